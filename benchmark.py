@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import statistics
+import concurrent.futures
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+from rca.baseline.rca_agent.sql_functions import register_sql_functions
+from rca.baseline.rca_agent.sql_rollup import rewrite_for_rollups
+from rca.baseline.rca_agent.sql_pool import get_pool
+
+# Micro-benchmarks for the SQL side of the RCA agent, run against an imported dataset/<name>/data.db
+
+def timed(conn, sql, repeat):
+    best = None
+    rows = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        rows = conn.execute(sql).fetchall()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+def series_columns(conn, table):
+    columns = [col[1] for col in conn.execute(f'PRAGMA table_info("{table}")')]
+    kpi = next((col for col in ('kpi_name', 'name') if col in columns), None)
+    if 'cmdb_id' not in columns or kpi is None or 'value' not in columns:
+        raise SystemExit(f"{table} is not a long-format metric table (cmdb_id, kpi_name|name, value)")
+    return 'cmdb_id', kpi
+
+def max_abs_diff(rows_a, rows_b):
+    a = {tuple(row[:-1]): row[-1] for row in rows_a}
+    b = {tuple(row[:-1]): row[-1] for row in rows_b}
+    diffs = [abs(a[key] - b[key]) for key in a if key in b and a[key] is not None and b[key] is not None]
+    return max(diffs) if diffs else 0.0
+
+def bench_sql_functions(args):
+    conn = sqlite3.connect(args.db)
+    register_sql_functions(conn)
+    component, kpi = series_columns(conn, args.table)
+    group = f'{component}, {kpi}'
+    # Pure-SQL formulations the model writes without the registered functions
+    ranked = f"""WITH ranked AS (
+        SELECT {group}, value,
+               ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY value) AS rn,
+               COUNT(*) OVER (PARTITION BY {group}) AS n
+        FROM "{args.table}" WHERE value IS NOT NULL)"""
+    cases = [
+        ('P95',
+         f'SELECT {group}, percentile(value, 95) FROM "{args.table}" GROUP BY {group}',
+         f'{ranked} SELECT {group}, MIN(value) FROM ranked WHERE rn >= 0.95 * n GROUP BY {group}'),
+        ('median',
+         f'SELECT {group}, median(value) FROM "{args.table}" GROUP BY {group}',
+         f'{ranked} SELECT {group}, AVG(value) FROM ranked WHERE rn IN ((n + 1) / 2, (n + 2) / 2) GROUP BY {group}'),
+        ('stddev',
+         f'SELECT {group}, stddev(value) FROM "{args.table}" GROUP BY {group}',
+         f'SELECT {group}, (SUM(value * value) - SUM(value) * SUM(value) / COUNT(value)) / (COUNT(value) - 1) '
+         f'FROM "{args.table}" GROUP BY {group}'),
+    ]
+    total = conn.execute(f'SELECT COUNT(*) FROM "{args.table}"').fetchone()[0]
+    print(f"Table {args.table}: {total} rows")
+    for name, udf_sql, plain_sql in cases:
+        udf_secs, udf_rows = timed(conn, udf_sql, args.repeat)
+        plain_secs, plain_rows = timed(conn, plain_sql, args.repeat)
+        if name == 'stddev':
+            # The pure-SQL version yields the variance; SQLite has no sqrt without the math extension
+            plain_rows = [(*row[:-1], row[-1] ** 0.5 if row[-1] is not None and row[-1] >= 0 else None) for row in plain_rows]
+        print(f"{name:>8}: udf {udf_secs * 1000:9.1f} ms | pure SQL {plain_secs * 1000:9.1f} ms | "
+              f"speedup {plain_secs / max(udf_secs, 1e-9):5.2f}x | max |diff| {max_abs_diff(udf_rows, plain_rows):.4g}")
+    conn.close()
+
+def bench_rollups(args):
+    conn = sqlite3.connect(args.db)
+    component, kpi = series_columns(conn, args.table)
+    start, end = conn.execute(f'SELECT MIN(timestamp), MAX(timestamp) FROM "{args.table}"').fetchone()
+    # Window and bucket sizes in the table's timestamp unit
+    unit = 1000 if end > 1e11 else 1
+    window_end = start - start % (3600 * unit) + args.hours * 3600 * unit
+    cases = [
+        (f'{bucket}s buckets over {args.hours}h',
+         f'SELECT {component}, {kpi}, (timestamp / {bucket * unit}) * {bucket * unit} AS bucket, AVG(value), MAX(value) '
+         f'FROM "{args.table}" WHERE timestamp >= {start - start % (3600 * unit)} AND timestamp < {window_end} '
+         f'GROUP BY {component}, {kpi}, bucket')
+        for bucket in (60, 300, 3600)
+    ]
+    cases.append(('whole table per series', f'SELECT {component}, {kpi}, MIN(value), MAX(value), COUNT(value) FROM "{args.table}" GROUP BY {component}, {kpi}'))
+    for name, sql in cases:
+        rewrite = rewrite_for_rollups(sql, conn)
+        if rewrite is None:
+            print(f"{name:>24}: not rewritten (was the dataset imported with --rollups?)")
+            continue
+        raw_secs, raw_rows = timed(conn, sql, args.repeat)
+        rollup_secs, rollup_rows = timed(conn, rewrite[0], args.repeat)
+        print(f"{name:>24}: raw {raw_secs * 1000:9.1f} ms | {rewrite[1]} {rollup_secs * 1000:9.1f} ms | "
+              f"speedup {raw_secs / max(rollup_secs, 1e-9):6.1f}x | max |diff| {max_abs_diff(raw_rows, rollup_rows):.4g}")
+    conn.close()
+
+def bench_pool(args):
+    conn = sqlite3.connect(args.db)
+    component, kpi = series_columns(conn, args.table)
+    start, end = conn.execute(f'SELECT MIN(timestamp), MAX(timestamp) FROM "{args.table}"').fetchone()
+    some_component = conn.execute(f'SELECT {component} FROM "{args.table}" LIMIT 1').fetchone()[0]
+    conn.close()
+    window = (end - start) // 8
+    # The exploratory queries the executor repeats across steps: listings, a window scan, a series lookup
+    queries = [
+        f'SELECT DISTINCT {component} FROM "{args.table}"',
+        f'SELECT DISTINCT {kpi} FROM "{args.table}"',
+        f'SELECT {component}, {kpi}, MAX(value) FROM "{args.table}" WHERE timestamp BETWEEN {start + window} AND {start + 2 * window} GROUP BY {component}, {kpi}',
+        f"SELECT timestamp, {kpi}, value FROM \"{args.table}\" WHERE {component} = '{some_component}' AND timestamp BETWEEN {start} AND {start + window}",
+    ]
+
+    def fresh(sql):
+        t0 = time.perf_counter()
+        with sqlite3.connect(args.db) as conn:
+            register_sql_functions(conn)
+            conn.execute(sql).fetchall()
+        conn.close()
+        return time.perf_counter() - t0
+
+    def pooled(sql):
+        t0 = time.perf_counter()
+        with get_pool(args.db).connection() as conn:
+            conn.execute(sql).fetchall()
+        return time.perf_counter() - t0
+
+    for name, run in (('new connection', fresh), ('pooled', pooled)):
+        jobs = [sql for _ in range(args.rounds) for sql in queries]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+            t0 = time.perf_counter()
+            latencies = list(executor.map(run, jobs))
+            wall = time.perf_counter() - t0
+        print(f"{name:>15}: {len(jobs)} queries on {args.threads} thread(s) | mean {statistics.mean(latencies) * 1000:8.2f} ms | "
+              f"p50 {statistics.median(latencies) * 1000:8.2f} ms | max {max(latencies) * 1000:8.2f} ms | wall {wall:.2f}s")
+    print(f"Pool: {get_pool(args.db).stats()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("sql_functions", help="registered percentile/median/stddev vs pure-SQL formulations")
+    p.add_argument("--db", type=str, default="dataset/Market/cloudbed-1/data.db")
+    p.add_argument("--table", type=str, default="metric_container")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_sql_functions)
+    p = subparsers.add_parser("rollups", help="aggregates over the raw metric table vs the rollup tables they are rewritten to")
+    p.add_argument("--db", type=str, default="dataset/Market/cloudbed-1/data.db")
+    p.add_argument("--table", type=str, default="metric_container")
+    p.add_argument("--hours", type=int, default=6)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_rollups)
+    p = subparsers.add_parser("pool", help="repeated-query latency with a new connection per query vs the read-only pool")
+    p.add_argument("--db", type=str, default="dataset/Market/cloudbed-1/data.db")
+    p.add_argument("--table", type=str, default="metric_container")
+    p.add_argument("--rounds", type=int, default=20)
+    p.add_argument("--threads", type=int, default=1)
+    p.set_defaults(func=bench_pool)
+    args = parser.parse_args()
+    args.func(args)
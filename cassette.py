@@ -0,0 +1,116 @@
+import os
+import gzip
+import json
+import time
+import atexit
+import hashlib
+import threading
+
+# Record/replay cassette for the agent's LLM calls, for offline, repeatable end-to-end runs. Record
+# mode passes every completion through to the backend and appends the response, keyed by a hash of the
+# messages, to a gzip JSONL cassette; replay mode serves the responses back in the order they were
+# recorded, optionally sleeping for the recorded latency, so the non-LLM paths can be profiled without
+# a model. A replayed prompt that was never recorded (the run diverged, e.g. a changed SQL result) gets
+# the response recorded at the same position of the same call site, unless replay is strict.
+
+class CassetteMiss(RuntimeError):
+    pass
+
+def request_key(messages):
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+class Cassette:
+    def __init__(self, path, mode, latency=0.0, strict=False):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"unknown cassette mode {mode!r}")
+        self.path = path
+        self.mode = mode
+        # Share of the recorded latency slept on replay (0 = none, 1 = as recorded)
+        self.latency = latency
+        self.strict = strict
+        self.lock = threading.Lock()
+        # Calls per call site so far, the position used when a prompt was never recorded
+        self.calls = {}
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self.file = None
+        if mode == 'record':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # Appending adds a gzip member; recording the same prompt again queues another response
+            self.file = gzip.open(path, 'at', encoding='utf-8')
+            atexit.register(self.close)
+            return
+        self.by_key = {}
+        self.by_position = {}
+        self.served = {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                self.by_key.setdefault(record['key'], []).append(record)
+                self.by_position.setdefault((record['label'], record['seq']), record)
+
+    def call(self, completion, label, messages, kwargs):
+        key = request_key(messages)
+        if self.mode == 'record':
+            start = time.perf_counter()
+            # Calls that raise (e.g. a rejected option that is retried without it) are not recorded or counted
+            response = completion(messages=messages, **kwargs)
+            latency = round(time.perf_counter() - start, 3)
+            with self.lock:
+                seq = self.calls.get(label, 0)
+                self.calls[label] = seq + 1
+                record = {'key': key, 'label': label, 'seq': seq, 'latency': latency, 'response': response}
+                self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.file.flush()
+                self.recorded += 1
+            return response
+        with self.lock:
+            seq = self.calls.get(label, 0)
+            self.calls[label] = seq + 1
+            records = self.by_key.get(key, [])
+            served = self.served.get(key, 0)
+            if served < len(records):
+                record = records[served]
+                self.served[key] = served + 1
+                self.hits += 1
+            else:
+                record = None if self.strict else self.by_position.get((label, seq))
+                if record is None:
+                    raise CassetteMiss(f"no recorded response for {label} call {seq + 1} (prompt {key}) in {self.path}")
+                self.misses += 1
+        if self.latency:
+            time.sleep(record['latency'] * self.latency)
+        return record['response']
+
+    def stats(self):
+        with self.lock:
+            return {'mode': self.mode, 'recorded': self.recorded, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+_cassette = None
+
+def use_cassette(path, mode, latency=0.0, strict=False):
+    global _cassette
+    if _cassette is not None:
+        _cassette.close()
+    _cassette = Cassette(path, mode, latency, strict)
+    return _cassette
+
+def get_cassette():
+    return _cassette
+
+def recorded(completion, label):
+    # Wraps a get_chat_completion-style function so its calls go through the active cassette, if any;
+    # label names the call site
+    def call(messages, **kwargs):
+        if _cassette is None:
+            return completion(messages=messages, **kwargs)
+        return _cassette.call(completion, label, messages, kwargs)
+    return call
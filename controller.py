@@ -3,8 +3,19 @@ import re
 #from IPython.terminal.embed import InteractiveShellEmbed  # Remove this import
 
 from rca.baseline.rca_agent.executor import execute_act
+from rca.baseline.rca_agent.log_sink import set_context
+from rca.baseline.rca_agent.prompt_compaction import PromptCompactor, HISTORY_TOKEN_BUDGET, KEEP_STEPS
 
-from rca.api_router import get_chat_completion
+from rca.baseline.rca_agent.prompt_meter import metered
+from rca.baseline.rca_agent.json_repair import loads as repaired_loads, strip_fence
+from rca.baseline.rca_agent.llm_stream import streaming, json_end
+from rca.baseline.rca_agent.cassette import recorded
+from rca.api_router import get_chat_completion as api_chat_completion
+
+# LLM calls are metered and go through the record/replay cassette when one is in use
+get_chat_completion = metered(recorded(api_chat_completion, 'controller'), 'controller')
+# Step responses are streamed and cut off once their JSON object is complete
+step_chat_completion = metered(recorded(streaming(api_chat_completion, json_end, 'controller'), 'controller-step'), 'controller')
 
 system = """You are the Administrator of a DevOps Assistant system for failure diagnosis. To solve each given issue, you should iteratively instruct an Executor to write and execute Python code for data analysis on telemetry files of target system. By analyzing the execution results, you should approximate the answer step-by-step.
 
@@ -14,15 +25,9 @@ There is some domain knowledge for you:
 
 {agent}
 
-The issue you are going to solve is:
-
-{objective}
-
-Solve the issue step-by-step. In each step, your response should follow the JSON format below:
-
-{format}
+The issue you are going to solve is given in the first user message. Solve the issue step-by-step. In each step, your response should follow the JSON format below:
 
-Let's begin."""
+{format}"""
 
 format = """{
     "analysis": (Your analysis of the code execution result from Executor in the last step, with detailed reasoning of 'what have been done' and 'what can be derived'. Respond 'None' if it is the first step.),
@@ -31,6 +36,36 @@ format = """{
 }
 (DO NOT contain "```json" and "```" tags. DO contain the JSON object with the brackets "{}" only. Use '\\n' instead of an actual newline character to ensure JSON compatibility when you want to insert a line break within a string.)"""
 
+# The same format as a JSON schema, for backends with structured output (e.g. Ollama's format option)
+response_schema = {
+    "type": "object",
+    "properties": {
+        "analysis": {"type": "string"},
+        "completed": {"type": "string", "enum": ["True", "False"]},
+        "instruction": {"type": "string"},
+    },
+    "required": ["analysis", "completed", "instruction"],
+}
+
+# Ask the backend for schema-constrained step responses; turned off once the client or the backend rejects the format option
+STRUCTURED_OUTPUT = True
+
+# Step responses of the last control_loop: all, those that needed repair, and those re-asked
+response_stats = {'responses': 0, 'repaired': 0, 'reasked': 0}
+
+opening = """The issue you are going to solve is:
+
+{objective}
+
+Let's begin."""
+
+# Sent after the latest turn of every step; kept short since it is evaluated anew each time
+reminder = """Continue your reasoning process for the target issue:
+
+{objective}
+
+Follow the rules and the JSON response format given in the system prompt."""
+
 summary = """Now, you have decided to finish your reasoning process. You should now provide the final answer to the issue. The candidates of possible root cause components and reasons are provided to you. The root cause components and reasons must be selected from the provided candidates.
 
 {cand}
@@ -57,16 +92,60 @@ Please first review your previous reasoning process to infer an exact answer of
 (Please use "```json" and "```" tags to wrap the JSON object. You only need to provide the elements asked by the issue, and ommited the other fields in the JSON.)
 Note that all the root cause components and reasons must be selected from the provided candidates. Do not reply 'unknown' or 'null' or 'not found' in the JSON. Do not be too conservative in selecting the root cause components and reasons. Be decisive to infer a possible answer based on your current observation."""
 
-def control_loop(objective:str, plan:str, ap, bp, logger, max_step = 15, max_turn = 3) -> str:
+def format_rejected(e):
+    # The client has no format option, or the backend turns the schema down (ollama.ResponseError from
+    # a server without structured outputs, or an OpenAI-style 400 on response_format)
+    if isinstance(e, TypeError):
+        return 'format' in str(e)
+    message = str(e).lower()
+    return getattr(e, 'status_code', None) in (400, 422) and ('format' in message or 'schema' in message)
+
+def step_completion(messages, logger=None):
+    global STRUCTURED_OUTPUT
+    if STRUCTURED_OUTPUT:
+        try:
+            return step_chat_completion(messages=messages, format=response_schema)
+        except Exception as e:
+            if not format_rejected(e):
+                raise
+            # Prompt-only output from here on, repaired when needed
+            STRUCTURED_OUTPUT = False
+            if logger:
+                logger.warning(f"Structured output is not supported by the backend ({e}); falling back to prompt-only JSON.")
+    return step_chat_completion(messages=messages)
+
+def parse_step(response_raw):
+    # (step response, whether it needed repair); the response is None when no instruction can be read from it
+    try:
+        # A well-formed object in a ```json fence, as the prompt asks for, needs no repair
+        response = json.loads(strip_fence(response_raw))
+        repaired = False
+    except ValueError:
+        try:
+            response = repaired_loads(response_raw)
+        except ValueError:
+            return None, True
+        repaired = True
+    if not isinstance(response, dict) or not isinstance(response.get('instruction'), str) or not response['instruction'].strip():
+        return None, repaired
+    return response, repaired
+
+def control_loop(objective:str, plan:str, ap, bp, logger, max_step = 15, max_turn = 3,
+                 history_budget = HISTORY_TOKEN_BUDGET, keep_steps = KEEP_STEPS) -> str:
    
+    # The system prompt holds only what is the same for every task of a dataset (schema, rules, format), so
+    # it is a byte-identical prefix the backend can keep cached; the issue comes in the first user message
     prompt = [
-            {'role': 'system', 'content': system.format(objective=objective,
-                                                        format=format,
+            {'role': 'system', 'content': system.format(format=format,
                                                         agent=ap.rules, 
                                                         background=bp.schema)},
-            {'role': 'user', 'content': "Let's begin."}
+            {'role': 'user', 'content': opening.format(objective=objective)}
         ]
+    note = [{'role': 'user', 'content': reminder.format(objective=objective)}]
 
+    # prompt keeps the whole transcript; the compactor decides what of it is sent
+    compactor = PromptCompactor(history_budget, keep_steps)
+    response_stats.update(responses=0, repaired=0, reasked=0)
     history = []
     trajectory = []
     observation = "Let's begin."
@@ -78,34 +157,38 @@ def control_loop(objective:str, plan:str, ap, bp, logger, max_step = 15, max_tur
     # kernel.run_cell(init_code)
 
     for step in range(max_step):
-        
-        note = [{'role': 'user', 'content': f"Continue your reasoning process for the target issue:\n\n{objective}\n\nFollow the rules during issue solving:\n\n{ap.rules}.\n\nResponse format:\n\n{format}"}]
+        set_context(step=step + 1)
         attempt_actor = []
         try:
-            response_raw = get_chat_completion(
-                messages=prompt + note,
-            )
-            if "```json" in response_raw:
-                response_raw = re.search(r"```json\n(.*)\n```", response_raw, re.S).group(1).strip()
+            messages = compactor.messages(prompt, note)
+            logger.debug(f"Prompt tokens: ~{compactor.last_tokens[1]} sent, ~{compactor.last_tokens[0]} in the full history")
+            response_raw = step_completion(messages, logger)
             logger.debug(f"Raw Response:\n{response_raw}")
-            if '"analysis":' not in response_raw or '"instruction":' not in response_raw or '"completed":' not in response_raw:
+            response, repaired = parse_step(response_raw)
+            response_stats['responses'] += 1
+            if response is None:
+                response_stats['reasked'] += 1
                 logger.warning("Invalid response format. Please provide a valid JSON response.")
                 prompt.append({'role': 'assistant', 'content': response_raw})
                 prompt.append({'role': 'user', 'content': "Please provide your analysis in requested JSON format."})
                 continue
-            response = json.loads(response_raw)
-            analysis = response['analysis']
+            if repaired:
+                response_stats['repaired'] += 1
+                # The transcript keeps the repaired object, so the model is not shown its own malformed output
+                response_raw = json.dumps(response, ensure_ascii=False)
+                logger.debug(f"Repaired Response:\n{response_raw}")
+            analysis = response.get('analysis', 'None')
             instruction = response['instruction']
-            completed = response['completed']
+            completed = str(response.get('completed', 'False'))
             logger.info('-'*80 + '\n' + f"### Step[{step+1}]\nAnalysis: {analysis}\nInstruction: {instruction}" + '\n' + '-'*80)
 
-            if completed == "True":
+            if completed.lower() == "true":
                 # kernel.reset()  # Remove kernel reset
                 prompt.append({'role': 'assistant', 'content': response_raw})
                 prompt.append({'role': 'user', 'content': summary.format(objective=objective,
                                                                                 cand=bp.cand)})
                 answer = get_chat_completion(
-                    messages=prompt,
+                    messages=compactor.messages(prompt),
                 )
                 logger.debug(f"Raw Final Answer:\n{answer}")
                 prompt.append({'role': 'assistant', 'content': answer})
@@ -119,8 +202,7 @@ def control_loop(objective:str, plan:str, ap, bp, logger, max_step = 15, max_tur
                 observation = "The Executor failed to execute the instruction. Please provide a new instruction."
             observation = f"{result}"
             history = new_history
-            trajectory.append({'code': f"# In[{step+1}]:\n\n{code}", 'result': f"Out[{step+1}]:\n```
-{result}```"})
+            trajectory.append({'code': f"# In[{step+1}]:\n\n{code}", 'result': f"Out[{step+1}]:\n```\n{result}```"})
             logger.info('-'*80 + '\n' + f"Step[{step+1}]\n### Observation:\n{result}" + '\n' + '-'*80)
             prompt.append({'role': 'assistant', 'content': response_raw})
             prompt.append({'role': 'user', 'content': observation})
@@ -143,7 +225,7 @@ def control_loop(objective:str, plan:str, ap, bp, logger, max_step = 15, max_tur
     else:
         prompt.append({'role': 'user', 'content': final_prompt['content']})
     answer = get_chat_completion(
-        messages=prompt,
+        messages=compactor.messages(prompt),
     )
     logger.debug(f"Raw Final Answer:\n{answer}")
     prompt.append({'role': 'assistant', 'content': answer})
@@ -2,14 +2,45 @@ import re
 import time
 import sqlite3
 from datetime import datetime
-from rca.api_router import get_chat_completion
-import tiktoken
-import traceback
-import pandas as pd
+from rca.api_router import get_chat_completion as api_chat_completion
+from rca.baseline.rca_agent.sql_functions import sql_functions_doc
+from rca.baseline.rca_agent.sql_pool import get_pool
+from rca.baseline.rca_agent.sql_cache import get_cache, normalize_sql
+from rca.baseline.rca_agent.sql_budget import QueryBudget, QueryBudgetExceeded
+from rca.baseline.rca_agent.sql_result import fetch_result, render_result
+from rca.baseline.rca_agent.sql_rollup import rewrite_for_rollups
+from rca.baseline.rca_agent.sql_preflight import preflight, PreflightRejected
+from rca.baseline.rca_agent.sql_validate import get_validator
+from rca.baseline.rca_agent.log_sink import get_log
+from rca.baseline.rca_agent.prompt_meter import metered
+from rca.baseline.rca_agent.llm_stream import streaming, sql_end
+from rca.baseline.rca_agent.cassette import recorded
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
-import json
 
 DB_PATH = 'dataset/Telecom/data.db'
+# Run aggregate queries over raw metric tables on the coarsest rollup table that answers them
+ROLLUP_REWRITE = True
+# Serve repeated queries from the dataset's persistent result cache (dataset/<name>/sql_cache.db)
+RESULT_CACHE = True
+# Check every query's plan before running it: fix time filters that defeat the timestamp index and reject plans that visit too many rows
+PREFLIGHT = True
+# Compile queries against the cached schema first: fix misspelt names with a single close match, report the rest without touching the DB
+VALIDATE_SQL = True
+# Candidate queries generated in parallel per attempt (1 = one completion at a time)
+SQL_CANDIDATES = 1
+# Sampling temperature of each speculative candidate, the last one repeated: the first candidate is the
+# sequential mode's greedy completion, the others sample so they do not all return the same query
+CANDIDATE_TEMPERATURES = (0.0, 0.5, 0.8, 1.0)
+# Set to False when the backend has no temperature option; candidates are then told apart by the prompt
+CANDIDATE_SAMPLING = True
+# ```sql blocks of one response run concurrently as a batch, at most this many (the rest are ignored)
+MAX_BATCH = 4
+sql_pattern = re.compile(r"```sql\n(.*?)\n```", re.DOTALL)
+# LLM calls are metered and go through the record/replay cassette when one is in use
+get_chat_completion = metered(recorded(api_chat_completion, 'executor'), 'executor')
+# SQL responses are streamed and cut off once their ```sql blocks are complete
+sql_chat_completion = metered(recorded(streaming(api_chat_completion, sql_end(MAX_BATCH), 'executor'), 'executor-sql'), 'executor')
 
 # Helper to get dataset name from DB_PATH
 
@@ -22,15 +53,9 @@ def get_dataset_name_from_db_path(db_path):
     return 'unknown'
 
 def get_sql_logger(db_path):
+    # Records go through the shared buffered sink as JSONL; extra fields (sql, rows, duration) are keyword arguments
     dataset_name = get_dataset_name_from_db_path(db_path)
-    log_path = os.path.join('dataset', dataset_name, 'sql_executor.log')
-    def log(msg):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        line = f"[{timestamp}] {msg}"
-        print(line)
-        with open(log_path, 'a') as f:
-            f.write(line + '\n')
-    return log
+    return get_log(os.path.join('dataset', dataset_name, 'sql_executor.jsonl'), dataset=dataset_name)
 
 system = """You are a DevOps assistant for writing SQL queries to answer RCA (Root Cause Analysis) questions. For each question, you need to write a SQL query to solve it by retrieving and processing telemetry data of the target system. Your generated SQL query will be automatically submitted to a SQLite database. The execution result output in SQLite will be used as the answer to the question.
 
@@ -39,6 +64,8 @@ system = """You are a DevOps assistant for writing SQL queries to answer RCA (Ro
 There is some domain knowledge for you:
 
 {background}
+{precomputed}
+{functions}
 
 Your response should follow the SQL block format below:
 
@@ -46,7 +73,17 @@ Your response should follow the SQL block format below:
 
 format = """```sql
 (YOUR SQL QUERY HERE)
-```"""
+```
+
+If the instruction needs several independent lookups (e.g. the thresholds of several KPIs, or the same check on several tables), write one ```sql block per lookup in the same response: they are run concurrently and their results are returned together."""
+
+batch_result = """Query {index} of {count} ({state}):
+```sql
+{sql}
+```
+{result}"""
+
+candidate_note = """Write candidate {index} of {count}: a query that answers the instruction in a different way than the most obvious one (other tables, filters or aggregation), following the same rules and response format."""
 
 summary = """The SQL execution is successful. The execution result is shown below: 
 
@@ -60,6 +97,21 @@ The original SQL execution output is also provided below for reference:
 
 {result}"""
 
+too_expensive = """The SQL query was stopped because it is too expensive: {reason} (after {elapsed:.1f}s, {steps} SQLite VM steps, {rows} rows returned).
+
+Revise the query so it touches less data, e.g. filter on the indexed `timestamp` / `cmdb_id` columns with a narrow time window, aggregate (GROUP BY) instead of returning raw rows, add LIMIT, use the precomputed tables where they apply, and avoid cross joins or self-joins without selective join conditions."""
+
+budget_reasons = {
+    'time': "it ran longer than the {limit:.0f}s time limit",
+    'vm_steps': "it exceeded the limit of {limit} SQLite VM steps (it scans or joins too many rows)",
+}
+
+expensive_plan = """The SQL query was not run because its query plan would visit about {estimate:.3g} rows.
+
+{hints}
+
+Revise the query so SQLite can use an index: compare raw indexed columns with constants (convert time bounds to the column's unit instead of converting the column), join on selective keys, and aggregate the big tables in a filtered subquery before joining them."""
+
 rule = """## RULES OF SQL QUERY WRITING:
 
 1. Use only the tables and columns provided in the schema.
@@ -70,75 +122,248 @@ rule = """## RULES OF SQL QUERY WRITING:
 6. Do not generate anything else except the SQL code block except the instruction tells you to 'Use plain English'. If you find the input instruction is a summarization task (which is typically happening in the last step), you should comprehensively summarize the conclusion as a string and display it directly.
 """
 
+# Descriptions of the tables the importer precomputes, shown to the model when they exist in the DB
+precomputed_tables = {
+    'kpi_thresholds': """- `kpi_thresholds` (dataset, date, metric_table, component, kpi, p5, p15, p50, p90, p95, p99, min, max, mean, count): global thresholds of every component-KPI time series, computed over the whole metric file of each day (`date` is the telemetry directory name, e.g. '2022_03_20'; `metric_table` is the metric table the series comes from). Read global P95/P90/P15/P5 thresholds from this table with a point lookup on (component, kpi, date) instead of computing percentiles over the raw metric table.""",
+    'anomaly_segments': """- `anomaly_segments` (dataset, date, metric_table, component, kpi, direction, percentile, threshold, start_ts, end_ts, points, peak, breach_ratio): pre-detected faults, i.e. runs of consecutive points of a component-KPI series beyond its global threshold (`direction` 'high' = above the `percentile` threshold, 'low' = below it). Isolated single-point spikes are already filtered out. `start_ts`/`end_ts` use the same unit as the source metric table's timestamp, `peak` is the extremal value of the run and `breach_ratio` = |peak - threshold| / |threshold|. To find which components breached within a failure window, query this table with `start_ts <= <window end> AND end_ts >= <window start>`.""",
+    'span_edges': """- `span_edges` (dataset, date, trace_table, trace_id, parent_span, child_span, caller, callee, duration, timestamp): one row per parent->child span call, with the caller and callee components (`cmdb_id` of the parent and child span), the child span's duration and start timestamp (same unit as the trace table). Use it instead of self-joining the raw trace table to follow call chains.""",
+    'trace_service_depth': """- `trace_service_depth` (dataset, date, trace_table, trace_id, service, min_depth, max_depth, spans, first_ts): the position of every component within every trace, where depth 0 is the root span and larger depths are further downstream. The most downstream component of a trace is the one with the largest `max_depth`; to rank candidate components by how downstream they are, filter on `service IN (...)` and the time window on `first_ts`.""",
+}
+
+log_search_table = """- `{fts}`: full-text index (SQLite FTS5) over the text columns of `{log}`, sharing its rowid. Search log lines by keyword with `MATCH` instead of `LIKE '%...%'`, and filter time and component on the indexed `{log}` columns, e.g. `SELECT * FROM {log} WHERE rowid IN (SELECT rowid FROM {fts} WHERE {fts} MATCH 'OutOfMemoryError OR "GC pause"') AND timestamp BETWEEN ... AND cmdb_id = ...`. MATCH supports AND/OR/NOT, "exact phrases" and prefix* queries; quote search terms containing punctuation."""
+
+rollup_table = """- `{rollups}`: per-bucket aggregates of `{metric}` at 1 minute / 5 minutes / 1 hour, keyed by `{keys}` and `{ts}` (the bucket start, same unit as `{metric}`), with `<kpi column>_min`, `_max`, `_avg`, `_sum`, `_count` for {values}. Aggregate them with MIN(_min), MAX(_max), SUM(_sum) / SUM(_count) and SUM(_count) for per-minute or longer trends instead of scanning `{metric}`."""
+
+def describe_precomputed_tables(db_path):
+    try:
+        with get_pool(db_path).connection() as conn:
+            names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            rollups = {}
+            if 'rollup_tables' in names:
+                for row in conn.execute('SELECT metric_table, table_name, timestamp_column, component_column, kpi_column, value_columns FROM rollup_tables ORDER BY metric_table, seconds'):
+                    rollups.setdefault(row[0], []).append(row[1:])
+    except (sqlite3.Error, OSError):
+        return ''
+    lines = [text for name, text in precomputed_tables.items() if name in names]
+    for metric, tables in rollups.items():
+        _, ts, component, kpi, values = tables[0]
+        lines.append(rollup_table.format(rollups='`, `'.join(t[0] for t in tables), metric=metric, ts=ts,
+                                         keys='`, `'.join(c for c in (component, kpi) if c),
+                                         values=', '.join(f'`{v}`' for v in values.split(','))))
+    for name in sorted(names):
+        if name.endswith('_fts') and name[:-len('_fts')] in names:
+            lines.append(log_search_table.format(fts=name, log=name[:-len('_fts')]))
+    if not lines:
+        return ''
+    return "\n## PRECOMPUTED TABLES:\n\n" + '\n'.join(lines) + "\n"
+
+def validate_sql(sql_code, sql_log):
+    # Returns (sql to run, retry hint when it does not compile against the schema)
+    if not VALIDATE_SQL:
+        return sql_code, None
+    try:
+        validator = get_validator(DB_PATH)
+        validation = validator.validate(sql_code)
+    except Exception as validate_err:
+        sql_log(f"SQL validation skipped: {validate_err}")
+        return sql_code, None
+    for kind, name, fix in validation.fixes:
+        sql_log(f"Fixed unknown {kind} {name} -> {fix}")
+    return validation.sql, None if validation.ok else validator.describe(validation)
+
+def checked_sql(conn, sql_code, sql_log, budget):
+    # Raises PreflightRejected for plans that are too expensive to run; hints for expensive plans that
+    # still run go to the budget, which reports them if it stops the query
+    if not PREFLIGHT:
+        return sql_code
+    check = preflight(conn, sql_code)
+    for original, replacement in check.rewrites:
+        sql_log(f"Sargable rewrite: {original} -> {replacement}")
+    sql_log(f"Preflight: ~{check.estimate:.3g} row visits, full scans: {[scan[:2] for scan in check.scans]}")
+    budget.hints = check.hints
+    return check.sql
+
+def read_sql(conn, sql_code, sql_log, budget):
+    if ROLLUP_REWRITE:
+        try:
+            rewrite = rewrite_for_rollups(sql_code, conn)
+        except Exception as rewrite_err:
+            rewrite = None
+            sql_log(f"Rollup rewrite skipped: {rewrite_err}")
+        if rewrite:
+            sql_log(f"Rewritten to rollup {rewrite[1]}:\n{rewrite[0]}")
+            try:
+                return fetch_result(conn, checked_sql(conn, rewrite[0], sql_log, budget), budget)
+            except (QueryBudgetExceeded, PreflightRejected):
+                raise
+            except Exception as rewrite_err:
+                sql_log(f"Rollup query failed, running the original query: {rewrite_err}")
+    return fetch_result(conn, checked_sql(conn, sql_code, sql_log, budget), budget)
+
+def run_sql(sql_code, sql_log):
+    # Validates and executes one query. Returns (sql as run, status, observation, whether rows came back)
+    start = time.perf_counter()
+    sql_code, invalid = validate_sql(sql_code, sql_log)
+    if invalid:
+        # Caught locally against the cached schema, without a round trip to the database
+        sql_log(f"SQL VALIDATION ERROR: {invalid}", event='invalid', sql=sql_code, duration=time.perf_counter() - start)
+        return sql_code, False, invalid, False
+    try:
+        # Pooled read-only connection, reused across attempts, steps and tasks
+        with get_pool(DB_PATH).connection() as conn:
+            try:
+                result_cache = get_cache(DB_PATH) if RESULT_CACHE else None
+                query_result = result_cache.get(sql_code) if result_cache else None
+                if query_result is not None:
+                    sql_log(f"Result cache hit: {result_cache.stats()}")
+                else:
+                    # Time and VM-step budgets are enforced inside SQLite, the row budget while reading
+                    with QueryBudget().enforce(conn) as budget:
+                        query_result = read_sql(conn, sql_code, sql_log, budget)
+                    if result_cache:
+                        result_cache.put(sql_code, query_result)
+                        sql_log(f"Result cache miss: {result_cache.stats()}")
+                if query_result.empty:
+                    sql_log(f"Query returned no results.", event='result', sql=sql_code, rows=0, duration=time.perf_counter() - start)
+                    return sql_code, True, "(No results)", False
+                # Rendered to a token budget, so an oversized result no longer costs an attempt
+                result, tokens = render_result(query_result)
+                sql_log(f"Query result ({query_result.row_count} rows, ~{tokens} tokens):\n{result}", event='result', sql=sql_code,
+                        rows=query_result.row_count, tokens=tokens, duration=time.perf_counter() - start)
+                return sql_code, True, result, True
+            except QueryBudgetExceeded as budget_err:
+                reason = budget_reasons[budget_err.reason].format(limit=budget_err.limit)
+                sql_log(f"QUERY TOO EXPENSIVE: {budget_err}", event='too_expensive', sql=sql_code, rows=budget_err.rows, duration=time.perf_counter() - start)
+                observation = too_expensive.format(reason=reason, elapsed=budget_err.elapsed, steps=budget_err.steps, rows=budget_err.rows)
+                if budget_err.hints:
+                    observation += '\n' + '\n'.join(f"- {hint}" for hint in budget_err.hints)
+                return sql_code, False, observation, False
+            except PreflightRejected as plan_err:
+                sql_log(f"QUERY REJECTED BEFORE EXECUTION: {plan_err}", event='rejected', sql=sql_code, duration=time.perf_counter() - start)
+                return sql_code, False, expensive_plan.format(estimate=plan_err.estimate, hints='\n'.join(f"- {hint}" for hint in plan_err.hints)), False
+            except Exception as sql_err:
+                sql_log(f"SQL ERROR: {sql_err}", event='error', sql=sql_code, duration=time.perf_counter() - start)
+                return sql_code, False, str(sql_err), False
+    except Exception as db_err:
+        sql_log(f"DB ERROR: {db_err}", event='error', sql=sql_code, duration=time.perf_counter() - start)
+        return sql_code, False, str(db_err), False
+
+def extract_sql(response):
+    # One query per ```sql block, or the whole response when it has none
+    queries = [query.strip() for query in sql_pattern.findall(response)]
+    return queries[:MAX_BATCH] or [response.strip()]
+
+def run_batch(queries, sql_log):
+    # Independent lookups of one response run concurrently, each on its own pooled connection, and come
+    # back as one labeled observation. The batch fails only when every query failed.
+    # Returns (sql as run, status, observation, whether rows came back)
+    if len(queries) == 1:
+        return run_sql(queries[0], sql_log)
+    with ThreadPoolExecutor(max_workers=len(queries)) as workers:
+        outcomes = list(workers.map(lambda sql_code: run_sql(sql_code, sql_log), queries))
+    result = '\n\n'.join(batch_result.format(index=k + 1, count=len(outcomes), state='succeeded' if status else 'failed', sql=sql_code, result=result)
+                           for k, (sql_code, status, result, _) in enumerate(outcomes))
+    sql_log(f"Batch of {len(outcomes)} queries: {sum(outcome[1] for outcome in outcomes)} succeeded")
+    return (';\n\n'.join(outcome[0] for outcome in outcomes), any(outcome[1] for outcome in outcomes), result,
+            any(outcome[3] for outcome in outcomes))
+
+def candidate_completion(messages, index, count):
+    # Completion of speculative candidate index (0-based): the first is the plain greedy completion, the
+    # others are sampled at CANDIDATE_TEMPERATURES, or asked for a different query when the backend
+    # cannot sample
+    global CANDIDATE_SAMPLING
+    if index == 0:
+        return sql_chat_completion(messages=messages)
+    if CANDIDATE_SAMPLING:
+        temperature = CANDIDATE_TEMPERATURES[min(index, len(CANDIDATE_TEMPERATURES) - 1)]
+        try:
+            return sql_chat_completion(messages=messages, temperature=temperature)
+        except TypeError as e:
+            if 'temperature' not in str(e):
+                raise
+            CANDIDATE_SAMPLING = False
+    return sql_chat_completion(messages=messages + [{'role': 'user', 'content': candidate_note.format(index=index + 1, count=count)}])
+
+def run_candidates(messages, n, sql_log, attempt):
+    # Speculative mode: n differently sampled completions are requested in parallel and each candidate
+    # query is executed as soon as its completion arrives. The first candidate that returns rows wins
+    # without waiting for the others; otherwise the first successful (empty) one, and only when every
+    # candidate failed are all the errors reported back. Returns (sql_code, status, result).
+    workers = ThreadPoolExecutor(max_workers=2 * n)
+    pending = {workers.submit(candidate_completion, messages, k, n): None for k in range(n)}
+    seen = set()
+    outcomes = []
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                candidate = pending.pop(future)
+                if candidate is None:
+                    try:
+                        queries = extract_sql(future.result())
+                    except Exception as llm_err:
+                        sql_log(f"Candidate completion failed: {llm_err}")
+                        continue
+                    key = tuple(normalize_sql(query) for query in queries)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    sql_log(f"Executing SQL query (attempt {attempt+1}, candidate {len(seen)}/{n}):\n" + ';\n\n'.join(queries),
+                            event='execute', attempt=attempt + 1, candidate=len(seen), sql=queries)
+                    pending[workers.submit(run_batch, queries, sql_log)] = len(seen)
+                    continue
+                sql_code, status, result, rows = future.result()
+                outcomes.append((candidate, sql_code, status, result))
+                if status and rows:
+                    sql_log(f"Candidate {candidate} returned rows first ({len(outcomes)} of {len(seen)} candidates finished)")
+                    return sql_code, status, result
+    finally:
+        # Slower candidates finish in the background within their query budgets
+        workers.shutdown(wait=False, cancel_futures=True)
+    if not outcomes:
+        raise RuntimeError("no candidate SQL query was generated")
+    outcomes.sort()
+    for candidate, sql_code, status, result in outcomes:
+        if status:
+            return sql_code, status, result
+    if len(outcomes) == 1:
+        return outcomes[0][1], False, outcomes[0][3]
+    errors = '\n\n'.join(f"Candidate {candidate}:\n```sql\n{sql_code}\n```\n{result}" for candidate, sql_code, _, result in outcomes)
+    return outcomes[0][1], False, f"All {len(outcomes)} candidate queries failed.\n\n{errors}"
+
 def execute_act(instruction: str, background: str, history, attempt, logger) -> str:
     logger.debug("Start execution")
     t1 = datetime.now()
     if history == []:
         history = [
-            {'role': 'system', 'content': system.format(rule=rule, background=background, format=format)},
+            {'role': 'system', 'content': system.format(rule=rule, background=background, format=format,
+                                                        precomputed=describe_precomputed_tables(DB_PATH),
+                                                        functions=sql_functions_doc)},
         ]
-    sql_pattern = re.compile(r"```sql\n(.*?)\n```", re.DOTALL)
     sql_code = ""
     result = ""
     retry_flag = False
     status = False
     history.extend([{'role': 'user', 'content': instruction}])
     prompt = history.copy()
-    note = [{'role': 'user', 'content': f"Continue your SQL writing process following the rules:\n\n{rule}\n\nResponse format:\n\n{format}"}]
-    tokenizer = tiktoken.encoding_for_model("gpt-4")
+    # Short and constant: the rules and the response format are in the system prompt, which stays a byte-identical prefix
+    note = [{'role': 'user', 'content': "Continue your SQL writing process following the rules and the response format given in the system prompt."}]
     sql_log = get_sql_logger(DB_PATH)
     for i in range(2):
         try:
-            if not retry_flag:
-                response = get_chat_completion(
-                    messages=prompt + note,
-                )
-            else:
-                response = get_chat_completion(
-                    messages=prompt,
-                )
-                retry_flag = False
-            if re.search(sql_pattern, response):
-                sql_code = re.search(sql_pattern, response).group(1).strip()
+            messages = prompt if retry_flag else prompt + note
+            retry_flag = False
+            if SQL_CANDIDATES > 1:
+                sql_code, status, result = run_candidates(messages, SQL_CANDIDATES, sql_log, i)
             else:
-                sql_code = response.strip()
-            logger.debug(f"Raw SQL:\n{sql_code}")
-            sql_log(f"Executing SQL query (attempt {i+1}):\n{sql_code}")
-            # Execute SQL
-            try:
-                with sqlite3.connect(DB_PATH) as conn:
-                    df = None
-                    try:
-                        df = pd.read_sql_query(sql_code, conn)
-                        status = True
-                        if df.empty:
-                            result = "(No results)"
-                            sql_log(f"Query returned no results.")
-                        else:
-                            max_rows = 20
-                            truncated = False
-                            if len(df) > max_rows:
-                                truncated = True
-                                result = df.head(max_rows).to_string(index=False)
-                                result += f"\n\n**Note**: Only the first {max_rows} rows are shown. The result was truncated."
-                                sql_log(f"Query result truncated to {max_rows} rows.")
-                            else:
-                                result = df.to_string(index=False)
-                            sql_log(f"Query result:\n{result}")
-                    except Exception as sql_err:
-                        status = False
-                        result = str(sql_err)
-                        sql_log(f"SQL ERROR: {result}")
-            except Exception as db_err:
-                status = False
-                result = str(db_err)
-                sql_log(f"DB ERROR: {result}")
+                queries = extract_sql(sql_chat_completion(
+                    messages=messages,
+                ))
+                sql_code = ';\n\n'.join(queries)
+                logger.debug(f"Raw SQL:\n{sql_code}")
+                sql_log(f"Executing SQL query (attempt {i+1}):\n{sql_code}", event='execute', attempt=i + 1, sql=queries)
+                sql_code, status, result, _ = run_batch(queries, sql_log)
             if status:
-                tokens_len = len(tokenizer.encode(result))
-                if tokens_len > 16384:
-                    logger.warning(f"Token length exceeds the limit: {tokens_len}")
-                    sql_log(f"Token length exceeds the limit: {tokens_len}")
-                    continue
                 t2 = datetime.now()
                 logger.debug(f"Execution Result:\n{result}")
                 logger.debug(f"Execution finished. Time cost: {t2-t1}")
@@ -1,172 +1,1064 @@
-import os
-import sqlite3
-import pandas as pd
-import sys
-import json
-import datetime
-
-def infer_sqlite_type(dtype):
-    if pd.api.types.is_integer_dtype(dtype):
-        return 'INTEGER'
-    elif pd.api.types.is_float_dtype(dtype):
-        return 'REAL'
-    elif pd.api.types.is_bool_dtype(dtype):
-        return 'BOOLEAN'
-    else:
-        return 'TEXT'
-
-def get_logger(log_path):
-    def log(msg):
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        line = f"[{timestamp}] {msg}"
-        print(line)
-        with open(log_path, 'a') as f:
-            f.write(line + '\n')
-    return log
-
-def create_indexes(cursor, table_name, columns, log):
-    # Common index columns
-    index_cols = ['timestamp', 'component_id', 'trace_id', 'span_id']
-    for col in index_cols:
-        if col in columns:
-            idx_name = f'idx_{table_name}_{col}'
-            try:
-                cursor.execute(f'CREATE INDEX IF NOT EXISTS {idx_name} ON "{table_name}" ("{col}")')
-                log(f"Created index {idx_name} on {table_name}({col})")
-            except Exception as e:
-                log(f"ERROR creating index {idx_name} on {table_name}: {e}")
-
-def import_to_sql_and_get_schema(dataset_name):
-    dataset_dir = os.path.join(os.path.dirname(__file__), dataset_name)
-    telemetry_dir = os.path.join(dataset_dir, 'telemetry')
-    db_path = os.path.join(dataset_dir, 'data.db')
-    record_csv = os.path.join(dataset_dir, 'record.csv')
-    query_csv = os.path.join(dataset_dir, 'query.csv')
-    schema_json = os.path.join(dataset_dir, 'schema.json')
-    log_path = os.path.join(dataset_dir, 'import.log')
-    log = get_logger(log_path)
-
-    log(f"--- Starting import for dataset: {dataset_name} ---")
-    # Check for schema cache
-    csv_mtimes = []
-    for root, dirs, files in os.walk(dataset_dir):
-        for f in files:
-            if f.endswith('.csv'):
-                csv_mtimes.append(os.path.getmtime(os.path.join(root, f)))
-    db_mtime = os.path.getmtime(db_path) if os.path.exists(db_path) else 0
-    schema_mtime = os.path.getmtime(schema_json) if os.path.exists(schema_json) else 0
-    if os.path.exists(schema_json) and os.path.exists(db_path) and csv_mtimes and db_mtime >= max(csv_mtimes) and schema_mtime >= db_mtime:
-        log(f"Loaded schema from cache: {schema_json}")
-        with open(schema_json, 'r') as f:
-            schema_summary = json.load(f)
-        log(f"--- Import complete (from cache) for dataset: {dataset_name} ---")
-        return schema_summary
-
-    def import_csv_to_table(cursor, conn, csv_path, table_name):
-        try:
-            df = pd.read_csv(csv_path)
-            columns = []
-            for col in df.columns:
-                coltype = infer_sqlite_type(df[col].dtype)
-                columns.append(f'"{col}" {coltype}')
-            schema = ', '.join(columns)
-            cursor.execute(f'DROP TABLE IF EXISTS "{table_name}";')
-            cursor.execute(f'CREATE TABLE "{table_name}" ({schema});')
-            # Batch insert for large tables
-            chunksize = 10000 if len(df) > 10000 else None
-            df.to_sql(table_name, conn, if_exists='replace', index=False, chunksize=chunksize, method=None)
-            log(f"Imported table: {table_name} from {csv_path} ({len(df)} rows, chunksize={chunksize})")
-            create_indexes(cursor, table_name, df.columns, log)
-            return df
-        except Exception as e:
-            log(f"ERROR importing {csv_path} to {table_name}: {e}")
-            raise
-
-    if os.path.exists(db_path):
-        os.remove(db_path)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    schema_summary = {}
-
-    # Import record.csv and query.csv
-    df_record = import_csv_to_table(cursor, conn, record_csv, 'record')
-    df_query = import_csv_to_table(cursor, conn, query_csv, 'query')
-    schema_summary['record'] = list(df_record.dtypes.items())
-    schema_summary['query'] = list(df_query.dtypes.items())
-
-    # Scan all telemetry files
-    for date_dir in sorted(os.listdir(telemetry_dir)):
-        date_path = os.path.join(telemetry_dir, date_dir)
-        if not os.path.isdir(date_path):
-            continue
-        metric_dir = os.path.join(date_path, 'metric')
-        trace_dir = os.path.join(date_path, 'trace')
-        # Import all metric files
-        if os.path.isdir(metric_dir):
-            for metric_file in os.listdir(metric_dir):
-                if not metric_file.endswith('.csv'):
-                    continue
-                metric_type = metric_file.replace('.csv', '')
-                table_name = metric_type
-                csv_path = os.path.join(metric_dir, metric_file)
-                if not cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';").fetchone():
-                    df = import_csv_to_table(cursor, conn, csv_path, table_name)
-                    schema_summary[table_name] = list(df.dtypes.items())
-                else:
-                    df = pd.read_csv(csv_path)
-                    chunksize = 10000 if len(df) > 10000 else None
-                    df.to_sql(table_name, conn, if_exists='append', index=False, chunksize=chunksize, method=None)
-                    log(f"Appended to table: {table_name} from {csv_path} ({len(df)} rows, chunksize={chunksize})")
-        # Import all trace files
-        if os.path.isdir(trace_dir):
-            for trace_file in os.listdir(trace_dir):
-                if not trace_file.endswith('.csv'):
-                    continue
-                trace_type = trace_file.replace('.csv', '')
-                table_name = trace_type
-                csv_path = os.path.join(trace_dir, trace_file)
-                if not cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';").fetchone():
-                    df = import_csv_to_table(cursor, conn, csv_path, table_name)
-                    schema_summary[table_name] = list(df.dtypes.items())
-                else:
-                    df = pd.read_csv(csv_path)
-                    chunksize = 10000 if len(df) > 10000 else None
-                    df.to_sql(table_name, conn, if_exists='append', index=False, chunksize=chunksize, method=None)
-                    log(f"Appended to table: {table_name} from {csv_path} ({len(df)} rows, chunksize={chunksize})")
-    conn.commit()
-    conn.close()
-
-    # Save schema cache
-    with open(schema_json, 'w') as f:
-        json.dump(schema_summary, f, indent=2)
-    log(f"Schema cached to {schema_json}")
-
-    # Schema validation
-    expected_tables = {'record', 'query'}
-    metric_tables = [t for t in schema_summary if t.startswith('metric_')]
-    trace_tables = [t for t in schema_summary if t.startswith('trace')]
-    missing = []
-    for t in expected_tables:
-        if t not in schema_summary:
-            missing.append(t)
-    if not metric_tables:
-        missing.append('at least one metric_* table')
-    if not trace_tables:
-        missing.append('at least one trace* table')
-    if missing:
-        log(f"WARNING: Missing tables: {', '.join(missing)}")
-    log(f"--- Import complete for dataset: {dataset_name} ---")
-    return schema_summary
-
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python import_to_sql.py <DATASET_NAME>")
-        sys.exit(1)
-    dataset_name = sys.argv[1]
-    schema = import_to_sql_and_get_schema(dataset_name)
-    print(f'\n--- Schema Summary for {dataset_name} ---')
-    for table, cols in schema.items():
-        print(f'Table: {table}')
-        for col, dtype in cols:
-            print(f'  {col}: {dtype}')
-        print() 
\ No newline at end of file
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import sys
+import json
+import argparse
+import datetime
+import hashlib
+import time
+import queue
+import multiprocessing
+import concurrent.futures
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+from rca.baseline.rca_agent.log_sink import get_log
+
+# Rows per pandas chunk when streaming a CSV into SQLite
+CHUNK_ROWS = 100000
+# Seconds the parallel writer waits on the chunk queue before checking that the parse workers are alive
+QUEUE_POLL_SECS = 5.0
+
+# Connection settings for bulk loading: no fsync, in-memory rollback journal and temp b-trees,
+# and a 512 MiB page cache. Restored to SQLite's defaults once the load is done.
+BULK_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -524288,
+    'temp_store': 'MEMORY',
+}
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'cache_size': -2000,
+    'temp_store': 'DEFAULT',
+}
+
+def infer_sqlite_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    elif pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    elif pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    else:
+        return 'TEXT'
+
+def get_logger(log_path):
+    # JSONL records through the shared buffered log sink, so the import loops never wait on the log file
+    return get_log(log_path, source='import')
+
+def create_indexes(cursor, table_name, columns, log):
+    # Common index columns
+    index_cols = ['timestamp', 'component_id', 'trace_id', 'span_id']
+    if table_name.startswith('log_'):
+        # Log searches are narrowed by component as well as by time
+        index_cols.append('cmdb_id')
+    for col in index_cols:
+        if col in columns:
+            idx_name = f'idx_{table_name}_{col}'
+            try:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {idx_name} ON "{table_name}" ("{col}")')
+                log(f"Created index {idx_name} on {table_name}({col})")
+            except Exception as e:
+                log(f"ERROR creating index {idx_name} on {table_name}: {e}")
+
+def infer_table_columns(df):
+    columns = []
+    for col in df.columns:
+        # A column that is entirely empty in the sampled chunk carries no type information
+        if df[col].isna().all():
+            columns.append((col, 'TEXT'))
+        else:
+            columns.append((col, infer_sqlite_type(df[col].dtype)))
+    return columns
+
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+
+def insert_chunk(conn, table_name, df, source=None):
+    # With a single writer, new rows get consecutive rowids after the current maximum,
+    # so each chunk is recorded as one rowid range of its source file.
+    first_rowid = (conn.execute(f'SELECT MAX(rowid) FROM "{table_name}"').fetchone()[0] or 0) + 1
+    columns = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' for _ in df.columns)
+    # tolist() yields native Python values (NaN binds as NULL), which sqlite3 accepts directly
+    rows = zip(*[df[col].tolist() for col in df.columns])
+    conn.executemany(f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders})', rows)
+    if source is not None:
+        conn.execute('INSERT INTO _import_chunks (path, table_name, first_rowid, last_rowid) VALUES (?, ?, ?, ?)',
+                     (source, table_name, first_rowid, first_rowid + len(df) - 1))
+
+def create_table_for_chunk(cursor, table_name, chunk):
+    columns = ', '.join(f'"{col}" {coltype}' for col, coltype in infer_table_columns(chunk))
+    cursor.execute(f'DROP TABLE IF EXISTS "{table_name}";')
+    cursor.execute(f'CREATE TABLE "{table_name}" ({columns});')
+    return [(col, str(dtype)) for col, dtype in chunk.dtypes.items()]
+
+def import_csv_to_table(cursor, conn, csv_path, table_name, log, create=True, chunk_rows=CHUNK_ROWS, source=None, build_indexes=True, derived=None):
+    # Stream the CSV in bounded chunks so peak memory does not depend on the file size.
+    # Column types are inferred from the first chunk; later chunks are appended as-is.
+    try:
+        schema = None
+        rows = 0
+        collector = derived.start_file(table_name, source) if derived else None
+        for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+            if schema is None:
+                if create:
+                    schema = create_table_for_chunk(cursor, table_name, chunk)
+                else:
+                    schema = [(col, str(dtype)) for col, dtype in chunk.dtypes.items()]
+            insert_chunk(conn, table_name, chunk, source)
+            if collector is not None:
+                collector.add(chunk)
+            rows += len(chunk)
+        if schema is None:
+            log(f"WARNING: {csv_path} is empty, skipped")
+            return []
+        if derived:
+            derived.finish_file(cursor, table_name, source, collector)
+        action = 'Imported table' if create else 'Appended to table'
+        log(f"{action}: {table_name} from {csv_path} ({rows} rows, chunk_rows={chunk_rows})")
+        if create and build_indexes:
+            create_indexes(cursor, table_name, [col for col, _ in schema], log)
+        return schema
+    except Exception as e:
+        log(f"ERROR importing {csv_path} to {table_name}: {e}")
+        raise
+
+def table_exists(cursor, table_name):
+    return cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,)).fetchone() is not None
+
+# --- Import manifest: which rows of which table came from which CSV file ---
+
+def ensure_manifest(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS _import_manifest (
+        path TEXT PRIMARY KEY, table_name TEXT, size INTEGER, mtime REAL, hash TEXT, rows INTEGER, imported_at TEXT)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS _import_chunks (
+        path TEXT, table_name TEXT, first_rowid INTEGER, last_rowid INTEGER)''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx__import_chunks_path ON _import_chunks (path)')
+
+def bump_data_version(cursor, name):
+    # Records a rebuild of a derived table that leaves the manifest untouched, so the executor's result
+    # cache (sql_cache.db_fingerprint) stops serving results computed on the old rows
+    cursor.execute('CREATE TABLE IF NOT EXISTS _data_version (name TEXT PRIMARY KEY, version INTEGER, updated_at TEXT)')
+    cursor.execute('''INSERT INTO _data_version (name, version, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at''',
+                   (name, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def scan_changes(cursor, dataset_dir, plan, log, force_kinds=()):
+    # Returns (changed, removed): plan entries whose CSV is new or modified, and manifest paths
+    # whose CSV disappeared. Size and mtime are checked first; the file is only hashed when they differ.
+    # Files of a telemetry kind in force_kinds are reloaded even when unchanged.
+    manifest = {row[0]: row[1:] for row in cursor.execute('SELECT path, size, mtime, hash FROM _import_manifest')}
+    changed = []
+    seen = set()
+    for table_name, csv_path in plan:
+        source = os.path.relpath(csv_path, dataset_dir)
+        seen.add(source)
+        stat = os.stat(csv_path)
+        entry = manifest.get(source)
+        if entry is not None and source_parts(source)[1] in force_kinds:
+            log(f"Reloading file for new derived tables: {source}")
+            changed.append((table_name, csv_path, source, stat.st_size, stat.st_mtime, entry[2]))
+            continue
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            continue
+        digest = file_hash(csv_path)
+        if entry is not None and entry[2] == digest:
+            cursor.execute('UPDATE _import_manifest SET size = ?, mtime = ? WHERE path = ?', (stat.st_size, stat.st_mtime, source))
+            continue
+        log(f"{'Modified' if entry is not None else 'New'} file: {source}")
+        changed.append((table_name, csv_path, source, stat.st_size, stat.st_mtime, digest))
+    removed = [path for path in manifest if path not in seen]
+    for source in removed:
+        log(f"Removed file: {source}")
+    return changed, removed
+
+def delete_source_rows(cursor, source, derived=None):
+    ranges = cursor.execute('SELECT table_name, first_rowid, last_rowid FROM _import_chunks WHERE path = ?', (source,)).fetchall()
+    if derived:
+        for table_name in {table_name for table_name, _, _ in ranges}:
+            derived.drop_file(cursor, table_name, source)
+    for table_name, first_rowid, last_rowid in ranges:
+        if table_exists(cursor, table_name):
+            cursor.execute(f'DELETE FROM "{table_name}" WHERE rowid BETWEEN ? AND ?', (first_rowid, last_rowid))
+    cursor.execute('DELETE FROM _import_chunks WHERE path = ?', (source,))
+    cursor.execute('DELETE FROM _import_manifest WHERE path = ?', (source,))
+    return {table_name for table_name, _, _ in ranges}
+
+def record_manifest(cursor, source, table_name, size, mtime, digest):
+    rows = cursor.execute('SELECT COALESCE(SUM(last_rowid - first_rowid + 1), 0) FROM _import_chunks WHERE path = ?', (source,)).fetchone()[0]
+    imported_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute('INSERT OR REPLACE INTO _import_manifest (path, table_name, size, mtime, hash, rows, imported_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (source, table_name, size, mtime, digest, rows, imported_at))
+
+def read_schema_from_db(cursor, table_name):
+    return [(col[1], col[2]) for col in cursor.execute(f'PRAGMA table_info("{table_name}")').fetchall()]
+
+def collect_import_plan(dataset_dir, kinds=('metric', 'trace', 'log')):
+    # Ordered list of (table_name, csv_path): record/query first, then every telemetry file by date
+    plan = [
+        ('record', os.path.join(dataset_dir, 'record.csv')),
+        ('query', os.path.join(dataset_dir, 'query.csv')),
+    ]
+    telemetry_dir = os.path.join(dataset_dir, 'telemetry')
+    for date_dir in sorted(os.listdir(telemetry_dir)):
+        date_path = os.path.join(telemetry_dir, date_dir)
+        if not os.path.isdir(date_path):
+            continue
+        for kind in kinds:
+            kind_dir = os.path.join(date_path, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for csv_file in sorted(os.listdir(kind_dir)):
+                if not csv_file.endswith('.csv'):
+                    continue
+                plan.append((csv_file.replace('.csv', ''), os.path.join(kind_dir, csv_file)))
+    return plan
+
+# --- Derived tables computed while telemetry is imported ---
+
+# Percentiles materialized per component-KPI series in kpi_thresholds
+THRESHOLD_PERCENTILES = (5, 15, 50, 90, 95, 99)
+TIMESTAMP_COLUMNS = ('timestamp', 'startTime')
+COMPONENT_COLUMNS = ('cmdb_id', 'service', 'serviceName', 'tc')
+KPI_NAME_COLUMNS = ('kpi_name', 'name')
+# Numeric columns of wide metric files that are identifiers rather than KPIs
+NON_KPI_COLUMNS = ('itemid',)
+# (direction, percentile) thresholds scanned for anomaly_segments: 'high' breaches are values above
+# the series' global percentile, 'low' breaches values below it
+ANOMALY_THRESHOLDS = (('high', 95), ('low', 5))
+# Runs of consecutive breaching points shorter than this are treated as isolated noise spikes
+ANOMALY_MIN_POINTS = 2
+# Column names of the trace files across datasets (Bank/Market use snake_case, Telecom camelCase)
+TRACE_ID_COLUMNS = ('trace_id', 'traceId')
+SPAN_ID_COLUMNS = ('span_id', 'id')
+PARENT_SPAN_COLUMNS = ('parent_span', 'parent_id', 'pid')
+DURATION_COLUMNS = ('duration', 'elapsedTime')
+# Guard against malformed traces whose parent links never reach a leaf
+MAX_TRACE_DEPTH = 64
+# Text columns of the log files indexed for full-text search, in the order they appear in <log table>_fts
+LOG_TEXT_COLUMNS = ('value', 'log_name')
+# (suffix, seconds) of the optional <metric table>_rollup_<suffix> tables, finest first. Each level is
+# grouped from the previous one, so every resolution must divide the next.
+ROLLUP_RESOLUTIONS = (('1m', 60), ('5m', 300), ('1h', 3600))
+# Aggregates kept per bucket for every KPI column, as <column>_<aggregate>
+ROLLUP_AGGREGATES = ('min', 'max', 'avg', 'sum', 'count')
+# Larger timestamps are in milliseconds (1e11 seconds is in the year 5138)
+MS_TIMESTAMP_THRESHOLD = 1e11
+
+def source_parts(source):
+    # 'telemetry/<date>/<kind>/<file>.csv' -> (date, kind); (None, None) for record/query
+    parts = source.replace('\\', '/').split('/')
+    if len(parts) == 4 and parts[0] == 'telemetry':
+        return parts[1], parts[2]
+    return None, None
+
+def columns_layout(columns, numeric):
+    # Long files keep one KPI per row (timestamp, cmdb_id, kpi_name|name, value);
+    # wide files (metric_app / metric_service) keep one KPI per numeric column.
+    ts_col = next((col for col in TIMESTAMP_COLUMNS if col in columns), None)
+    component_col = next((col for col in COMPONENT_COLUMNS if col in columns), None)
+    kpi_col = next((col for col in KPI_NAME_COLUMNS if col in columns), None)
+    if ts_col is None or component_col is None:
+        return None
+    if kpi_col is not None and 'value' in columns:
+        return {'timestamp': ts_col, 'component': component_col, 'kpi': kpi_col, 'values': ['value']}
+    skip = {ts_col, component_col, *NON_KPI_COLUMNS}
+    values = [col for col in columns if col not in skip and col in numeric]
+    return {'timestamp': ts_col, 'component': component_col, 'kpi': None, 'values': values} if values else None
+
+def metric_layout(df):
+    numeric = {col for col in df.columns if pd.api.types.is_numeric_dtype(df[col].dtype)
+               and not pd.api.types.is_bool_dtype(df[col].dtype)}
+    return columns_layout(list(df.columns), numeric)
+
+def fts5_available():
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE _probe USING fts5(text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def trace_layout(columns):
+    layout = {}
+    for key, candidates in (('trace', TRACE_ID_COLUMNS), ('span', SPAN_ID_COLUMNS), ('parent', PARENT_SPAN_COLUMNS),
+                            ('service', ('cmdb_id',)), ('duration', DURATION_COLUMNS), ('timestamp', TIMESTAMP_COLUMNS)):
+        layout[key] = next((col for col in candidates if col in columns), None)
+    if layout['trace'] is None or layout['span'] is None or layout['parent'] is None or layout['service'] is None:
+        return None
+    return layout
+
+class MetricSeriesCollector:
+    # Accumulates the component-KPI series of one metric file as compact NumPy arrays
+    # (int32 series code, int64 timestamp, float64 value) instead of keeping the parsed DataFrames alive.
+
+    def __init__(self):
+        self.layout = None
+        self.keys = {}
+        self.codes = []
+        self.timestamps = []
+        self.values = []
+
+    def _encode(self, components, kpis):
+        labels = components.astype(str) + '\x1f' + kpis.astype(str)
+        local_codes, uniques = pd.factorize(labels)
+        mapping = np.array([self.keys.setdefault(key, len(self.keys)) for key in uniques], dtype=np.int32)
+        return mapping[local_codes]
+
+    def add(self, chunk):
+        if self.layout is None:
+            self.layout = metric_layout(chunk)
+            if self.layout is None:
+                return
+        layout = self.layout
+        components = chunk[layout['component']]
+        timestamps = pd.to_numeric(chunk[layout['timestamp']], errors='coerce').to_numpy(dtype=np.float64)
+        for value_col in layout['values']:
+            kpis = chunk[layout['kpi']] if layout['kpi'] else pd.Series(value_col, index=chunk.index)
+            values = pd.to_numeric(chunk[value_col], errors='coerce').to_numpy(dtype=np.float64)
+            keep = ~np.isnan(values) & ~np.isnan(timestamps)
+            self.codes.append(self._encode(components[keep], kpis[keep]))
+            self.timestamps.append(timestamps[keep].astype(np.int64))
+            self.values.append(values[keep])
+
+    def series_keys(self):
+        # Code -> (component, kpi)
+        keys = [None] * len(self.keys)
+        for key, code in self.keys.items():
+            keys[code] = tuple(key.split('\x1f', 1))
+        return keys
+
+    def sorted_series(self, by='value'):
+        # Rows sorted by series and then by value (by='value') or time (by='timestamp'),
+        # plus the start offset and length of every series
+        if not self.codes:
+            return None
+        codes = np.concatenate(self.codes)
+        timestamps = np.concatenate(self.timestamps)
+        values = np.concatenate(self.values)
+        order = np.lexsort((values if by == 'value' else timestamps, codes))
+        codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        counts = np.diff(np.r_[starts, len(codes)])
+        return codes, timestamps[order], values[order], starts, counts
+
+def percentile_key(q):
+    # Stats key / kpi_thresholds column of a percentile: 95 and 95.0 (as parsed from --anomaly_thresholds) are both 'p95'
+    return f'p{q:g}'
+
+def series_percentile(values, starts, counts, q):
+    # Vectorized per-series percentile over value-sorted series, with linear interpolation
+    # (same as np.percentile's default)
+    pos = starts + (counts - 1) * (q / 100.0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, starts + counts - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def compute_kpi_thresholds(collector, percentiles=THRESHOLD_PERCENTILES):
+    series = collector.sorted_series(by='value')
+    if series is None:
+        return None
+    codes, _, values, starts, counts = series
+    series_codes = codes[starts]
+    stats = {'code': series_codes}
+    for q in percentiles:
+        stats[percentile_key(q)] = series_percentile(values, starts, counts, q)
+    stats['min'] = values[starts]
+    stats['max'] = values[starts + counts - 1]
+    stats['mean'] = np.add.reduceat(values, starts) / counts
+    stats['count'] = counts
+    keys = collector.series_keys()
+    stats['component'] = [keys[code][0] for code in series_codes]
+    stats['kpi'] = [keys[code][1] for code in series_codes]
+    return stats
+
+def detect_anomaly_segments(collector, stats, thresholds=ANOMALY_THRESHOLDS, min_points=ANOMALY_MIN_POINTS):
+    # Runs of consecutive points of a component-KPI series (ordered by time) that breach the series'
+    # global percentile threshold; runs shorter than min_points are dropped as isolated spikes.
+    series = collector.sorted_series(by='timestamp')
+    if series is None:
+        return []
+    codes, timestamps, values, _, _ = series
+    keys = collector.series_keys()
+    new_series = np.r_[True, codes[1:] != codes[:-1]]
+    segments = []
+    for direction, q in thresholds:
+        threshold_by_code = np.full(len(keys), np.nan)
+        threshold_by_code[stats['code']] = stats[percentile_key(q)]
+        threshold = threshold_by_code[codes]
+        breach = values > threshold if direction == 'high' else values < threshold
+        if not breach.any():
+            continue
+        # A run starts at a breaching point whose predecessor does not breach or belongs to another series
+        run_start = breach & (new_series | ~np.r_[False, breach[:-1]])
+        idx = np.flatnonzero(breach)
+        run_id = np.cumsum(run_start)[idx] - 1
+        firsts = np.flatnonzero(np.r_[True, run_id[1:] != run_id[:-1]])
+        points = np.diff(np.r_[firsts, len(idx)])
+        run_values = values[idx]
+        peaks = (np.maximum if direction == 'high' else np.minimum).reduceat(run_values, firsts)
+        start_ts = timestamps[idx][firsts]
+        end_ts = timestamps[idx][np.r_[firsts[1:], len(idx)] - 1]
+        run_codes = codes[idx][firsts]
+        run_threshold = threshold[idx][firsts]
+        keep = points >= min_points
+        for code, thr, start, end, n, peak in zip(run_codes[keep].tolist(), run_threshold[keep].tolist(), start_ts[keep].tolist(),
+                                                  end_ts[keep].tolist(), points[keep].tolist(), peaks[keep].tolist()):
+            ratio = abs(peak - thr) / abs(thr) if thr else None
+            segments.append((keys[code][0], keys[code][1], direction, q, thr, start, end, n, peak, ratio))
+    return segments
+
+class DerivedTables:
+    # Hooks called by the importer around every CSV file it loads or drops
+
+    def __init__(self, dataset_name, log, kpi_stats=True, anomaly_segments=True,
+                 anomaly_thresholds=ANOMALY_THRESHOLDS, anomaly_min_points=ANOMALY_MIN_POINTS, trace_graph=True, log_search=True, rollups=False):
+        self.dataset_name = dataset_name
+        self.log = log
+        self.kpi_stats = kpi_stats
+        self.anomaly_segments = anomaly_segments
+        self.trace_graph = trace_graph
+        self.log_search = log_search and fts5_available()
+        if log_search and not self.log_search:
+            log("WARNING: this SQLite build has no FTS5, log tables are imported without full-text indexes")
+        self.anomaly_thresholds = tuple(anomaly_thresholds)
+        self.anomaly_min_points = anomaly_min_points
+        self.rollups = rollups
+
+    def ensure_tables(self, cursor):
+        # Returns the telemetry kinds whose already-imported files must be reloaded
+        # because a derived table built from them did not exist yet
+        stale = set()
+        if self.kpi_stats:
+            if not table_exists(cursor, 'kpi_thresholds'):
+                stale.add('metric')
+            percentile_cols = ', '.join(f'{percentile_key(q)} REAL' for q in THRESHOLD_PERCENTILES)
+            cursor.execute(f'''CREATE TABLE IF NOT EXISTS kpi_thresholds (
+                dataset TEXT, date TEXT, metric_table TEXT, component TEXT, kpi TEXT,
+                {percentile_cols}, min REAL, max REAL, mean REAL, count INTEGER)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_kpi_thresholds_component_kpi ON kpi_thresholds (component, kpi, date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_kpi_thresholds_table_date ON kpi_thresholds (metric_table, date)')
+        if self.anomaly_segments:
+            if not table_exists(cursor, 'anomaly_segments'):
+                stale.add('metric')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS anomaly_segments (
+                dataset TEXT, date TEXT, metric_table TEXT, component TEXT, kpi TEXT, direction TEXT, percentile REAL,
+                threshold REAL, start_ts INTEGER, end_ts INTEGER, points INTEGER, peak REAL, breach_ratio REAL)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_anomaly_segments_time ON anomaly_segments (start_ts, end_ts)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_anomaly_segments_component_kpi ON anomaly_segments (component, kpi)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_anomaly_segments_table_date ON anomaly_segments (metric_table, date)')
+        if self.trace_graph:
+            if not table_exists(cursor, 'span_edges') or not table_exists(cursor, 'trace_service_depth'):
+                stale.add('trace')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS span_edges (
+                dataset TEXT, date TEXT, trace_table TEXT, trace_id TEXT, parent_span TEXT, child_span TEXT,
+                caller TEXT, callee TEXT, duration REAL, timestamp INTEGER)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_span_edges_trace_id ON span_edges (trace_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_span_edges_callee ON span_edges (callee, timestamp)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_span_edges_caller ON span_edges (caller, timestamp)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_span_edges_table_date ON span_edges (trace_table, date)')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS trace_service_depth (
+                dataset TEXT, date TEXT, trace_table TEXT, trace_id TEXT, service TEXT,
+                min_depth INTEGER, max_depth INTEGER, spans INTEGER, first_ts INTEGER)''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_trace_service_depth_trace_id ON trace_service_depth (trace_id, max_depth)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_trace_service_depth_service ON trace_service_depth (service, first_ts)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_trace_service_depth_table_date ON trace_service_depth (trace_table, date)')
+        if self.log_search:
+            log_tables = cursor.execute("SELECT DISTINCT table_name FROM _import_chunks WHERE table_name LIKE 'log%'").fetchall()
+            if any(not table_exists(cursor, f'{table_name}_fts') for (table_name,) in log_tables):
+                stale.add('log')
+        if self.rollups and not table_exists(cursor, 'rollup_tables'):
+            stale.add('metric')
+        if table_exists(cursor, 'rollup_tables'):
+            # Once a database has rollups they are kept in step with every later metric import
+            self.rollups = True
+        if self.rollups:
+            cursor.execute('''CREATE TABLE IF NOT EXISTS rollup_tables (
+                table_name TEXT PRIMARY KEY, metric_table TEXT, resolution TEXT, seconds INTEGER, bucket INTEGER,
+                timestamp_column TEXT, component_column TEXT, kpi_column TEXT, value_columns TEXT)''')
+        return stale
+
+    def tables(self, cursor):
+        enabled = (('kpi_thresholds', self.kpi_stats), ('anomaly_segments', self.anomaly_segments),
+                   ('span_edges', self.trace_graph), ('trace_service_depth', self.trace_graph))
+        names = [name for name, on in enabled if on]
+        if self.rollups:
+            names += ['rollup_tables'] + [row[0] for row in cursor.execute('SELECT table_name FROM rollup_tables ORDER BY metric_table, seconds')]
+        if self.log_search:
+            names += [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'log%\\_fts' ESCAPE '\\'")]
+        return names
+
+    def fts_columns(self, cursor, table_name):
+        columns = [col for col, _ in read_schema_from_db(cursor, table_name)]
+        return [col for col in LOG_TEXT_COLUMNS if col in columns]
+
+    def write_log_index(self, cursor, table_name, source, date):
+        # External-content FTS5 index over the log text; rows stay in the log table, where the
+        # timestamp and cmdb_id columns keep their B-tree indexes
+        fts_cols = self.fts_columns(cursor, table_name)
+        if not fts_cols:
+            self.log(f"WARNING: {table_name} has no text columns to index, full-text index skipped")
+            return
+        fts_table = f'{table_name}_fts'
+        col_list = ', '.join(f'"{col}"' for col in fts_cols)
+        cursor.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS "{fts_table}" USING fts5({col_list}, content="{table_name}", content_rowid="rowid")''')
+        rows = 0
+        ranges = cursor.execute('SELECT first_rowid, last_rowid FROM _import_chunks WHERE path = ?', (source,)).fetchall()
+        for first_rowid, last_rowid in ranges:
+            rows += cursor.execute(f'''INSERT INTO "{fts_table}" (rowid, {col_list})
+                SELECT rowid, {col_list} FROM "{table_name}" WHERE rowid BETWEEN ? AND ?''', (first_rowid, last_rowid)).rowcount
+        self.log(f"Indexed {rows} log lines of {table_name} on {date} into {fts_table}")
+
+    def drop_log_index(self, cursor, table_name, source):
+        # External-content FTS5 tables need the old values to remove rows, so this runs before the
+        # log rows themselves are deleted
+        fts_table = f'{table_name}_fts'
+        if not table_exists(cursor, fts_table) or not table_exists(cursor, table_name):
+            return
+        col_list = ', '.join(f'"{col}"' for col in self.fts_columns(cursor, table_name))
+        ranges = cursor.execute('SELECT first_rowid, last_rowid FROM _import_chunks WHERE path = ?', (source,)).fetchall()
+        for first_rowid, last_rowid in ranges:
+            cursor.execute(f'''INSERT INTO "{fts_table}" ("{fts_table}", rowid, {col_list})
+                SELECT 'delete', rowid, {col_list} FROM "{table_name}" WHERE rowid BETWEEN ? AND ?''', (first_rowid, last_rowid))
+
+    def start_file(self, table_name, source):
+        date, kind = source_parts(source or '')
+        if (self.kpi_stats or self.anomaly_segments) and kind == 'metric':
+            return MetricSeriesCollector()
+        return None
+
+    def finish_file(self, cursor, table_name, source, collector):
+        date, kind = source_parts(source or '')
+        if self.trace_graph and kind == 'trace':
+            self.write_trace_graph(cursor, table_name, source, date)
+        if self.log_search and kind == 'log':
+            self.write_log_index(cursor, table_name, source, date)
+        if self.rollups and kind == 'metric':
+            self.write_rollups(cursor, table_name, source, date)
+        if collector is None:
+            return
+        percentiles = sorted(set(THRESHOLD_PERCENTILES) | {q for _, q in self.anomaly_thresholds})
+        stats = compute_kpi_thresholds(collector, percentiles)
+        if stats is None:
+            return
+        if self.kpi_stats:
+            cols = ['component', 'kpi'] + [percentile_key(q) for q in THRESHOLD_PERCENTILES] + ['min', 'max', 'mean', 'count']
+            columns = [stats[col].tolist() if isinstance(stats[col], np.ndarray) else stats[col] for col in cols]
+            rows = [(self.dataset_name, date, table_name, *row) for row in zip(*columns)]
+            placeholders = ', '.join('?' for _ in range(len(cols) + 3))
+            cursor.executemany(f'INSERT INTO kpi_thresholds (dataset, date, metric_table, {", ".join(cols)}) VALUES ({placeholders})', rows)
+            self.log(f"Computed kpi_thresholds for {table_name} on {date} ({len(rows)} component-KPI series)")
+        if self.anomaly_segments:
+            self.write_anomaly_segments(cursor, table_name, date, collector, stats)
+
+    def write_anomaly_segments(self, cursor, table_name, date, collector, stats):
+        segments = detect_anomaly_segments(collector, stats, self.anomaly_thresholds, self.anomaly_min_points)
+        cursor.executemany('''INSERT INTO anomaly_segments (dataset, date, metric_table, component, kpi, direction, percentile,
+            threshold, start_ts, end_ts, points, peak, breach_ratio) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           [(self.dataset_name, date, table_name, *segment) for segment in segments])
+        self.log(f"Detected {len(segments)} anomaly segments for {table_name} on {date}")
+
+    def ensure_rollup_tables(self, cursor, table_name, layout, scale):
+        keys = [layout['component']] + ([layout['kpi']] if layout['kpi'] else [])
+        agg_cols = ', '.join(f'"{col}_{agg}" {"INTEGER" if agg == "count" else "REAL"}'
+                             for col in layout['values'] for agg in ROLLUP_AGGREGATES)
+        key_cols = ', '.join(f'"{col}" TEXT' for col in keys)
+        key_list = ', '.join(f'"{col}"' for col in keys)
+        for suffix, seconds in ROLLUP_RESOLUTIONS:
+            rollup = f'{table_name}_rollup_{suffix}'
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS "{rollup}" (date TEXT, {key_cols}, "{layout["timestamp"]}" INTEGER, {agg_cols})')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS "idx_{rollup}_series" ON "{rollup}" ({key_list}, "{layout["timestamp"]}")')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS "idx_{rollup}_timestamp" ON "{rollup}" ("{layout["timestamp"]}")')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS "idx_{rollup}_date" ON "{rollup}" (date)')
+            cursor.execute('''INSERT OR REPLACE INTO rollup_tables (table_name, metric_table, resolution, seconds, bucket,
+                timestamp_column, component_column, kpi_column, value_columns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (rollup, table_name, suffix, seconds, seconds * scale, layout['timestamp'], layout['component'],
+                            layout['kpi'], ','.join(layout['values'])))
+
+    def write_rollups(self, cursor, table_name, source, date):
+        # Partial aggregates of every rowid range of the file go to a temp table; the finest rollup is
+        # grouped from them and every coarser rollup from the level before it
+        schema = read_schema_from_db(cursor, table_name)
+        layout = columns_layout([col for col, _ in schema], {col for col, coltype in schema if coltype in ('INTEGER', 'REAL')})
+        ranges = cursor.execute('SELECT first_rowid, last_rowid FROM _import_chunks WHERE path = ?', (source,)).fetchall()
+        if layout is None or not ranges:
+            self.log(f"WARNING: {table_name} has no timestamp/component/KPI columns, rollups skipped")
+            return
+        ts = layout['timestamp']
+        max_ts = cursor.execute(f'SELECT MAX("{ts}") FROM "{table_name}" WHERE rowid BETWEEN ? AND ?', ranges[0]).fetchone()[0]
+        scale = 1000 if max_ts is not None and float(max_ts) > MS_TIMESTAMP_THRESHOLD else 1
+        self.ensure_rollup_tables(cursor, table_name, layout, scale)
+        keys = ', '.join(f'"{col}"' for col in [layout['component']] + ([layout['kpi']] if layout['kpi'] else []))
+        values = layout['values']
+        partial_cols = ', '.join(f'"{col}_{agg}"' for col in values for agg in ('min', 'max', 'sum', 'count'))
+        bucket = ROLLUP_RESOLUTIONS[0][1] * scale
+        raw_aggs = ', '.join(f'MIN("{col}"), MAX("{col}"), SUM("{col}"), COUNT("{col}")' for col in values)
+        cursor.execute('DROP TABLE IF EXISTS temp._rollup_partial')
+        cursor.execute(f'CREATE TEMP TABLE _rollup_partial AS SELECT {keys}, "{ts}", {partial_cols} FROM "{table_name}_rollup_{ROLLUP_RESOLUTIONS[0][0]}" WHERE 0')
+        for first_rowid, last_rowid in ranges:
+            cursor.execute(f'''INSERT INTO temp._rollup_partial
+                SELECT {keys}, (CAST("{ts}" AS INTEGER) / {bucket}) * {bucket}, {raw_aggs}
+                FROM "{table_name}" WHERE rowid BETWEEN ? AND ? AND "{ts}" IS NOT NULL
+                GROUP BY {keys}, (CAST("{ts}" AS INTEGER) / {bucket}) * {bucket}''', (first_rowid, last_rowid))
+        level_aggs = ', '.join(f'MIN("{col}_min"), MAX("{col}_max"), SUM("{col}_sum") * 1.0 / SUM("{col}_count"), '
+                               f'SUM("{col}_sum"), SUM("{col}_count")' for col in values)
+        agg_cols = ', '.join(f'"{col}_{agg}"' for col in values for agg in ROLLUP_AGGREGATES)
+        source_table, where, params = 'temp._rollup_partial', '', (date,)
+        counts = []
+        for suffix, seconds in ROLLUP_RESOLUTIONS:
+            rollup = f'{table_name}_rollup_{suffix}'
+            bucket = seconds * scale
+            rows = cursor.execute(f'''INSERT INTO "{rollup}" (date, {keys}, "{ts}", {agg_cols})
+                SELECT ?, {keys}, ("{ts}" / {bucket}) * {bucket}, {level_aggs}
+                FROM {source_table} {where} GROUP BY {keys}, ("{ts}" / {bucket}) * {bucket}''', params).rowcount
+            counts.append(f'{suffix}: {rows}')
+            source_table, where, params = f'"{rollup}"', 'WHERE date = ?', (date, date)
+        cursor.execute('DROP TABLE temp._rollup_partial')
+        self.log(f"Built rollups for {table_name} on {date} ({', '.join(counts)} rows)")
+
+    def drop_table(self, cursor, table_name):
+        # Derived tables that belong to a single raw table are dropped along with it; returns their names
+        names = [f'{table_name}_fts']
+        if table_exists(cursor, 'rollup_tables'):
+            names += [row[0] for row in cursor.execute('SELECT table_name FROM rollup_tables WHERE metric_table = ?', (table_name,)).fetchall()]
+            cursor.execute('DELETE FROM rollup_tables WHERE metric_table = ?', (table_name,))
+        for name in names:
+            cursor.execute(f'DROP TABLE IF EXISTS "{name}"')
+        return names
+
+    def write_trace_graph(self, cursor, table_name, source, date):
+        # Joins the spans of one trace file to their parents through a temp table indexed on
+        # (trace, span) and (trace, parent), then walks each trace from its root spans.
+        layout = trace_layout([col for col, _ in read_schema_from_db(cursor, table_name)])
+        if layout is None:
+            self.log(f"WARNING: {table_name} has no trace/span/parent columns, span_edges skipped")
+            return
+        duration = f'"{layout["duration"]}"' if layout['duration'] else 'NULL'
+        timestamp = f'"{layout["timestamp"]}"' if layout['timestamp'] else 'NULL'
+        cursor.execute('DROP TABLE IF EXISTS temp._trace_spans')
+        cursor.execute('CREATE TEMP TABLE _trace_spans (trace TEXT, span TEXT, parent TEXT, service TEXT, duration REAL, ts INTEGER)')
+        ranges = cursor.execute('SELECT first_rowid, last_rowid FROM _import_chunks WHERE path = ?', (source,)).fetchall()
+        for first_rowid, last_rowid in ranges:
+            cursor.execute(f'''INSERT INTO temp._trace_spans
+                SELECT "{layout['trace']}", "{layout['span']}", "{layout['parent']}", "{layout['service']}", {duration}, {timestamp}
+                FROM "{table_name}" WHERE rowid BETWEEN ? AND ?''', (first_rowid, last_rowid))
+        cursor.execute('CREATE INDEX temp.idx__trace_spans_span ON _trace_spans (trace, span)')
+        cursor.execute('CREATE INDEX temp.idx__trace_spans_parent ON _trace_spans (trace, parent)')
+        params = (self.dataset_name, date, table_name)
+        edges = cursor.execute('''INSERT INTO span_edges
+            SELECT ?, ?, ?, c.trace, p.span, c.span, p.service, c.service, c.duration, c.ts
+            FROM temp._trace_spans c JOIN temp._trace_spans p ON p.trace = c.trace AND p.span = c.parent''', params).rowcount
+        services = cursor.execute(f'''INSERT INTO trace_service_depth
+            WITH RECURSIVE walk(trace, span, service, depth, ts) AS (
+                SELECT c.trace, c.span, c.service, 0, c.ts FROM temp._trace_spans c
+                WHERE NOT EXISTS (SELECT 1 FROM temp._trace_spans p WHERE p.trace = c.trace AND p.span = c.parent)
+                UNION ALL
+                SELECT c.trace, c.span, c.service, w.depth + 1, c.ts
+                FROM walk w JOIN temp._trace_spans c ON c.trace = w.trace AND c.parent = w.span
+                WHERE w.depth < {MAX_TRACE_DEPTH})
+            SELECT ?, ?, ?, trace, service, MIN(depth), MAX(depth), COUNT(*), MIN(ts)
+            FROM walk GROUP BY trace, service''', params).rowcount
+        cursor.execute('DROP TABLE temp._trace_spans')
+        self.log(f"Built span_edges for {table_name} on {date} ({edges} edges, {services} trace-service rows)")
+
+    def drop_file(self, cursor, table_name, source):
+        date, kind = source_parts(source)
+        if kind == 'metric':
+            derived_tables = ('kpi_thresholds', 'anomaly_segments')
+            key = 'metric_table'
+        elif kind == 'trace':
+            derived_tables = ('span_edges', 'trace_service_depth')
+            key = 'trace_table'
+        elif kind == 'log':
+            self.drop_log_index(cursor, table_name, source)
+            return
+        else:
+            return
+        for derived_table in derived_tables:
+            if table_exists(cursor, derived_table):
+                cursor.execute(f'DELETE FROM {derived_table} WHERE {key} = ? AND date = ?', (table_name, date))
+        if kind == 'metric' and table_exists(cursor, 'rollup_tables'):
+            for (rollup,) in cursor.execute('SELECT table_name FROM rollup_tables WHERE metric_table = ?', (table_name,)).fetchall():
+                cursor.execute(f'DELETE FROM "{rollup}" WHERE date = ?', (date,))
+
+# --- Parallel import: a process pool parses CSVs, the calling process is the only SQLite writer ---
+
+_chunk_queue = None
+
+def _init_parse_worker(chunk_queue):
+    global _chunk_queue
+    _chunk_queue = chunk_queue
+
+def _parse_csv_worker(job_id, csv_path, chunk_rows):
+    # Runs in a pool process: parse the CSV chunk by chunk and hand each DataFrame to the writer.
+    # The queue is bounded, so a slow writer throttles the parsers instead of buffering whole files.
+    rows = 0
+    parse_secs = 0.0
+    try:
+        reader = pd.read_csv(csv_path, chunksize=chunk_rows)
+        while True:
+            t0 = time.perf_counter()
+            chunk = next(reader, None)
+            parse_secs += time.perf_counter() - t0
+            if chunk is None:
+                break
+            rows += len(chunk)
+            _chunk_queue.put((job_id, chunk, None))
+        _chunk_queue.put((job_id, None, {'rows': rows, 'parse_secs': parse_secs}))
+    except Exception as e:
+        _chunk_queue.put((job_id, None, {'rows': rows, 'parse_secs': parse_secs, 'error': str(e)}))
+
+def group_by_table(entries):
+    # Stable reorder so all files of one table are loaded back to back
+    order = {}
+    for entry in entries:
+        order.setdefault(entry[0], len(order))
+    return sorted(entries, key=lambda entry: order[entry[0]])
+
+def check_parse_workers(futures, pending, silent):
+    # Called whenever the chunk queue stays empty for a poll interval. A pool process that died (OOM kill,
+    # crash in the parser) or a job that returned without its final message would otherwise leave the
+    # writer waiting forever. silent holds jobs already seen finished, whose final message gets one more
+    # poll interval to arrive.
+    for future, job_id in futures.items():
+        if job_id not in pending or not future.done():
+            continue
+        error = future.exception()
+        if error is not None:
+            raise RuntimeError(f"Parse worker for job {job_id} failed: {error!r}") from error
+        if job_id in silent:
+            raise RuntimeError(f"Parse worker for job {job_id} finished without reporting its result")
+        silent.add(job_id)
+
+def abort_parse_pool(pool, futures, chunk_queue):
+    # Cancel the jobs not started yet and keep draining the bounded queue, so workers blocked in put()
+    # can finish their file and exit instead of making the pool's shutdown wait on them forever
+    pool.shutdown(wait=False, cancel_futures=True)
+    while not all(future.done() for future in futures):
+        try:
+            chunk_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    pool.shutdown(wait=True)
+
+def parallel_import(conn, plan, log, workers, chunk_rows=CHUNK_ROWS, queue_size=None, bulk=False, derived=None):
+    cursor = conn.cursor()
+    jobs_left = {}
+    for entry in plan:
+        jobs_left[entry[0]] = jobs_left.get(entry[0], 0) + 1
+    # Spawned, not forked: the log sink's writer thread is already running, and a fork could hand the
+    # workers its stdio and queue locks in a held state
+    ctx = multiprocessing.get_context('spawn')
+    # Spawned workers unpickle _parse_csv_worker by importing this module by name, with the parent's
+    # sys.path. The agent runner loads it from its file path, so its directory has to be on that path.
+    importer_dir = os.path.dirname(os.path.abspath(__file__))
+    if __name__ != '__main__' and importer_dir not in sys.path:
+        sys.path.append(importer_dir)
+    chunk_queue = ctx.Queue(maxsize=queue_size or workers * 2)
+    schema_summary = {}
+    created = set()
+    table_rows = {}
+    collectors = {}
+    pending = set(range(len(plan)))
+    parse_rows = 0
+    parse_secs = 0.0
+    write_secs = 0.0
+    errors = []
+    t_start = time.perf_counter()
+    if bulk:
+        cursor.execute('BEGIN')
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                                  initializer=_init_parse_worker, initargs=(chunk_queue,))
+    futures = {}
+    silent = set()
+    try:
+        for job_id, (table_name, csv_path, *_) in enumerate(plan):
+            futures[pool.submit(_parse_csv_worker, job_id, csv_path, chunk_rows)] = job_id
+        while pending:
+            try:
+                job_id, chunk, stats = chunk_queue.get(timeout=QUEUE_POLL_SECS)
+            except queue.Empty:
+                check_parse_workers(futures, pending, silent)
+                continue
+            table_name, csv_path, source, size, mtime, digest = plan[job_id]
+            if chunk is None:
+                pending.discard(job_id)
+                parse_rows += stats['rows']
+                parse_secs += stats['parse_secs']
+                if 'error' in stats:
+                    errors.append(f"{csv_path}: {stats['error']}")
+                    log(f"ERROR importing {csv_path} to {table_name}: {stats['error']}")
+                else:
+                    if derived and job_id in collectors:
+                        derived.finish_file(cursor, table_name, source, collectors.pop(job_id))
+                    record_manifest(cursor, source, table_name, size, mtime, digest)
+                    log(f"Parsed {csv_path} -> {table_name} ({stats['rows']} rows in {stats['parse_secs']:.2f}s)")
+                jobs_left[table_name] -= 1
+                if bulk and jobs_left[table_name] == 0:
+                    # Jobs are submitted grouped by table, so this closes roughly one transaction per table
+                    cursor.execute('COMMIT')
+                    cursor.execute('BEGIN')
+                continue
+            t0 = time.perf_counter()
+            if table_name not in created and not table_exists(cursor, table_name):
+                schema_summary[table_name] = create_table_for_chunk(cursor, table_name, chunk)
+                created.add(table_name)
+            insert_chunk(conn, table_name, chunk, source)
+            if derived:
+                if job_id not in collectors:
+                    collectors[job_id] = derived.start_file(table_name, source)
+                if collectors[job_id] is not None:
+                    collectors[job_id].add(chunk)
+            write_secs += time.perf_counter() - t0
+            table_rows[table_name] = table_rows.get(table_name, 0) + len(chunk)
+    except BaseException:
+        abort_parse_pool(pool, futures, chunk_queue)
+        raise
+    pool.shutdown(wait=True)
+    if bulk:
+        cursor.execute('COMMIT')
+    t_index = time.perf_counter()
+    for table_name in created:
+        create_indexes(cursor, table_name, [col for col, _ in schema_summary[table_name]], log)
+    conn.commit()
+    index_secs = time.perf_counter() - t_index
+    wall_secs = time.perf_counter() - t_start
+    write_rows = sum(table_rows.values())
+    for table_name, rows in table_rows.items():
+        log(f"Imported table: {table_name} ({rows} rows)")
+    log(f"Parse stage: {parse_rows} rows, {parse_secs:.2f}s across {workers} workers "
+        f"({parse_rows / max(parse_secs, 1e-9):.0f} rows/s per worker)")
+    log(f"Write stage: {write_rows} rows in {write_secs:.2f}s ({write_rows / max(write_secs, 1e-9):.0f} rows/s)")
+    log(f"Index build: {index_secs:.2f}s")
+    log(f"Pipeline (bulk={bulk}): {write_rows} rows in {wall_secs:.2f}s wall ({write_rows / max(wall_secs, 1e-9):.0f} rows/s)")
+    if errors:
+        raise RuntimeError(f"Parallel import failed for {len(errors)} file(s): {'; '.join(errors)}")
+    return schema_summary
+
+def sequential_import(conn, plan, log, chunk_rows=CHUNK_ROWS, bulk=False, derived=None):
+    cursor = conn.cursor()
+    schema_summary = {}
+    created = []
+    t_start = time.perf_counter()
+    if not bulk:
+        for table_name, csv_path, source, size, mtime, digest in plan:
+            create = not table_exists(cursor, table_name)
+            schema = import_csv_to_table(cursor, conn, csv_path, table_name, log, create=create, chunk_rows=chunk_rows,
+                                         source=source, derived=derived)
+            if create:
+                schema_summary[table_name] = schema
+            record_manifest(cursor, source, table_name, size, mtime, digest)
+            conn.commit()
+        log(f"Load (bulk=False): {len(plan)} file(s) in {time.perf_counter() - t_start:.2f}s")
+        return schema_summary
+
+    # Bulk mode: one explicit transaction per table and indexes built once after every table is loaded
+    for table_name in dict.fromkeys(entry[0] for entry in plan):
+        t_table = time.perf_counter()
+        entries = [entry for entry in plan if entry[0] == table_name]
+        cursor.execute('BEGIN')
+        for _, csv_path, source, size, mtime, digest in entries:
+            create = not table_exists(cursor, table_name)
+            schema = import_csv_to_table(cursor, conn, csv_path, table_name, log, create=create, chunk_rows=chunk_rows,
+                                         source=source, build_indexes=False, derived=derived)
+            if create:
+                schema_summary[table_name] = schema
+                created.append(table_name)
+            record_manifest(cursor, source, table_name, size, mtime, digest)
+        cursor.execute('COMMIT')
+        log(f"Loaded table {table_name}: {len(entries)} file(s) in {time.perf_counter() - t_table:.2f}s")
+    t_load = time.perf_counter() - t_start
+    t_index = time.perf_counter()
+    for table_name in created:
+        create_indexes(cursor, table_name, [col for col, _ in schema_summary[table_name]], log)
+    conn.commit()
+    log(f"Load (bulk=True): {len(plan)} file(s) in {t_load:.2f}s, index build {time.perf_counter() - t_index:.2f}s")
+    return schema_summary
+
+def rebuild_anomaly_segments(dataset_name, thresholds=ANOMALY_THRESHOLDS, min_points=ANOMALY_MIN_POINTS, chunk_rows=CHUNK_ROWS):
+    # On-demand rescan of the already-imported metric tables, e.g. with different percentile thresholds
+    dataset_dir = os.path.join(os.path.dirname(__file__), dataset_name)
+    db_path = os.path.join(dataset_dir, 'data.db')
+    log = get_logger(os.path.join(dataset_dir, 'import.jsonl'))
+    log(f"--- Rebuilding anomaly_segments for dataset: {dataset_name} (thresholds={thresholds}, min_points={min_points}) ---")
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    derived = DerivedTables(dataset_name, log, kpi_stats=False, anomaly_thresholds=thresholds, anomaly_min_points=min_points,
+                            trace_graph=False)
+    derived.ensure_tables(cursor)
+    cursor.execute('DELETE FROM anomaly_segments')
+    sources = cursor.execute('SELECT path, table_name FROM _import_manifest ORDER BY path').fetchall()
+    for source, table_name in sources:
+        date, kind = source_parts(source)
+        if kind != 'metric':
+            continue
+        collector = MetricSeriesCollector()
+        ranges = cursor.execute('SELECT first_rowid, last_rowid FROM _import_chunks WHERE path = ? ORDER BY first_rowid', (source,)).fetchall()
+        for first_rowid, last_rowid in ranges:
+            query = f'SELECT * FROM "{table_name}" WHERE rowid BETWEEN ? AND ?'
+            for chunk in pd.read_sql_query(query, conn, params=(first_rowid, last_rowid), chunksize=chunk_rows):
+                collector.add(chunk)
+        percentiles = sorted({q for _, q in thresholds})
+        stats = compute_kpi_thresholds(collector, percentiles)
+        if stats is not None:
+            derived.write_anomaly_segments(cursor, table_name, date, collector, stats)
+    bump_data_version(cursor, 'anomaly_segments')
+    conn.commit()
+    conn.close()
+    log(f"--- Rebuild complete for dataset: {dataset_name} ---")
+
+def parse_anomaly_thresholds(text):
+    # 'high:95,low:5' -> (('high', 95.0), ('low', 5.0))
+    thresholds = []
+    for item in text.split(','):
+        direction, q = item.split(':')
+        if direction not in ('high', 'low'):
+            raise ValueError(f"Unknown anomaly direction: {direction}")
+        thresholds.append((direction, float(q)))
+    return tuple(thresholds)
+
+def import_to_sql_and_get_schema(dataset_name, chunk_rows=CHUNK_ROWS, workers=1, bulk=False, kpi_stats=True,
+                                 anomaly_segments=True, anomaly_thresholds=ANOMALY_THRESHOLDS, anomaly_min_points=ANOMALY_MIN_POINTS,
+                                 trace_graph=True, logs=True, rollups=False):
+    dataset_dir = os.path.join(os.path.dirname(__file__), dataset_name)
+    db_path = os.path.join(dataset_dir, 'data.db')
+    schema_json = os.path.join(dataset_dir, 'schema.json')
+    log_path = os.path.join(dataset_dir, 'import.jsonl')
+    log = get_logger(log_path)
+
+    log(f"--- Starting import for dataset: {dataset_name} ---")
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    if not table_exists(cursor, '_import_manifest') and table_exists(cursor, 'record'):
+        # Database predates the manifest, so its rows cannot be attributed to files: rebuild once
+        log(f"No import manifest in {db_path}, rebuilding it from scratch")
+        conn.close()
+        os.remove(db_path)
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+    ensure_manifest(cursor)
+    derived = DerivedTables(dataset_name, log, kpi_stats=kpi_stats, anomaly_segments=anomaly_segments,
+                            anomaly_thresholds=anomaly_thresholds, anomaly_min_points=anomaly_min_points,
+                            trace_graph=trace_graph, log_search=logs, rollups=rollups)
+    stale_kinds = derived.ensure_tables(cursor)
+
+    plan = collect_import_plan(dataset_dir, kinds=('metric', 'trace', 'log') if logs else ('metric', 'trace'))
+    changed, removed = scan_changes(cursor, dataset_dir, plan, log, force_kinds=stale_kinds)
+    conn.commit()
+    if not changed and not removed and os.path.exists(schema_json):
+        conn.close()
+        log(f"Loaded schema from cache: {schema_json}")
+        with open(schema_json, 'r') as f:
+            schema_summary = json.load(f)
+        log(f"--- Import complete (from cache) for dataset: {dataset_name} ---")
+        return schema_summary
+
+    schema_summary = {}
+    if os.path.exists(schema_json):
+        with open(schema_json, 'r') as f:
+            schema_summary = json.load(f)
+
+    # Drop the rows of every file that is re-imported or gone, then tables left without any source
+    touched = set()
+    for source in removed + [entry[2] for entry in changed]:
+        touched |= delete_source_rows(cursor, source, derived)
+    for table_name in touched:
+        if not cursor.execute('SELECT 1 FROM _import_chunks WHERE table_name = ? LIMIT 1', (table_name,)).fetchone():
+            for name in derived.drop_table(cursor, table_name):
+                schema_summary.pop(name, None)
+            cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            schema_summary.pop(table_name, None)
+            log(f"Dropped table {table_name}: no source files left")
+    conn.commit()
+    log(f"Incremental import: {len(changed)} new/modified file(s), {len(removed)} removed file(s)")
+
+    if bulk:
+        # Explicit BEGIN/COMMIT instead of the sqlite3 module's implicit transactions
+        conn.isolation_level = None
+        apply_pragmas(conn, BULK_PRAGMAS)
+        changed = group_by_table(changed)
+    try:
+        if workers > 1:
+            schema_summary.update(parallel_import(conn, changed, log, workers, chunk_rows=chunk_rows, bulk=bulk, derived=derived))
+        else:
+            schema_summary.update(sequential_import(conn, changed, log, chunk_rows=chunk_rows, bulk=bulk, derived=derived))
+    finally:
+        if bulk:
+            if conn.in_transaction:
+                conn.rollback()
+            apply_pragmas(conn, DEFAULT_PRAGMAS)
+            conn.isolation_level = ''
+    for (table_name,) in cursor.execute('SELECT DISTINCT table_name FROM _import_chunks').fetchall():
+        if table_name not in schema_summary:
+            schema_summary[table_name] = read_schema_from_db(cursor, table_name)
+    # Precomputed tables are advertised alongside the raw telemetry tables
+    for table_name in derived.tables(cursor):
+        schema_summary[table_name] = read_schema_from_db(cursor, table_name)
+    conn.commit()
+    conn.close()
+
+    # Save schema cache
+    with open(schema_json, 'w') as f:
+        json.dump(schema_summary, f, indent=2)
+    log(f"Schema cached to {schema_json}")
+
+    # Schema validation
+    expected_tables = {'record', 'query'}
+    metric_tables = [t for t in schema_summary if t.startswith('metric_')]
+    trace_tables = [t for t in schema_summary if t.startswith('trace')]
+    missing = []
+    for t in expected_tables:
+        if t not in schema_summary:
+            missing.append(t)
+    if not metric_tables:
+        missing.append('at least one metric_* table')
+    if not trace_tables:
+        missing.append('at least one trace* table')
+    if missing:
+        log(f"WARNING: Missing tables: {', '.join(missing)}")
+    log(f"--- Import complete for dataset: {dataset_name} ---")
+    return schema_summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import a dataset's CSV telemetry into SQLite")
+    parser.add_argument("dataset", help="dataset name, e.g. Bank or Market/cloudbed-1")
+    parser.add_argument("--workers", type=int, default=1, help="CSV parser processes (1 = sequential import)")
+    parser.add_argument("--chunk_rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--bulk", action="store_true", help="bulk-load mode: import PRAGMAs, one transaction per table, deferred indexes")
+    parser.add_argument("--no_kpi_stats", action="store_true", help="skip building the kpi_thresholds table")
+    parser.add_argument("--no_anomaly_segments", action="store_true", help="skip building the anomaly_segments table")
+    parser.add_argument("--anomaly_thresholds", type=parse_anomaly_thresholds, default=ANOMALY_THRESHOLDS,
+                        help="comma-separated direction:percentile pairs, e.g. high:95,low:5")
+    parser.add_argument("--anomaly_min_points", type=int, default=ANOMALY_MIN_POINTS)
+    parser.add_argument("--no_trace_graph", action="store_true", help="skip building span_edges and trace_service_depth")
+    parser.add_argument("--no_logs", action="store_true", help="do not import log files (and their full-text indexes)")
+    parser.add_argument("--rollups", action="store_true",
+                        help="also build 1m/5m/1h rollup tables of every metric table (kept up to date once built)")
+    parser.add_argument("--rebuild_anomalies", action="store_true",
+                        help="only rescan the imported metric tables and rebuild anomaly_segments")
+    args = parser.parse_args()
+    dataset_name = args.dataset
+    if args.rebuild_anomalies:
+        rebuild_anomaly_segments(dataset_name, args.anomaly_thresholds, args.anomaly_min_points, chunk_rows=args.chunk_rows)
+        sys.exit(0)
+    schema = import_to_sql_and_get_schema(dataset_name, chunk_rows=args.chunk_rows, workers=args.workers, bulk=args.bulk,
+                                          kpi_stats=not args.no_kpi_stats, anomaly_segments=not args.no_anomaly_segments,
+                                          anomaly_thresholds=args.anomaly_thresholds, anomaly_min_points=args.anomaly_min_points,
+                                          trace_graph=not args.no_trace_graph, logs=not args.no_logs, rollups=args.rollups)
+    print(f'\n--- Schema Summary for {dataset_name} ---')
+    for table, cols in schema.items():
+        print(f'Table: {table}')
+        for col, dtype in cols:
+            print(f'  {col}: {dtype}')
+        print()
@@ -0,0 +1,169 @@
+import re
+import json
+
+# Tolerant, incremental parser for the JSON objects LLMs write. It walks the text once from the first
+# '{' and emits valid JSON, repairing what models commonly get wrong: code fences and prose around the
+# object, raw newlines and stray quotes inside strings, single-quoted strings, Python literals
+# (True/False/None), bare words, missing or trailing commas, and a cut-off tail (open strings and
+# brackets are closed). It also tells where the object ended, if it did, so a partial response can be
+# parsed as it arrives. A reasoning model's <think> block is skipped.
+
+_NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+_LITERALS = {'true': 'true', 'false': 'false', 'null': 'null', 'True': 'true', 'False': 'false', 'None': 'null'}
+# A quote closes a string only when what follows it is structure: a colon, a closing bracket, the end,
+# a comma followed by the next key (quoted or not) or value, or the next quoted key without its comma
+_CLOSES_STRING = re.compile(r'''\s*(?:[:}\]]|$|,\s*(?:["'{\[\]}\d-]|true|false|null|\w+\s*:|$))|\s+(["'])[\w -]+\1\s*:''')
+# A response that is nothing but one fenced code block; the closing fence may be missing, as in a
+# streamed response cut right after its object
+_FENCED = re.compile(r'\s*```(?:json)?[ \t]*\n?(.*?)(?:\n?```)?\s*', re.DOTALL | re.IGNORECASE)
+_BARE = re.compile(r'[^,:{}\[\]\n"]+')
+_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t', '\b': '\\b', '\f': '\\f'}
+
+def _string(text, i):
+    # The string starting at text[i] as a JSON literal, and the index after it
+    quote = text[i]
+    out = ['"']
+    j = i + 1
+    n = len(text)
+    while j < n:
+        ch = text[j]
+        if ch == '\\':
+            nxt = text[j + 1] if j + 1 < n else ''
+            if nxt == 'u' and re.match(r'[0-9a-fA-F]{4}', text[j + 2:j + 6]):
+                out.append(text[j:j + 6])
+                j += 6
+            elif nxt and nxt in '"\\/bfnrt':
+                out.append(ch + nxt)
+                j += 2
+            elif nxt == "'":
+                out.append("'")
+                j += 2
+            else:
+                # Invalid escape (e.g. a regex or a Windows path): keep the backslash literally
+                out.append('\\\\')
+                j += 1
+            continue
+        if ch == quote:
+            if _CLOSES_STRING.match(text, j + 1):
+                out.append('"')
+                return ''.join(out), j + 1
+            out.append('\\"' if quote == '"' else "'")
+        elif ch == '"':
+            out.append('\\"')
+        elif ch in _ESCAPES:
+            out.append(_ESCAPES[ch])
+        elif ch < ' ':
+            out.append(f'\\u{ord(ch):04x}')
+        else:
+            out.append(ch)
+        j += 1
+    out.append('"')
+    return ''.join(out), n
+
+def scan(text):
+    # (repaired JSON text, index after the object's closing bracket or None when it is cut off);
+    # ValueError without any '{'
+    start = 0
+    if '<think>' in text:
+        start = text.find('</think>')
+        if start < 0:
+            raise ValueError('the response ends inside its <think> block')
+    start = text.find('{', start)
+    if start < 0:
+        raise ValueError('no JSON object in the response')
+    out = []
+    stack = []
+    # What the current container expects next: 'key', 'colon', 'value' or 'comma' (after a value)
+    expect = 'value'
+    i = start
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch.isspace():
+            i += 1
+            continue
+        if ch in '}]':
+            if stack:
+                _finish_member(out, expect)
+                out.append('}' if stack.pop() == '{' else ']')
+                expect = 'comma'
+                if not stack:
+                    return ''.join(out), i + 1
+            i += 1
+            continue
+        if ch == ',':
+            if expect == 'comma':
+                out.append(',')
+                expect = 'key' if stack[-1] == '{' else 'value'
+            i += 1
+            continue
+        if ch == ':':
+            if expect == 'colon':
+                out.append(':')
+                expect = 'value'
+            i += 1
+            continue
+        if ch == '/' and text.startswith('//', i):
+            end = text.find('\n', i)
+            i = n if end < 0 else end
+            continue
+        if expect == 'comma':
+            # Two values in a row: the comma between them is missing
+            out.append(',')
+            expect = 'key' if stack[-1] == '{' else 'value'
+        elif expect == 'colon':
+            out.append(':')
+            expect = 'value'
+        if ch in '{[':
+            if expect == 'key':
+                i += 1
+                continue
+            out.append(ch)
+            stack.append(ch)
+            expect = 'key' if ch == '{' else 'value'
+            i += 1
+            continue
+        if ch in '"\'':
+            literal, i = _string(text, i)
+            out.append(literal)
+            expect = 'colon' if expect == 'key' else 'comma'
+            continue
+        number = _NUMBER.match(text, i)
+        if number and expect == 'value':
+            out.append(number.group())
+            i = number.end()
+            expect = 'comma'
+            continue
+        word = _BARE.match(text, i).group().rstrip()
+        if expect == 'value' and word in _LITERALS:
+            out.append(_LITERALS[word])
+        else:
+            # An unquoted key or string value
+            out.append(json.dumps(word, ensure_ascii=False))
+        i += len(word) or 1
+        expect = 'colon' if expect == 'key' else 'comma'
+    # Cut off: close the open member and brackets
+    _finish_member(out, expect)
+    while stack:
+        out.append('}' if stack.pop() == '{' else ']')
+    return ''.join(out), None
+
+def _finish_member(out, expect):
+    if expect == 'colon':
+        out.append(':null')
+    elif expect == 'value' and out and out[-1] == ':':
+        out.append('null')
+    elif out and out[-1] == ',':
+        out.pop()
+
+def strip_fence(text):
+    # The content of a response wrapped in a single ```json fence (closed or not), else the response as it is
+    fenced = _FENCED.fullmatch(text)
+    return fenced.group(1) if fenced else text
+
+def repair(text):
+    return scan(text)[0]
+
+def loads(text):
+    # The first JSON object in text, repaired as needed; ValueError when there is none
+    return json.loads(repair(text))
@@ -0,0 +1,218 @@
+import re
+import time
+import threading
+import rca.api_router as api_router
+from rca.api_router import configs
+from rca.baseline.rca_agent.json_repair import scan
+from rca.baseline.rca_agent.sql_result import estimate_tokens
+from rca.baseline.rca_agent.prompt_meter import get_meter
+
+# Streaming completions with early cut-off. Reasoning models often keep writing after the part the
+# agent reads (the controller's JSON object, the executor's ```sql blocks); a streamed completion is
+# parsed as it arrives and the generation is cancelled, by closing the stream, as soon as that part is
+# complete. The router's own get_chat_completion_stream is used when it has one, otherwise the Ollama
+# or OpenAI client for configs['SOURCE']; any other backend gets the blocking call, cut the same way.
+# Tokens generated, kept and saved are reported per call. A stream may end with a dict of the backend's
+# own counts (Ollama's done chunk): its eval_count is the real number of tokens generated and its
+# prompt_eval_count goes to the prompt meter. Tokens saved by a cancellation are measured against the
+# mean length of sampled responses that were let run to their end.
+
+# Cancel generations once the response is complete; off, streams run to their end and the tail past the
+# cut is measured
+EARLY_CUTOFF = True
+# Every BASELINE_EVERY-th call of a call site (starting with the first) runs to its end even with
+# EARLY_CUTOFF, so the full response length that cancelled calls are compared to keeps being measured
+BASELINE_EVERY = 20
+# Characters the model may write after its last closed ```sql block before the response counts as
+# complete: it may still open another block of the batch
+SQL_TAIL_CHARS = 200
+_SQL_FENCE = re.compile(r"```sql\n.*?\n```", re.DOTALL)
+
+def json_end(text):
+    # End of the first complete JSON object in text, or None
+    if '}' not in text:
+        return None
+    try:
+        return scan(text)[1]
+    except ValueError:
+        return None
+
+def sql_end(max_blocks):
+    def end(text):
+        # After max_blocks closed ```sql blocks, or after the last one once SQL_TAIL_CHARS of text follow it
+        # without a new block being opened
+        if '<think>' in text and '</think>' not in text:
+            return None
+        fences = list(_SQL_FENCE.finditer(text, text.find('</think>') + 1))
+        if not fences:
+            return None
+        if len(fences) >= max_blocks:
+            return fences[max_blocks - 1].end()
+        tail = text[fences[-1].end():]
+        if '```' not in tail and len(tail) >= SQL_TAIL_CHARS:
+            return fences[-1].end()
+        return None
+    return end
+
+def _ollama_stream(messages, temperature=0.0, format=None):
+    import ollama
+    client = ollama.Client(host=configs.get('API_BASE') or None)
+    options = {'temperature': temperature}
+    # Leaving the generator closes the HTTP response, which makes Ollama stop generating
+    for part in client.chat(model=configs['MODEL'], messages=messages, stream=True, options=options, format=format or ''):
+        yield part['message']['content']
+        if part.get('done'):
+            # Only a stream that runs to its end reports the backend's token counts
+            yield {'prompt_eval_count': part.get('prompt_eval_count'), 'eval_count': part.get('eval_count')}
+
+def _openai_stream(messages, temperature=0.0, format=None):
+    from openai import OpenAI
+    client = OpenAI(api_key=configs['API_KEY'], base_url=configs.get('API_BASE') or None)
+    extra = {'response_format': {'type': 'json_object'}} if format else {}
+    stream = client.chat.completions.create(model=configs['MODEL'], messages=messages, temperature=temperature,
+                                            stream=True, **extra)
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+
+_SOURCES = {'ollama': _ollama_stream, 'openai': _openai_stream}
+
+def get_stream():
+    # Chunk generator for the configured backend, or None when it cannot stream
+    stream = getattr(api_router, 'get_chat_completion_stream', None)
+    if stream is not None:
+        return stream
+    return _SOURCES.get(str(configs.get('SOURCE', '')).lower())
+
+class StreamStats:
+    def __init__(self, log=None):
+        self.log = log
+        self.lock = threading.Lock()
+        # Per label: calls seen, and the tokens of sampled responses generated to their end (tokens, count),
+        # the baseline of the saved-token measure; both survive reset()
+        self.calls = {}
+        self.baseline = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.by_label = {}
+
+    def sample(self, label):
+        # Whether this call of label runs to its end as a baseline sample
+        with self.lock:
+            seen = self.calls.get(label, 0)
+            self.calls[label] = seen + 1
+        return seen % BASELINE_EVERY == 0
+
+    def baseline_tokens(self, label):
+        tokens, count = self.baseline.get(label, (0, 0))
+        return tokens / count if count else None
+
+    def record(self, label, generated, kept, cancelled, tail, duration, sampled=False, counted=False):
+        # generated: tokens the backend produced (its own eval_count when counted, else estimated from the
+        # text); kept: tokens up to the cut; tail: tokens generated past the cut by a response that ran to
+        # its end; sampled: a baseline sample, which also ran to its end
+        with self.lock:
+            if sampled and not cancelled:
+                tokens, count = self.baseline.get(label, (0, 0))
+                self.baseline[label] = (tokens + generated, count + 1)
+            saved = 0
+            if cancelled:
+                baseline = self.baseline_tokens(label)
+                saved = max(round(baseline - generated), 0) if baseline is not None else None
+            stats = self.by_label.setdefault(label, {'calls': 0, 'cut': 0, 'sampled': 0, 'generated_tokens': 0, 'kept_tokens': 0,
+                                                     'saved_tokens': 0, 'wasted_tokens': 0})
+            stats['calls'] += 1
+            stats['cut'] += cancelled
+            stats['sampled'] += sampled
+            stats['generated_tokens'] += generated
+            stats['kept_tokens'] += kept
+            stats['saved_tokens'] += saved or 0
+            stats['wasted_tokens'] += tail or 0
+        if self.log:
+            state = 'cancelled early' if cancelled else 'ran to its end' + (' (baseline sample)' if sampled else '')
+            self.log(f"{label} completion {state}: {'' if counted else '~'}{generated} tokens generated, {kept} kept, "
+                     f"~{saved if saved is not None else '?'} saved, {tail or 0} wasted in {duration:.2f}s",
+                     event='stream', label=label, cancelled=cancelled, sampled=sampled, counted=counted, generated_tokens=generated,
+                     kept_tokens=kept, saved_tokens=saved, wasted_tokens=tail, duration=duration)
+
+    def stats(self):
+        with self.lock:
+            return {label: dict(stats) for label, stats in self.by_label.items()}
+
+_stats = StreamStats()
+
+def get_stream_stats():
+    return _stats
+
+def _rest(chunks):
+    # After a cut: reads one more chunk to tell a stream that had nothing left but its final counts from one
+    # that was still generating. Returns (ended, the backend counts if they came, the content chunk read)
+    usage = None
+    for chunk in chunks:
+        if isinstance(chunk, dict):
+            usage = chunk
+        elif chunk:
+            return False, usage, chunk
+    return True, usage, None
+
+def stream_completion(messages, end, label, fallback, **kwargs):
+    # The response up to end(text), generating no further than that when the backend streams
+    start = time.perf_counter()
+    stream = get_stream()
+    cut = None
+    usage = None
+    sampled = False
+    if stream is None:
+        text = fallback(messages=messages, **kwargs)
+        cut = end(text)
+        complete = True
+    else:
+        sampled = not EARLY_CUTOFF or _stats.sample(label)
+        parts = []
+        chunks = stream(messages, **kwargs)
+        complete = False
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, dict):
+                    usage = chunk
+                    continue
+                parts.append(chunk)
+                # Only text that can close the object or a fence is worth checking
+                if cut is None and ('}' in chunk or '`' in chunk or '\n' in chunk):
+                    cut = end(''.join(parts))
+                    if cut is not None and not sampled:
+                        # A cut on the last chunk cancels nothing
+                        complete, usage, extra = _rest(chunks)
+                        if extra:
+                            parts.append(extra)
+                        break
+            else:
+                complete = True
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+        text = ''.join(parts)
+        if cut is None:
+            cut = end(text)
+    kept = text if cut is None else text[:cut]
+    counted = complete and bool(usage) and usage.get('eval_count') is not None
+    generated = usage['eval_count'] if counted else estimate_tokens(text)
+    kept_tokens = min(estimate_tokens(kept), generated)
+    tail = generated - kept_tokens if complete and cut is not None else None
+    _stats.record(label, generated, kept_tokens, not complete, tail, time.perf_counter() - start, sampled=sampled, counted=counted)
+    if usage and usage.get('prompt_eval_count') is not None:
+        get_meter().record_backend(label, usage['prompt_eval_count'])
+    return kept
+
+def streaming(completion, end, label):
+    # Wraps a get_chat_completion-style function into a streamed call cut off at end(text); completion
+    # serves backends that cannot stream
+    def call(messages, **kwargs):
+        return stream_completion(messages, end, label, completion, **kwargs)
+    return call
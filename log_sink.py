@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import datetime
+import threading
+
+# Shared buffered log sink for the executor and the importer. Callers only enqueue a record; one
+# background thread appends the records to their JSONL files (one open handle per file) and echoes a
+# readable line to stdout, so the hot path never waits on file or terminal I/O. Records still queued
+# are written at interpreter exit, including after an uncaught exception.
+
+# Seconds the writer waits for more records before flushing what it has
+FLUSH_INTERVAL = 0.5
+# Records written per batch at most
+BATCH_RECORDS = 1000
+# Echo "[time] message" lines to stdout as the old per-line loggers did
+ECHO = True
+
+_STOP = object()
+
+class LogSink:
+    def __init__(self, echo=ECHO):
+        self.echo = echo
+        self.queue = queue.SimpleQueue()
+        self.files = {}
+        self.context = {}
+        self.written = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+        self.thread.start()
+
+    def set_context(self, **fields):
+        # Fields added to every later record (e.g. task, step); None removes one
+        context = dict(self.context)
+        for name, value in fields.items():
+            if value is None:
+                context.pop(name, None)
+            else:
+                context[name] = value
+        self.context = context
+
+    def emit(self, path, msg, **fields):
+        record = {'ts': datetime.datetime.now().isoformat(timespec='milliseconds'), **self.context, **fields, 'msg': msg}
+        self.queue.put((path, record))
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self.queue.put((None, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        if self.thread.is_alive():
+            self.queue.put((None, _STOP))
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Gather what arrives within FLUSH_INTERVAL of the first record, so writes are batched
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            try:
+                while len(batch) < BATCH_RECORDS and batch[-1][0] is not None:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                pass
+            stop = self._write(batch)
+            if stop:
+                break
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def _write(self, batch):
+        stop = False
+        waiting = []
+        lines = {}
+        echo = []
+        for path, record in batch:
+            if path is None:
+                if record is _STOP:
+                    stop = True
+                else:
+                    waiting.append(record)
+                continue
+            lines.setdefault(path, []).append(json.dumps(record, default=str, ensure_ascii=False))
+            if self.echo:
+                echo.append(f"[{record['ts'][:19].replace('T', ' ')}] {record['msg']}")
+        for path, records in lines.items():
+            try:
+                f = self.files.get(path)
+                if f is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                    f = self.files[path] = open(path, 'a', encoding='utf-8')
+                f.write('\n'.join(records) + '\n')
+                f.flush()
+                self.written += len(records)
+            except OSError as e:
+                self.errors += len(records)
+                print(f"log sink: cannot write {path}: {e}", file=sys.stderr)
+        if echo:
+            print('\n'.join(echo), flush=True)
+        for done in waiting:
+            done.set()
+        return stop
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def get_sink():
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = LogSink()
+            atexit.register(_sink.close)
+        return _sink
+
+def set_context(**fields):
+    get_sink().set_context(**fields)
+
+def get_log(path, **fields):
+    # Returns log(msg, **record_fields) appending JSONL records to path
+    sink = get_sink()
+    def log(msg, **record_fields):
+        sink.emit(path, msg, **{**fields, **record_fields})
+    return log
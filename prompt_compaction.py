@@ -0,0 +1,104 @@
+import re
+import json
+from rca.baseline.rca_agent.sql_result import estimate_tokens
+
+# Token-budgeted compaction of the controller's prompt. The full transcript is kept (and returned by
+# control_loop) as it is; what is sent to the model is the system prompt, the opening message, a digest
+# of the older steps, and the later steps verbatim. Steps are digested in chunks once the prompt crosses
+# the budget, each chunk becoming one more digest message; a digest message is never edited once sent,
+# so between folds each prompt extends the previous one and the backend can reuse all of it, and a fold
+# only changes the bytes after the digest already sent. When a fold is not enough, the oldest digest
+# messages are dropped for a single note, down to the same low water, so a long run does not grow the
+# prompt without bound; that is the one rewrite of earlier bytes, and it leaves room for a while.
+
+HISTORY_TOKEN_BUDGET = 24000
+# Steps always sent verbatim
+KEEP_STEPS = 4
+# Once over budget, steps are digested until the prompt is back under this share of the budget
+LOW_WATER = 0.6
+# Characters kept of an instruction and of an observation in its digest line
+DIGEST_CHARS = 300
+
+digest_intro = """Steps {first}-{last} are summarized below to save context (instruction -> Executor observation, truncated); the later steps follow verbatim.
+
+{lines}"""
+
+dropped_note = """Steps 1-{last} were left out to stay within the context budget."""
+
+def _clip(text, limit=DIGEST_CHARS):
+    text = re.sub(r'\s+', ' ', str(text)).strip()
+    return text if len(text) <= limit else text[:limit] + ' ...'
+
+def digest_step(number, response, observation):
+    # One line per controller step; responses that were not valid JSON were re-asked and leave no line
+    # (and take no step number)
+    try:
+        instruction = json.loads(response)['instruction']
+    except (ValueError, TypeError, KeyError):
+        return None
+    return f"- Step {number}: {_clip(instruction)} -> {_clip(observation)}"
+
+class PromptCompactor:
+    def __init__(self, budget=HISTORY_TOKEN_BUDGET, keep_steps=KEEP_STEPS, head=2):
+        self.budget = budget
+        self.keep_steps = keep_steps
+        self.head = head
+        # Messages after the head already folded into the digest, the steps among them, the digest
+        # messages (one per fold) with the steps each covers, and the oldest steps whose digest messages
+        # were dropped again to keep the prompt within the budget
+        self.compacted = 0
+        self.steps = 0
+        self.blocks = []
+        self.block_steps = []
+        self.dropped = 0
+        self.token_cache = {}
+        self.last_tokens = (0, 0)
+
+    def tokens(self, message):
+        content = message['content']
+        tokens = self.token_cache.get(content)
+        if tokens is None:
+            tokens = self.token_cache[content] = estimate_tokens(content) + 4
+        return tokens
+
+    def messages(self, prompt, tail=()):
+        # The messages to send for prompt + tail; compacts further when they exceed the budget
+        steps = prompt[self.head:]
+        fixed = sum(self.tokens(m) for m in prompt[:self.head]) + sum(self.tokens(m) for m in tail)
+        total = fixed + sum(self.tokens(m) for m in steps[self.compacted:]) + self.digest_tokens()
+        if total > self.budget:
+            # Pairs of (controller response, observation), oldest first, never the last keep_steps, are
+            # folded into one new digest message
+            first, lines = self.steps + 1, []
+            while len(steps) - self.compacted > 2 * self.keep_steps and total > self.budget * LOW_WATER:
+                response, observation = steps[self.compacted:self.compacted + 2]
+                total -= self.tokens(response) + self.tokens(observation)
+                line = digest_step(self.steps + 1, response['content'], observation['content'])
+                if line:
+                    self.steps += 1
+                    lines.append(line)
+                self.compacted += 2
+            if lines:
+                block = {'role': 'user', 'content': digest_intro.format(first=first, last=self.steps, lines='\n'.join(lines))}
+                self.blocks.append(block)
+                self.block_steps.append(len(lines))
+                total += self.tokens(block)
+            # Still over budget: the oldest digest messages go, down to the same low water so that the
+            # digest left is again sent unchanged for a while
+            if total > self.budget:
+                while self.blocks and total > self.budget * LOW_WATER:
+                    total -= self.digest_tokens()
+                    self.blocks.pop(0)
+                    self.dropped += self.block_steps.pop(0)
+                    total += self.digest_tokens()
+        messages = list(prompt[:self.head]) + self.digest() + steps[self.compacted:] + list(tail)
+        self.last_tokens = (fixed + sum(self.tokens(m) for m in steps), total)
+        return messages
+
+    def digest(self):
+        # The digest messages, after the opening message (the issue) and before the verbatim steps
+        note = [{'role': 'user', 'content': dropped_note.format(last=self.dropped)}] if self.dropped else []
+        return note + self.blocks
+
+    def digest_tokens(self):
+        return sum(self.tokens(m) for m in self.digest())
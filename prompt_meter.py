@@ -0,0 +1,108 @@
+import threading
+from rca.baseline.rca_agent.sql_result import estimate_tokens
+
+# Meter of how much of each LLM prompt a prefix-caching backend can reuse. A backend with a KV/prefix
+# cache only evaluates the tokens after the longest prefix shared with a prompt it still holds; this
+# meter keeps the last CACHE_SLOTS prompts, estimates that shared prefix for every call and reports the
+# prompt-eval tokens left, per call and per run. That is a client-side simulation: where the backend
+# reports its own count (Ollama's prompt_eval_count, on streams that run to their end) llm_stream
+# records it as well, and the stats keep the two apart.
+
+# Prompts a backend keeps cached at once (e.g. Ollama's parallel slots)
+CACHE_SLOTS = 4
+
+def _flatten(messages):
+    return [f"<{message['role']}>\n{message['content']}\n" for message in messages]
+
+def _shared_prefix(a, b):
+    # Characters shared at the start of two flattened prompts
+    shared = 0
+    for x, y in zip(a, b):
+        if x == y:
+            shared += len(x)
+            continue
+        # Binary search on slice equality: the comparisons run in C
+        low, high = 0, min(len(x), len(y))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if x[:mid] == y[:mid]:
+                low = mid
+            else:
+                high = mid - 1
+        return shared + low
+    return shared
+
+class PromptMeter:
+    def __init__(self, slots=CACHE_SLOTS, log=None):
+        self.slots = slots
+        self.log = log
+        self.lock = threading.Lock()
+        self.recent = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.prompt_tokens = 0
+            self.reused_tokens = 0
+            self.by_label = {}
+            # Prompt tokens the backend reported evaluating: calls, tokens, per label
+            self.backend_calls = 0
+            self.backend_eval_tokens = 0
+            self.backend_by_label = {}
+
+    def record(self, messages, label):
+        parts = _flatten(messages)
+        text = ''.join(parts)
+        with self.lock:
+            shared = max((_shared_prefix(parts, other) for other in self.recent), default=0)
+            self.recent = ([parts] + self.recent)[:self.slots]
+        total = estimate_tokens(text)
+        reused = estimate_tokens(text[:shared]) if shared else 0
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += total
+            self.reused_tokens += reused
+            stats = self.by_label.setdefault(label, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += total
+            stats[2] += reused
+        if self.log:
+            self.log(f"{label} prompt (estimate): ~{total} tokens, ~{reused} reusable, ~{total - reused} to evaluate",
+                     event='prompt', label=label, messages=len(messages), prompt_tokens=total, reused_tokens=reused,
+                     eval_tokens=total - reused, estimated=True)
+        return total, reused
+
+    def record_backend(self, label, eval_tokens):
+        # The prompt tokens the backend says it evaluated for one call, i.e. after its own prefix cache
+        with self.lock:
+            self.backend_calls += 1
+            self.backend_eval_tokens += eval_tokens
+            stats = self.backend_by_label.setdefault(label, [0, 0])
+            stats[0] += 1
+            stats[1] += eval_tokens
+        if self.log:
+            self.log(f"{label} prompt: {eval_tokens} tokens evaluated by the backend",
+                     event='prompt_eval', label=label, eval_tokens=eval_tokens, estimated=False)
+
+    def stats(self):
+        with self.lock:
+            hit_rate = self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+            return {'estimated': {'calls': self.calls, 'prompt_tokens': self.prompt_tokens, 'reused_tokens': self.reused_tokens,
+                                  'eval_tokens': self.prompt_tokens - self.reused_tokens, 'prefix_hit_rate': hit_rate,
+                                  'by_label': {label: {'calls': c, 'prompt_tokens': t, 'eval_tokens': t - r}
+                                               for label, (c, t, r) in self.by_label.items()}},
+                    'backend': {'calls': self.backend_calls, 'eval_tokens': self.backend_eval_tokens,
+                                'by_label': {label: {'calls': c, 'eval_tokens': t} for label, (c, t) in self.backend_by_label.items()}}}
+
+_meter = PromptMeter()
+
+def get_meter():
+    return _meter
+
+def metered(completion, label):
+    # Wraps a get_chat_completion-style function so every prompt it sends is metered under label
+    def call(messages, **kwargs):
+        _meter.record(messages, label)
+        return completion(messages=messages, **kwargs)
+    return call
@@ -18,37 +18,32 @@ def handler(signum, frame):
 
 def main(args, uid, dataset):
     # --- Auto-import and schema extraction for any dataset ---
+    # The importer keeps a manifest of imported CSVs inside data.db and only reloads new or
+    # modified files, so it is cheap to call on every run.
     import importlib.util
-    import time
     import_path = os.path.join(os.path.dirname(__file__), '../dataset/import_to_sql.py')
-    db_path = os.path.join(os.path.dirname(__file__), f'../dataset/{dataset}/data.db')
-    dataset_dir = os.path.join(os.path.dirname(__file__), f'../dataset/{dataset}')
-    # Find all CSVs in dataset/{dataset}
-    csv_mtimes = []
-    for root, dirs, files in os.walk(dataset_dir):
-        for f in files:
-            if f.endswith('.csv'):
-                csv_mtimes.append(os.path.getmtime(os.path.join(root, f)))
-    db_mtime = os.path.getmtime(db_path) if os.path.exists(db_path) else 0
-    if not os.path.exists(db_path) or (csv_mtimes and db_mtime < max(csv_mtimes)):
-        # Import and run import_to_sql_and_get_schema
-        spec = importlib.util.spec_from_file_location("import_to_sql", import_path)
-        import_to_sql = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(import_to_sql)
-        schema_summary = import_to_sql.import_to_sql_and_get_schema(dataset)
-    else:
-        # If DB exists and is up-to-date, extract schema from DB
-        import sqlite3
-        schema_summary = {}
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table';"):
-            table = row[0]
-            cursor2 = conn.execute(f'PRAGMA table_info({table})')
-            schema_summary[table] = [(col[1], col[2]) for col in cursor2.fetchall()]
-        conn.close()
+    spec = importlib.util.spec_from_file_location("import_to_sql", import_path)
+    import_to_sql = importlib.util.module_from_spec(spec)
+    # Registered so the parallel importer's functions pickle by module name; its spawned pool workers
+    # import the module from dataset/, which parallel_import puts on their sys.path
+    sys.modules[spec.name] = import_to_sql
+    spec.loader.exec_module(import_to_sql)
+    schema_summary = import_to_sql.import_to_sql_and_get_schema(dataset, workers=args.import_workers, bulk=args.import_bulk,
+                                                                rollups=args.import_rollups)
 
     from rca.baseline.rca_agent.rca_agent import RCA_Agent
+    import rca.baseline.rca_agent.executor as executor
+    from rca.baseline.rca_agent.log_sink import set_context, get_log
+    from rca.baseline.rca_agent.prompt_meter import get_meter
+    from rca.baseline.rca_agent.controller import response_stats
+    import rca.baseline.rca_agent.llm_stream as llm_stream
+    from rca.baseline.rca_agent.cassette import use_cassette, get_cassette
+    executor.SQL_CANDIDATES = args.sql_candidates
+    llm_stream.EARLY_CUTOFF = not args.no_early_cutoff
+    # One cassette for the whole process, shared by the datasets of an --auto run
+    if get_cassette() is None and (args.record or args.replay):
+        use_cassette(args.record or args.replay, 'record' if args.record else 'replay',
+                     latency=args.replay_latency, strict=args.replay_strict)
     import rca.baseline.rca_agent.prompt.agent_prompt as ap
     if dataset == "Telecom":
         import rca.baseline.rca_agent.prompt.basic_prompt_Telecom as bp
@@ -97,6 +92,15 @@ def main(args, uid, dataset):
         "hard": 0,
     }
 
+    # Prompt-prefix reuse of every LLM call, logged per call and summarized per task
+    meter = get_meter()
+    meter.log = get_log(f"{unique_obs_path}/prompt_meter.jsonl")
+    # Tokens generated, kept and saved by cutting streamed completions off, per call and per task
+    stream_stats = llm_stream.get_stream_stats()
+    stream_stats.log = get_log(f"{unique_obs_path}/llm_stream.jsonl")
+    # Controller step responses over the run, for the re-ask rate
+    responses = {'responses': 0, 'repaired': 0, 'reasked': 0}
+
     signal.signal(signal.SIGALRM, handler)
     logger.info(f"Using dataset: {dataset}")
     logger.info(f"Using model: {configs['MODEL'].split('/')[-1]}")
@@ -131,6 +135,9 @@ def main(args, uid, dataset):
             logger.add(sys.stdout, colorize=True, enqueue=True, level="INFO")
             logger.add(logfile, colorize=True, enqueue=True, level="INFO")
             logger.debug('\n' + "#"*80 + f"\n{uuid}: {task_index}\n" + "#"*80)
+            set_context(task=task_index, run=uuid, step=None)
+            meter.reset()
+            stream_stats.reset()
             try: 
                 signal.alarm(args.timeout)
 
@@ -141,6 +148,11 @@ def main(args, uid, dataset):
                                                        max_turn=args.controller_max_turn)
                 
                 signal.alarm(0)
+                logger.info(f"Prompt prefix reuse (client-side estimate, and backend prompt_eval_count where reported): {meter.stats()}")
+                logger.info(f"Controller responses: {response_stats}")
+                logger.info(f"Streamed completions: {stream_stats.stats()}")
+                for key in responses:
+                    responses[key] += response_stats[key]
 
                 for step in trajectory:
                     code_cell = nbf.new_code_cell(step['code'])
@@ -197,6 +209,13 @@ def main(args, uid, dataset):
         scores = temp_scores
         nums = temp_nums
 
+    if get_cassette() is not None:
+        logger.info(f"LLM cassette: {get_cassette().stats()}")
+    if responses['responses']:
+        logger.info(f"Controller responses over the run: {responses}, "
+                    f"re-ask rate {responses['reasked'] / responses['responses']:.2%}, "
+                    f"repair rate {responses['repaired'] / responses['responses']:.2%}")
+
 
 if __name__ == "__main__":
     
@@ -211,6 +230,15 @@ if __name__ == "__main__":
     parser.add_argument("--timeout", type=int, default=600)
     parser.add_argument("--tag", type=str, default='rca')
     parser.add_argument("--auto", type=bool, default=False)
+    parser.add_argument("--import_workers", type=int, default=1)
+    parser.add_argument("--import_bulk", action="store_true")
+    parser.add_argument("--import_rollups", action="store_true")
+    parser.add_argument("--sql_candidates", type=int, default=1)
+    parser.add_argument("--no_early_cutoff", action="store_true")
+    parser.add_argument("--record", type=str, default=None)
+    parser.add_argument("--replay", type=str, default=None)
+    parser.add_argument("--replay_latency", type=float, default=0.0)
+    parser.add_argument("--replay_strict", action="store_true")
 
     args = parser.parse_args()
 
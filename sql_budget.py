@@ -0,0 +1,70 @@
+import time
+import contextlib
+
+# Per-query resource budgets for the executor. SQLite calls the progress handler every
+# PROGRESS_INTERVAL virtual machine instructions; returning non-zero interrupts the statement, so a
+# runaway query stops inside SQLite instead of holding the task until the run's global alarm fires.
+
+QUERY_TIMEOUT = 60.0
+# A full scan costs roughly 10-50 VM instructions per row, so this allows scanning ~10^7-10^8 rows
+QUERY_VM_STEPS = 2_000_000_000
+# Rows read of a query's result (None = unlimited): fetching stops there and the result is reported as
+# cut off; only the first rows are ever shown to the model, the rest feed the column statistics
+MAX_RESULT_ROWS = 1_000_000
+PROGRESS_INTERVAL = 10000
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, budget):
+        self.reason = budget.exceeded
+        self.elapsed = budget.elapsed()
+        self.steps = budget.steps
+        self.rows = budget.rows
+        self.hints = budget.hints
+        self.limit = {'time': budget.seconds, 'vm_steps': budget.vm_steps}[self.reason]
+        super().__init__(f"query exceeded its {self.reason} budget ({self.limit})")
+
+class QueryBudget:
+    def __init__(self, seconds=QUERY_TIMEOUT, vm_steps=QUERY_VM_STEPS, max_rows=MAX_RESULT_ROWS):
+        self.seconds = seconds
+        self.vm_steps = vm_steps
+        self.max_rows = max_rows
+        self.start = time.perf_counter()
+        self.steps = 0
+        self.rows = 0
+        self.exceeded = None
+        # Preflight's hints on how to make the query cheaper, reported when a budget stops it
+        self.hints = []
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def _progress(self):
+        self.steps += PROGRESS_INTERVAL
+        if self.seconds and self.elapsed() > self.seconds:
+            self.exceeded = 'time'
+        elif self.vm_steps and self.steps > self.vm_steps:
+            self.exceeded = 'vm_steps'
+        return 1 if self.exceeded else 0
+
+    def take_rows(self, n):
+        # How many of the next n rows fit under the row cap; the result is not read past it
+        if self.max_rows:
+            n = max(min(n, self.max_rows - self.rows), 0)
+        self.rows += n
+        return n
+
+    @contextlib.contextmanager
+    def enforce(self, conn):
+        self.start = time.perf_counter()
+        conn.set_progress_handler(self._progress, PROGRESS_INTERVAL)
+        try:
+            yield self
+        except QueryBudgetExceeded:
+            raise
+        except Exception as e:
+            # An interrupted statement surfaces as sqlite3.OperationalError (or pandas' DatabaseError around it)
+            if self.exceeded:
+                raise QueryBudgetExceeded(self) from e
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
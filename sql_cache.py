@@ -0,0 +1,181 @@
+import os
+import re
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+# Persistent cache of executor query results, shared by every task that runs against a dataset.
+# Entries are keyed by the normalized SQL text and a fingerprint of data.db taken from the import
+# manifest, so re-importing the data invalidates them without any bookkeeping by the caller.
+
+# Size bounds of one dataset's cache; least recently used entries are evicted first
+MAX_ENTRIES = 5000
+MAX_BYTES = 256 * 1024 * 1024
+# Part of every key: bump it when the type of the cached results changes
+CACHE_FORMAT = 'query_result-2'
+# Results that depend on when or how often the query runs are never cached
+_VOLATILE = re.compile(r"\brandom\s*\(|\brandomblob\s*\(|'now'|\bchanges\s*\(|\blast_insert_rowid\s*\(", re.IGNORECASE)
+_TOKENS = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*.*?(?:\*/|$)"""
+                     r"""|0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|[A-Za-z_][\w$]*|\s+|.""", re.DOTALL)
+_NUMBER = re.compile(r'(\d+\.?\d*|\.\d+)')
+
+def _number(token):
+    # '007' -> '7', '1.50' -> '1.5', '.5' -> '0.5'; a REAL literal stays REAL ('2.0'), so 5/2 and 5/2.0 keep apart
+    if not _NUMBER.fullmatch(token):
+        return token.lower()
+    if '.' not in token:
+        return str(int(token))
+    whole, frac = token.split('.', 1)
+    return f"{int(whole or '0')}.{frac.rstrip('0') or '0'}"
+
+def normalize_sql(sql):
+    # Case-folds keywords and unquoted identifiers, drops comments and whitespace that carries no meaning
+    # and canonicalizes numeric literals; quoted strings and identifiers are kept verbatim
+    tokens = []
+    for token in _TOKENS.findall(sql.strip().rstrip(';')):
+        if token.isspace() or token.startswith('--') or token.startswith('/*'):
+            continue
+        if token[0] in '\'"`[':
+            tokens.append(token)
+        elif token[0].isdigit() or (token[0] == '.' and len(token) > 1):
+            tokens.append(_number(token))
+        else:
+            tokens.append(token.lower())
+    text = ''
+    for token in tokens:
+        # Only two adjacent words or numbers need a separator
+        if text and (text[-1].isalnum() or text[-1] in '_$') and (token[0].isalnum() or token[0] in '_$'):
+            text += ' '
+        text += token
+    return text
+
+def db_fingerprint(db_path):
+    # Hash of the import manifest (which files, with which content, were loaded), of the table list,
+    # which also changes when derived tables are added or dropped, and of the versions bumped when a
+    # derived table is rebuilt in place (import_to_sql.py --rebuild_anomalies)
+    h = hashlib.blake2b(digest_size=16)
+    conn = sqlite3.connect(f'file:{os.path.abspath(db_path)}?mode=ro', uri=True)
+    try:
+        tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name").fetchall()
+        h.update(repr(tables).encode())
+        if ('_import_manifest',) in tables:
+            for row in conn.execute('SELECT path, hash, rows FROM _import_manifest ORDER BY path'):
+                h.update(repr(row).encode())
+            if ('_data_version',) in tables:
+                h.update(repr(conn.execute('SELECT name, version FROM _data_version ORDER BY name').fetchall()).encode())
+        else:
+            stat = os.stat(db_path)
+            h.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    finally:
+        conn.close()
+    return h.hexdigest()
+
+class ResultCache:
+    def __init__(self, db_path, cache_path=None, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.db_path = db_path
+        self.cache_path = cache_path or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'sql_cache.db')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY, fingerprint TEXT, sql TEXT, payload BLOB, bytes INTEGER,
+            created REAL, last_used REAL, hits INTEGER)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_used ON results (last_used)')
+        self.conn.commit()
+        self.stamp = None
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+
+    def _current_fingerprint(self):
+        stat = os.stat(self.db_path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if stamp != self.stamp:
+            self.stamp = stamp
+            fingerprint = db_fingerprint(self.db_path)
+            if fingerprint != self.fingerprint:
+                # Results computed on other data can never be hit again
+                self.conn.execute('DELETE FROM results WHERE fingerprint != ?', (fingerprint,))
+                self.conn.commit()
+                self.fingerprint = fingerprint
+        return self.fingerprint
+
+    def key(self, sql):
+        if _VOLATILE.search(sql):
+            return None
+        return hashlib.blake2b(f'{CACHE_FORMAT}\n{normalize_sql(sql)}'.encode(), digest_size=16).hexdigest()
+
+    def get(self, sql):
+        # Returns the cached result, or None on a miss. A broken cache only ever costs a miss.
+        key = self.key(sql)
+        with self.lock:
+            if key is None:
+                self.skipped += 1
+                return None
+            try:
+                fingerprint = self._current_fingerprint()
+                row = self.conn.execute('SELECT payload FROM results WHERE key = ? AND fingerprint = ?', (key, fingerprint)).fetchone()
+                result = pickle.loads(row[0]) if row is not None else None
+                if row is not None:
+                    self.conn.execute('UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?', (time.time(), key))
+                    self.conn.commit()
+            except (sqlite3.Error, OSError, pickle.UnpicklingError, EOFError):
+                result = None
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, sql, result):
+        key = self.key(sql)
+        if key is None:
+            return
+        payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                fingerprint = self._current_fingerprint()
+                self.conn.execute('INSERT OR REPLACE INTO results (key, fingerprint, sql, payload, bytes, created, last_used, hits) VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                                  (key, fingerprint, sql, payload, len(payload), now, now))
+                self._evict()
+                self.conn.commit()
+            except (sqlite3.Error, OSError):
+                self.conn.rollback()
+
+    def _evict(self):
+        entries, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results').fetchone()
+        if entries <= self.max_entries and total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute('SELECT key, bytes FROM results ORDER BY last_used').fetchall():
+            if entries <= self.max_entries and total <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            entries -= 1
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            entries, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results').fetchone()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'skipped': self.skipped, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': entries, 'bytes': total}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(db_path):
+    key = os.path.abspath(db_path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ResultCache(db_path)
+        return cache
@@ -0,0 +1,132 @@
+import math
+import sqlite3
+from array import array
+import numpy as np
+
+# Statistical SQL functions registered on every executor connection. The aggregates keep their
+# inputs in a flat array('d') so a window frame costs 8 bytes per row; sliding frames drop rows
+# from the front in insertion order, which is how SQLite calls inverse().
+
+sql_functions_doc = """## EXTRA SQL FUNCTIONS:
+
+Besides the built-in SQLite functions, these statistical functions are available. The aggregates can also be used as window functions with `OVER (...)`. NULL and non-numeric inputs are ignored.
+
+- `percentile(x, q)`: the q-th percentile of x with linear interpolation, q in [0, 100] (e.g., `percentile(value, 95)` for P95).
+- `median(x)`: the median of x, same as `percentile(x, 50)`.
+- `stddev(x)`: the sample standard deviation of x (NULL for fewer than 2 values).
+- `mad(x)`: the median absolute deviation of x, i.e. `median(abs(x - median(x)))`.
+- `zscore(x, mean, sd)`: `(x - mean) / sd` (NULL when sd is 0 or NULL), e.g. `zscore(value, AVG(value) OVER w, stddev(value) OVER w)`."""
+
+# Compact the buffer once this many rows have been removed from its front
+_COMPACT_AFTER = 4096
+
+def _as_float(x):
+    if x is None:
+        return None
+    try:
+        value = float(x)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+def _percentile(values, q):
+    # Same definition as np.percentile(values, q) with the default 'linear' method
+    n = len(values)
+    if n == 0:
+        return None
+    ordered = np.sort(values)
+    pos = (n - 1) * min(max(q, 0.0), 100.0) / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, n - 1)
+    return float(ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo))
+
+class _ArrayAccumulator:
+    def __init__(self):
+        self.values = array('d')
+        self.head = 0
+
+    def _push(self, x):
+        value = _as_float(x)
+        if value is not None:
+            self.values.append(value)
+
+    def inverse(self, x, *args):
+        # The leaving row was only stored if it was numeric
+        if _as_float(x) is not None:
+            self.head += 1
+            if self.head >= _COMPACT_AFTER and self.head * 2 >= len(self.values):
+                del self.values[:self.head]
+                self.head = 0
+
+    def live(self):
+        # Copy of the rows currently in the frame; a view would pin the buffer against appends
+        return np.array(self.values[self.head:], dtype=np.float64)
+
+    def finalize(self):
+        return self.value()
+
+class Percentile(_ArrayAccumulator):
+    def __init__(self):
+        super().__init__()
+        self.q = 50.0
+
+    def step(self, x, q):
+        q = _as_float(q)
+        if q is not None:
+            self.q = q
+        self._push(x)
+
+    def value(self):
+        return _percentile(self.live(), self.q)
+
+class Median(_ArrayAccumulator):
+    def step(self, x):
+        self._push(x)
+
+    def value(self):
+        return _percentile(self.live(), 50.0)
+
+class StdDev(_ArrayAccumulator):
+    def step(self, x):
+        self._push(x)
+
+    def value(self):
+        values = self.live()
+        if len(values) < 2:
+            return None
+        return float(np.std(values, ddof=1))
+
+class Mad(_ArrayAccumulator):
+    def step(self, x):
+        self._push(x)
+
+    def value(self):
+        values = self.live()
+        if len(values) == 0:
+            return None
+        center = _percentile(values, 50.0)
+        return _percentile(np.abs(values - center), 50.0)
+
+def zscore(x, mean, sd):
+    x, mean, sd = _as_float(x), _as_float(mean), _as_float(sd)
+    if x is None or mean is None or not sd:
+        return None
+    return (x - mean) / sd
+
+_aggregates = [
+    ('percentile', 2, Percentile),
+    ('median', 1, Median),
+    ('stddev', 1, StdDev),
+    ('mad', 1, Mad),
+]
+
+def register_sql_functions(conn):
+    # Window functions need SQLite >= 3.25 and Python >= 3.11; fall back to plain aggregates
+    window = hasattr(conn, 'create_window_function') and sqlite3.sqlite_version_info >= (3, 25, 0)
+    for name, n_args, cls in _aggregates:
+        if window:
+            conn.create_window_function(name, n_args, cls)
+        else:
+            conn.create_aggregate(name, n_args, cls)
+    conn.create_function('zscore', 3, zscore, deterministic=True)
+    return conn
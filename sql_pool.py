@@ -0,0 +1,142 @@
+import os
+import queue
+import sqlite3
+import threading
+import contextlib
+from urllib.request import pathname2url
+from rca.baseline.rca_agent.sql_functions import register_sql_functions
+
+# Process-wide pools of read-only connections, one pool per dataset DB. The executor only reads data.db,
+# so connections are opened immutable (no locking or change detection) and kept open across attempts,
+# steps and tasks; their page cache and memory map stay warm between queries.
+
+POOL_SIZE = 4
+# Per-connection settings: map up to 1 GiB of the file and keep up to 256 MiB of decoded pages
+READ_PRAGMAS = {
+    'mmap_size': 1 << 30,
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'query_only': 'ON',
+}
+
+def _file_stamp(db_path):
+    stat = os.stat(db_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def open_read_only(db_path):
+    # immutable=1 tells SQLite the file cannot change under it; the pool reopens connections when it does
+    uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    for name, value in READ_PRAGMAS.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    register_sql_functions(conn)
+    return conn
+
+class ConnectionPool:
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self.lock = threading.Lock()
+        # LIFO so the most recently used (warmest) connection is handed out first
+        self.idle = queue.LifoQueue()
+        self.open = 0
+        self.generation = 0
+        self.stamp = _file_stamp(db_path)
+        self.hits = 0
+        self.misses = 0
+
+    def _check_stamp(self):
+        # A re-import replaces data.db; connections opened on the old file must not be reused
+        stamp = _file_stamp(self.db_path)
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+        self.generation += 1
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            self.open -= 1
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._check_stamp()
+                try:
+                    conn, generation = self.idle.get_nowait()
+                    self.hits += 1
+                    return conn, generation
+                except queue.Empty:
+                    pass
+                if self.open < self.size:
+                    self.open += 1
+                    self.misses += 1
+                    generation = self.generation
+                    break
+            # Every connection is busy: wait for one to come back, re-checking whether one was closed meanwhile
+            try:
+                conn, generation = self.idle.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if generation == self.generation:
+                    self.hits += 1
+                    return conn, generation
+                conn.close()
+                self.open -= 1
+        try:
+            return open_read_only(self.db_path), generation
+        except Exception:
+            with self.lock:
+                self.open -= 1
+            raise
+
+    def release(self, conn, generation):
+        with self.lock:
+            if generation != self.generation:
+                conn.close()
+                self.open -= 1
+                return
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put((conn, generation))
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn, generation = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn, generation)
+
+    def close(self):
+        with self.lock:
+            while True:
+                try:
+                    conn, _ = self.idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self.open -= 1
+
+    def stats(self):
+        return {'open': self.open, 'idle': self.idle.qsize(), 'hits': self.hits, 'misses': self.misses}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path, size=POOL_SIZE):
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path, size)
+        return pool
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
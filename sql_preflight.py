@@ -0,0 +1,282 @@
+import re
+import math
+import calendar
+import datetime
+
+# Pre-flight check run before a model-written query touches the data. It rewrites time filters that
+# wrap the indexed timestamp column in datetime()/strftime()/date() into plain range predicates on the
+# raw column, then estimates the cost of the final plan from EXPLAIN QUERY PLAN and the tables' row
+# counts and rejects queries whose nested loops would visit too many rows, with a hint on how to fix
+# them. A costly single-table scan is not rejected: its cost is linear and the executor's runtime
+# budget stops it if needed, so it only gets the hints.
+
+# Estimated row visits above which a query is rejected before it runs
+REJECT_ROWS = 50_000_000
+# Rows assumed per lookup of an index SEARCH inside a join loop
+SEARCH_ROWS = 10
+# Cost of a row visited by a covering-index scan relative to a table row (index entries are much smaller)
+COVERING_SCAN_COST = 0.25
+# Anything that has to see every row before the first one is returned, so LIMIT does not bound the work
+_NEEDS_ALL_ROWS = re.compile(r'\b(?:order|group)\s+by\b|\bdistinct\b|\b(?:count|sum|avg|min|max|total|group_concat|median|percentile'
+                             r'|stddev|mad|zscore)\s*\(|\b(?:union|intersect|except|window|over)\b', re.IGNORECASE)
+_LIMIT = re.compile(r'\blimit\s+(\d+)(?:\s*(?:offset|,)\s*(\d+))?\s*;?\s*$', re.IGNORECASE)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_OFFSET = re.compile(r"^([+-]?\d+(?:\.\d+)?) (hour|minute|second)s?$", re.IGNORECASE)
+_DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H', '%Y-%m-%d')
+_DATE_ONLY = _DATETIME_FORMATS[-1]
+_FLIP = {'>=': '<=', '<=': '>=', '>': '<', '<': '>', '=': '=', '==': '=='}
+
+class PreflightRejected(Exception):
+    def __init__(self, estimate, hints):
+        self.estimate = estimate
+        self.hints = hints
+        super().__init__(f"estimated {estimate:.3g} row visits")
+
+class Preflight:
+    def __init__(self, sql):
+        self.sql = sql
+        self.rewrites = []
+        self.estimate = 0
+        self.scans = []
+        # How to make the query cheaper, for a plan that is expensive but not rejected
+        self.hints = []
+
+def _epoch(literal):
+    # (epoch seconds of the literal read as UTC, its format). Only zero-padded literals are read: SQLite
+    # compares the function's output with them as text, which '2022-3-20' would not match.
+    for fmt in _DATETIME_FORMATS:
+        try:
+            value = datetime.datetime.strptime(literal, fmt)
+        except ValueError:
+            continue
+        if value.strftime(fmt) != literal:
+            return None, None
+        return calendar.timegm(value.timetuple()), fmt
+    return None, None
+
+def _shift(modifiers):
+    # Seconds added by the modifiers after 'unixepoch', or None for ones that cannot be inverted
+    if not modifiers or modifiers[0].lower() != 'unixepoch':
+        return None
+    shift = 0.0
+    for modifier in modifiers[1:]:
+        match = _OFFSET.match(modifier.strip())
+        if modifier.strip().lower() == 'utc':
+            continue
+        if match is None:
+            return None
+        shift += float(match.group(1)) * {'hour': 3600, 'minute': 60, 'second': 1}[match.group(2).lower()]
+    return shift
+
+def _bounds(func, op, epoch, complete):
+    # [low, high) interval of whole seconds (as shown by func) that satisfies `func(...) op literal`.
+    # Shorter literals compare as string prefixes: everything at or after their start is greater.
+    step = 86400 if func == 'date' else 1
+    if op in ('=', '=='):
+        return (epoch, epoch + step) if complete or func == 'date' else None
+    if op == '>=' or (op == '>' and not (complete or func == 'date')):
+        return epoch, None
+    if op == '>':
+        return epoch + step, None
+    if op == '<' or (op == '<=' and not (complete or func == 'date')):
+        return None, epoch
+    return None, epoch + step
+
+def make_sargable(sql):
+    # Rewrites `datetime(ts[/1000], 'unixepoch'[, '+8 hours']) <op> '<literal>'` (also strftime with a
+    # full date-time format, date(), BETWEEN, and reversed comparisons) into integer bounds on ts.
+    # Returns (sql, [(original, replacement), ...]).
+    literals = []
+    def mask(match):
+        literals.append(match.group(0))
+        return f'__s{len(literals) - 1}__'
+    text = _STRING.sub(mask, sql)
+    unmask = lambda s: re.sub(r'__s(\d+)__', lambda m: literals[int(m.group(1))], s)
+    literal = lambda index: literals[int(index)][1:-1].replace("''", "'")
+    call = (r'''(?P<func>datetime|date|strftime)\s*\(\s*(?:(?P<fmt>__s\d+__)\s*,\s*)?'''
+            r'''(?P<col>(?:"?\w+"?\s*\.\s*)?"?\w+"?)(?P<ms>\s*/\s*1000(?:\.0)?)?(?P<mods>(?:\s*,\s*__s\d+__)+)\s*\)''')
+    forward = re.compile(rf'(?<![\w.]){call}\s*(?P<op>>=|<=|==|=|>|<)\s*__s(?P<lit>\d+)__'
+                         rf'|(?<![\w.]){call.replace("?P<", "?P<b_")}\s+between\s+__s(?P<lo>\d+)__\s+and\s+__s(?P<hi>\d+)__',
+                         re.IGNORECASE)
+    backward = re.compile(rf'__s(?P<lit>\d+)__\s*(?P<op>>=|<=|==|=|>|<)\s*{call}', re.IGNORECASE)
+    rewrites = []
+
+    def rewrite(match, prefix, comparisons):
+        group = lambda name: match.group(prefix + name)
+        func = group('func').lower()
+        if func == 'strftime':
+            if group('fmt') is None or literal(re.search(r'\d+', group('fmt')).group()) != '%Y-%m-%d %H:%M:%S':
+                return None
+            func = 'datetime'
+        shift = _shift([literal(i) for i in re.findall(r'__s(\d+)__', group('mods'))])
+        if shift is None or not shift.is_integer():
+            return None
+        unit = 1000 if group('ms') else 1
+        low = high = None
+        for op, index in comparisons:
+            epoch, fmt = _epoch(literal(index))
+            if epoch is None or (func == 'date' and fmt != _DATE_ONLY):
+                # date() yields 'YYYY-MM-DD', which compares as text against a longer literal: not a day range
+                return None
+            bounds = _bounds(func, op, epoch, fmt == _DATETIME_FORMATS[0])
+            if bounds is None:
+                return None
+            if bounds[0] is not None:
+                low = bounds[0] if low is None else max(low, bounds[0])
+            if bounds[1] is not None:
+                high = bounds[1] if high is None else min(high, bounds[1])
+        col = group('col')
+        parts = []
+        if low is not None:
+            parts.append(f'{col} >= {int((low - shift) * unit)}')
+        if high is not None:
+            parts.append(f'{col} < {int((high - shift) * unit)}')
+        replacement = '(' + ' AND '.join(parts) + ')'
+        rewrites.append((unmask(match.group(0)), replacement))
+        return replacement
+
+    def forward_sub(match):
+        if match.group('func'):
+            result = rewrite(match, '', [(match.group('op'), match.group('lit'))])
+        else:
+            result = rewrite(match, 'b_', [('>=', match.group('lo')), ('<=', match.group('hi'))])
+        return match.group(0) if result is None else result
+
+    def backward_sub(match):
+        result = rewrite(match, '', [(_FLIP[match.group('op')], match.group('lit'))])
+        return match.group(0) if result is None else result
+
+    text = forward.sub(forward_sub, text)
+    text = backward.sub(backward_sub, text)
+    return unmask(text), rewrites
+
+_NOT_ALIAS = {'where', 'join', 'left', 'inner', 'cross', 'natural', 'on', 'using', 'group', 'order', 'limit',
+              'having', 'union', 'except', 'intersect', 'outer', 'full', 'right', 'indexed', 'not', 'window'}
+
+def _table_aliases(conn, sql):
+    # Name as it appears in EXPLAIN QUERY PLAN (the alias when there is one) -> table name
+    tables = {name.lower(): name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    aliases = {name: name for name in tables.values()}
+    text = _STRING.sub("''", sql)
+    for table, alias in re.findall(r'(?<![\w"])(?="?(\w+)"?\s+(?:as\s+)?"?(\w+)"?)', text, re.IGNORECASE):
+        if table.lower() in tables and alias.lower() not in _NOT_ALIAS:
+            aliases[alias] = tables[table.lower()]
+    return aliases
+
+def _row_count(conn, table, cache):
+    if table not in cache:
+        try:
+            # MAX(rowid) is a single b-tree descent; a close upper bound of COUNT(*) for append-only tables
+            cache[table] = conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+        except Exception:
+            cache[table] = 0
+    return cache[table]
+
+def _loop_visits(kind, rest, rows, nested):
+    if kind == 'SCAN':
+        if 'COVERING INDEX' in rest:
+            return max(math.ceil(rows * COVERING_SCAN_COST), 1)
+        return max(rows, 1)
+    if 'AUTOMATIC' in rest or 'USING' not in rest:
+        # Keyed on a column without an index of its own: the rows per key are unknown, assume low selectivity
+        return max(math.isqrt(rows), SEARCH_ROWS)
+    # Equality lookups inside a join find a few rows; a range on the outermost loop reads a slice of the table
+    return SEARCH_ROWS if nested else min(max(rows, 1), max(rows // 100, SEARCH_ROWS))
+
+def _limit(sql):
+    # Rows the outermost LIMIT (plus OFFSET) lets the query produce before it stops, or None when the
+    # query has no LIMIT or has to see all rows before returning the first
+    text = _STRING.sub("''", sql).strip()
+    match = _LIMIT.search(text)
+    if match is None or _NEEDS_ALL_ROWS.search(text):
+        return None
+    return int(match.group(1)) + int(match.group(2) or 0)
+
+def estimate_cost(conn, sql, row_counts=None):
+    # Row visits estimated from the plan: the loops of one SELECT nest, so their row counts multiply;
+    # separate SELECTs (subqueries, CTEs, compound parts) add up, and a correlated subquery runs once per
+    # row of the loops before it. A LIMIT that stops the query early caps the estimate. Returns
+    # (estimate, full scans, whether the estimate multiplies the rows of nested loops).
+    row_counts = {} if row_counts is None else row_counts
+    aliases = _table_aliases(conn, sql)
+    children = {}
+    for node_id, parent, _, detail in conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall():
+        children.setdefault(parent, []).append((node_id, detail))
+    scans = []
+    nested = False
+
+    def cost(parent):
+        nonlocal nested
+        total = 0
+        outer = 1
+        for node_id, detail in children.get(parent, []):
+            match = re.match(r'(SCAN|SEARCH)\s+(?:TABLE\s+)?"?(\w+)"?(?:\s+AS\s+\w+)?(.*)', detail)
+            if match is None:
+                inner = cost(node_id)
+                if detail.startswith('CORRELATED') and outer > 1:
+                    nested = True
+                    total += outer * inner
+                else:
+                    total += inner
+                continue
+            kind, name, rest = match.groups()
+            table = aliases.get(name, name)
+            rows = _row_count(conn, table, row_counts)
+            if kind == 'SCAN' and rows and 'VIRTUAL TABLE' not in rest:
+                scans.append((table, rows, rest.strip()))
+            visits = _loop_visits(kind, rest, rows, outer > 1)
+            if outer > 1 and visits > 1:
+                nested = True
+            outer *= visits
+            total += outer
+        return total
+
+    estimate = cost(0)
+    limit = _limit(sql)
+    if limit is not None:
+        estimate = min(estimate, max(limit, 1))
+    return estimate, scans, nested
+
+def index_hints(conn, sql, scans):
+    hints = []
+    for table, rows, _ in scans:
+        indexed = []
+        for _, index, *_ in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+            columns = [col[2] for col in conn.execute(f'PRAGMA index_info("{index}")').fetchall()]
+            if columns:
+                indexed.append((index, columns[0]))
+        if not indexed:
+            hints.append(f"`{table}` ({rows} rows) has no index; narrow the query with selective conditions or aggregate it in a subquery first.")
+            continue
+        wrapped = [col for _, col in indexed if re.search(rf'\b(datetime|date|strftime|time|julianday|cast|abs|round)\s*\([^)]*\b{re.escape(col)}\b', sql, re.IGNORECASE)]
+        for col in wrapped:
+            index = next(name for name, c in indexed if c == col)
+            hints.append(f"`{table}` ({rows} rows) is fully scanned because `{col}` is wrapped in a function; "
+                         f"filter on the raw `{col}` with numeric bounds (e.g. `{col} >= <start> AND {col} < <end>`) to use {index}.")
+        if not wrapped:
+            cols = ', '.join(f'`{col}` ({index})' for index, col in indexed)
+            hints.append(f"`{table}` ({rows} rows) is fully scanned; add a condition on an indexed column: {cols}.")
+    return hints or ["The plan joins large tables on conditions that match many rows per key; join on selective keys or filter both sides first."]
+
+def preflight(conn, sql, reject_rows=REJECT_ROWS):
+    # Returns a Preflight with the SQL to run; raises PreflightRejected when the plan is too expensive.
+    # A query EXPLAIN cannot compile is passed through unchanged so its error surfaces on execution.
+    check = Preflight(sql)
+    rewritten, rewrites = make_sargable(sql)
+    if rewrites:
+        try:
+            conn.execute(f'EXPLAIN QUERY PLAN {rewritten}').fetchall()
+            check.sql, check.rewrites = rewritten, rewrites
+        except Exception:
+            pass
+    try:
+        check.estimate, check.scans, nested = estimate_cost(conn, check.sql)
+    except Exception:
+        return check
+    if check.estimate > reject_rows:
+        hints = index_hints(conn, check.sql, check.scans)
+        if nested:
+            raise PreflightRejected(check.estimate, hints)
+        # A single pass over the data: left to the runtime budget, which reports these hints if it stops it
+        check.hints = hints
+    return check
@@ -0,0 +1,217 @@
+import io
+import re
+import csv
+from collections import Counter
+import pandas as pd
+
+# Streaming result reader for the executor: rows are pulled with fetchmany, only the first rows are
+# kept for display and every column is summarized on the fly, so memory stays O(display rows)
+# whatever the size of the result.
+
+DISPLAY_ROWS = 20
+FETCH_ROWS = 5000
+# Distinct values tracked per column; past this the distinct count is a lower bound
+DISTINCT_CAP = 1000
+# Target size of a rendered result in the model's context, and the text cell widths tried to meet it
+RESULT_TOKEN_BUDGET = 4000
+CELL_CHARS = (120, 40)
+# Columns rendered at most; the rest are listed by name
+MAX_COLUMNS = 30
+# Aligned tables are easier to read; CSV is only used when it is this much cheaper
+ALIGNED_SLACK = 1.15
+_TOKEN_PIECES = re.compile(r"\d+|[^\W\d]+|\s+|[^\w\s]")
+
+def _order(value):
+    # SQLite's cross-type ordering: numbers < text < blobs
+    if isinstance(value, (int, float)):
+        return (0, value)
+    return (1, value) if isinstance(value, str) else (2, bytes(value))
+
+class ColumnSummary:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.numeric = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.values = Counter()
+        self.overflow = False
+
+    def add(self, values):
+        # One batch of a column at a time, with built-ins doing the per-value work
+        present = [value for value in values if value is not None]
+        self.nulls += len(values) - len(present)
+        values = present
+        if not values:
+            return
+        self.count += len(values)
+        numbers = [value for value in values if isinstance(value, (int, float))]
+        if numbers:
+            self.numeric += len(numbers)
+            self.sum += sum(numbers)
+        try:
+            low, high = min(values), max(values)
+        except TypeError:
+            low, high = min(values, key=_order), max(values, key=_order)
+        if self.min is None or _order(low) < _order(self.min):
+            self.min = low
+        if self.max is None or _order(high) > _order(self.max):
+            self.max = high
+        if not self.overflow:
+            self.values.update(values)
+            if len(self.values) > DISTINCT_CAP:
+                # Stop tracking: the distinct count becomes a lower bound and the top values approximate
+                self.overflow = True
+
+    def distinct(self):
+        # (count, exact?)
+        return (DISTINCT_CAP, False) if self.overflow else (len(self.values), True)
+
+    def mean(self):
+        return self.sum / self.numeric if self.numeric else None
+
+    def top(self, n=3):
+        return self.values.most_common(n)
+
+class QueryResult:
+    def __init__(self, columns, rows, row_count, summaries, capped=False):
+        self.columns = columns
+        self.rows = rows
+        self.row_count = row_count
+        self.summaries = summaries
+        # Reading stopped at the budget's row cap: row_count and the summaries cover only the rows read
+        self.capped = capped
+
+    @property
+    def empty(self):
+        return self.row_count == 0
+
+    @property
+    def truncated(self):
+        return self.row_count > len(self.rows)
+
+def fetch_result(conn, sql, budget=None, display_rows=DISPLAY_ROWS, summarize=True, fetch_rows=FETCH_ROWS):
+    cursor = conn.execute(sql)
+    try:
+        columns = [col[0] for col in cursor.description] if cursor.description else []
+        summaries = [ColumnSummary(col) for col in columns] if summarize else None
+        rows = []
+        row_count = 0
+        capped = False
+        while not capped:
+            batch = cursor.fetchmany(fetch_rows)
+            if not batch:
+                break
+            if budget is not None:
+                keep = budget.take_rows(len(batch))
+                if keep < len(batch):
+                    batch = batch[:keep]
+                    capped = True
+            row_count += len(batch)
+            if len(rows) < display_rows:
+                rows.extend(batch[:display_rows - len(rows)])
+            if summaries:
+                for summary, values in zip(summaries, zip(*batch)):
+                    summary.add(values)
+    finally:
+        cursor.close()
+    return QueryResult(columns, rows, row_count, summaries, capped)
+
+def estimate_tokens(text):
+    # Cheap upper-bound estimate of cl100k-style BPE tokens: letters in runs of ~4 characters, digits in
+    # runs of 3, whitespace runs of ~8, one token per punctuation character
+    tokens = 0
+    for piece in _TOKEN_PIECES.findall(text):
+        if piece[0].isdigit():
+            tokens += -(-len(piece) // 3)
+        elif piece[0].isspace():
+            tokens += -(-len(piece) // 8)
+        elif piece[0].isalpha() or piece[0] == '_':
+            tokens += -(-len(piece) // 4)
+        else:
+            tokens += 1
+    return tokens
+
+def _abbreviate(value, limit):
+    if isinstance(value, bytes):
+        value = f'<{len(value)} bytes>'
+    if isinstance(value, str) and len(value) > limit:
+        return f'{value[:limit]}...(+{len(value) - limit} chars)'
+    return value
+
+def _aligned(columns, rows):
+    return pd.DataFrame(rows, columns=columns).to_string(index=False)
+
+def _csv(columns, rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return out.getvalue().rstrip('\n')
+
+def _layout(columns, rows):
+    aligned = _aligned(columns, rows)
+    compact = _csv(columns, rows)
+    aligned_tokens, compact_tokens = estimate_tokens(aligned), estimate_tokens(compact)
+    if aligned_tokens <= compact_tokens * ALIGNED_SLACK:
+        return aligned, aligned_tokens
+    return compact, compact_tokens
+
+def describe_columns(query_result, columns=None, cell_chars=CELL_CHARS[-1]):
+    lines = [f"Column summary over {'the first' if query_result.capped else 'all'} {query_result.row_count} rows:"]
+    for summary in query_result.summaries or []:
+        if columns is not None and summary.name not in columns:
+            continue
+        distinct, exact = summary.distinct()
+        line = f"- {summary.name}: {summary.count} non-null, {distinct}{'' if exact else '+'} distinct"
+        if summary.count:
+            line += f", min {_abbreviate(summary.min, cell_chars)}, max {_abbreviate(summary.max, cell_chars)}"
+        if summary.numeric:
+            line += f", mean {summary.mean():.4g}"
+        if exact and 1 < distinct < summary.count:
+            top = ', '.join(f'{_abbreviate(value, cell_chars)} ({n})' for value, n in summary.top())
+            line += f", top: {top}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def render_result(query_result, token_budget=RESULT_TOKEN_BUDGET):
+    # Renders the kept rows within token_budget: abbreviates long text cells, drops columns past
+    # MAX_COLUMNS, picks the cheaper layout and halves the rows shown until the text fits; rows that
+    # are not shown are represented by the per-column statistics. Returns (text, estimated tokens).
+    columns = list(query_result.columns[:MAX_COLUMNS])
+    dropped = list(query_result.columns[MAX_COLUMNS:])
+    width = len(columns)
+    stats = ''
+    for cell_chars in CELL_CHARS:
+        rows = [tuple(_abbreviate(value, cell_chars) for value in row[:width]) for row in query_result.rows]
+        shown = len(rows)
+        while True:
+            partial = shown < query_result.row_count
+            stats = describe_columns(query_result, columns, CELL_CHARS[-1]) if partial and query_result.summaries else ''
+            body, tokens = _layout(columns, rows[:shown])
+            tokens += estimate_tokens(stats)
+            if tokens <= token_budget or shown <= 1:
+                break
+            shown //= 2
+        if tokens <= token_budget:
+            break
+    if tokens > token_budget and stats:
+        # Even a single row does not leave room for every column's statistics: keep the first ones
+        lines = stats.split('\n')
+        room = token_budget - (tokens - estimate_tokens(stats))
+        while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > room:
+            lines.pop()
+        stats = '\n'.join(lines)
+    text = body
+    if partial:
+        text += f"\n\n**Note**: Only the first {shown} of {query_result.row_count} rows are shown. The result was truncated."
+    if query_result.capped:
+        text += (f"\n\n**Note**: The query returned more than {query_result.row_count} rows; reading stopped there, so "
+                 f"the row count and statistics cover only the first {query_result.row_count}. Aggregate or filter to see all of it.")
+    if dropped:
+        text += f"\n\n**Note**: {len(dropped)} more columns are not shown: {', '.join(dropped)}"
+    if stats:
+        text += "\n\n" + stats
+    return text, estimate_tokens(text)
@@ -0,0 +1,196 @@
+import re
+import datetime
+
+# Rewrites aggregate queries over a raw metric table to the coarsest rollup table built by the importer
+# (dataset/import_to_sql.py --rollups) that gives the same answer. Only the simple single-table shape is
+# handled: one SELECT over one metric table, KPI columns used only inside MIN/MAX/SUM/COUNT/AVG/TOTAL, and
+# the timestamp used only in time buckets and range filters aligned to the rollup's bucket. Anything else
+# is left alone, so the raw table remains the fallback for every query the rewrite does not understand.
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"__s(\d+)__")
+_UNSUPPORTED = re.compile(r"\b(join|union|intersect|except|with|over|distinct|window)\b|\bcount\s*\(\s*\*\s*\)|;", re.IGNORECASE)
+_SOURCE = re.compile(r'\bfrom\s+"?(\w+)"?(?:\s+(?:as\s+)?(?!(?:where|group|order|limit|having)\b)"?\w+"?)?\s*(,)?', re.IGNORECASE)
+# Whole-hour shifts keep minute and hour buckets aligned; 'localtime' may not
+_TIME_MODIFIER = re.compile(r"^(unixepoch|utc|[+-]?\d+ hours?)$", re.IGNORECASE)
+_DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H', '%Y-%m-%d')
+# Operators that make a bound part of a larger expression (timestamp >= 1647770400 + 600)
+_ARITHMETIC = frozenset('+-*/%|&')
+
+def _col(name):
+    # A column reference, optionally quoted and optionally qualified by a table name or alias
+    return rf'(?<![\w."])((?:"?\w+"?\s*\.\s*)?)"?{re.escape(name)}"?(?![\w"])'
+
+def load_rollups(conn):
+    # metric table -> its rollups, coarsest first
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_tables'").fetchone():
+        return {}
+    rollups = {}
+    for row in conn.execute('''SELECT metric_table, table_name, seconds, bucket, timestamp_column, component_column,
+                               kpi_column, value_columns FROM rollup_tables ORDER BY seconds DESC'''):
+        metric_table, table_name, seconds, bucket, ts, component, kpi, values = row
+        rollups.setdefault(metric_table, []).append({
+            'table': table_name, 'seconds': seconds, 'bucket': bucket, 'timestamp': ts,
+            'keys': [component] + ([kpi] if kpi else []), 'values': values.split(','),
+        })
+    return rollups
+
+def _literal_seconds(literal):
+    # Seconds since midnight of a 'YYYY-MM-DD HH:MM:SS' literal (or a shorter prefix of one) and whether it is complete
+    text = literal[1:-1]
+    for fmt in _DATETIME_FORMATS:
+        try:
+            value = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return value.hour * 3600 + value.minute * 60 + value.second, fmt == _DATETIME_FORMATS[0]
+    return None, False
+
+def _in_expression(text, start, end):
+    # True when an arithmetic operator touches text[start:end] on either side, so the matched
+    # comparison is not the whole predicate and its literal is not the bound
+    return text[:start].rstrip()[-1:] in _ARITHMETIC or text[end:].lstrip()[:1] in _ARITHMETIC
+
+def _format_granularity(fmt):
+    # Coarsest time step (seconds) that a strftime format cannot tell apart
+    if re.search(r'%[SfsJ]', fmt):
+        return 1
+    if '%M' in fmt:
+        return 60
+    if '%H' in fmt:
+        return 3600
+    return 86400
+
+def _time_checks(text, literals, ts, ms):
+    # Returns (checks, text with every understood timestamp use blanked out), or None when the
+    # timestamp is used in a way no rollup can reproduce. A check is ('seconds', n) or ('units', n):
+    # n must be a multiple of the rollup's bucket, in seconds or in timestamp units.
+    checks = []
+    scale = r'\s*/\s*1000(?:\.0)?' if ms else ''
+    func = re.compile(rf'\b(strftime|datetime|date|time)\s*\(\s*(?:__s(\d+)__\s*,\s*)?{_col(ts)}{scale}((?:\s*,\s*__s\d+__)*)\s*\)', re.IGNORECASE)
+    compare = re.compile(r'\s*(>=|<=|<>|!=|>|<|==|=)\s*__s(\d+)__|\s+between\s+__s(\d+)__\s+and\s+__s(\d+)__', re.IGNORECASE)
+    while True:
+        match = func.search(text)
+        if match is None:
+            break
+        name = match.group(1).lower()
+        modifiers = [literals[int(i)][1:-1] for i in _PLACEHOLDER.findall(match.group(4))]
+        if not modifiers or modifiers[0].lower() != 'unixepoch' or not all(_TIME_MODIFIER.match(m) for m in modifiers):
+            return None
+        if name == 'strftime':
+            if match.group(2) is None:
+                return None
+            granularity = _format_granularity(literals[int(match.group(2))][1:-1])
+        else:
+            granularity = 86400 if name == 'date' else 1
+        end = match.end()
+        if granularity == 1:
+            # Only range filters against datetime literals survive bucketing, at the literal's alignment
+            cmp = compare.match(text, end)
+            if cmp is None or cmp.group(1) in ('<>', '!=', '==', '='):
+                return None
+            bounds = [(cmp.group(1), cmp.group(2))] if cmp.group(1) else [('>=', cmp.group(3)), ('<=', cmp.group(4))]
+            for op, index in bounds:
+                seconds, complete = _literal_seconds(literals[int(index)])
+                if seconds is None:
+                    return None
+                # A complete literal bounds at the next second for > and <=; a shorter prefix always at its start
+                checks.append(('seconds', seconds + (1 if complete and op in ('>', '<=') else 0)))
+            end = cmp.end()
+        else:
+            checks.append(('seconds', granularity))
+        text = text[:match.start()] + ' ' + text[end:]
+    col = _col(ts)
+    numeric = r'(\d+)(?![\d.])'
+    patterns = [
+        (re.compile(rf'{col}\s*(>=|<=|>|<)\s*{numeric}', re.IGNORECASE), lambda m: [(m.group(2), m.group(3))]),
+        (re.compile(rf'{numeric}\s*(>=|<=|>|<)\s*{col}', re.IGNORECASE),
+         lambda m: [({'>=': '<=', '<=': '>=', '>': '<', '<': '>'}[m.group(2)], m.group(1))]),
+        (re.compile(rf'{col}\s+between\s+{numeric}\s+and\s+{numeric}', re.IGNORECASE),
+         lambda m: [('>=', m.group(2)), ('<=', m.group(3))]),
+    ]
+    for pattern, bounds in patterns:
+        for match in list(pattern.finditer(text)):
+            if _in_expression(text, match.start(), match.end()):
+                return None
+            for op, value in bounds(match):
+                checks.append(('units', int(value) + (1 if op in ('>', '<=') else 0)))
+        text = pattern.sub(' ', text)
+    buckets = [
+        re.compile(rf'{col}\s*-\s*\(?\s*{col}\s*%\s*{numeric}\s*\)?', re.IGNORECASE),
+        re.compile(rf'{col}\s*/\s*{numeric}', re.IGNORECASE),
+    ]
+    for pattern in buckets:
+        for match in pattern.finditer(text):
+            checks.append(('units', int(match.group(match.lastindex))))
+        text = pattern.sub(' ', text)
+    if re.search(col, text, re.IGNORECASE):
+        return None
+    return checks, text
+
+def rewrite_for_rollups(sql, conn, rollups=None):
+    # Returns (rewritten_sql, rollup_table), or None when the query has to run on the raw table
+    rollups = load_rollups(conn) if rollups is None else rollups
+    if not rollups:
+        return None
+    literals = []
+    def mask(match):
+        literals.append(match.group(0))
+        return f'__s{len(literals) - 1}__'
+    text = _STRING.sub(mask, sql.strip().rstrip(';').strip())
+    if _UNSUPPORTED.search(text) or len(re.findall(r'\bselect\b', text, re.IGNORECASE)) != 1:
+        return None
+    source = _SOURCE.search(text)
+    if source is None or source.group(2) or source.group(1) not in rollups:
+        return None
+    table = source.group(1)
+    candidates = rollups[table]
+    layout = candidates[0]
+    raw_columns = {row[1]: (row[2] or '').upper() for row in conn.execute(f'PRAGMA table_info("{table}")')}
+    if raw_columns.get(layout['timestamp']) != 'INTEGER':
+        # Division only buckets integer timestamps
+        return None
+
+    # KPI columns may only appear inside the aggregates a rollup can re-aggregate
+    replacements = []
+    def aggregate(match):
+        func, q, col = match.group(1).lower(), re.sub(r'\s+', '', match.group(2)), match.group(3)
+        if func == 'avg':
+            expr = f'(SUM({q}"{col}_sum") * 1.0 / SUM({q}"{col}_count"))'
+        elif func == 'count':
+            expr = f'COALESCE(SUM({q}"{col}_count"), 0)'
+        else:
+            expr = f'{func.upper()}({q}"{col}_{"sum" if func in ("sum", "total") else func}")'
+        replacements.append(expr)
+        return f'__r{len(replacements) - 1}__'
+    for col in layout['values']:
+        pattern = re.compile(rf'\b(min|max|sum|count|avg|total)\s*\(\s*((?:"?\w+"?\s*\.\s*)?)"?({re.escape(col)})"?\s*\)', re.IGNORECASE)
+        text = pattern.sub(aggregate, text)
+        if re.search(_col(col), text, re.IGNORECASE):
+            return None
+    if not replacements:
+        return None
+    if re.search(r'\bselect\s+\*|,\s*\*|\.\s*\*', text, re.IGNORECASE):
+        return None
+
+    ms = layout['bucket'] != layout['seconds']
+    analysed = _time_checks(text, literals, layout['timestamp'], ms)
+    if analysed is None:
+        return None
+    checks, rest = analysed
+    # Any other column of the raw table must be a rollup key
+    rest = _PLACEHOLDER.sub(' ', rest)
+    for col in set(raw_columns) - set(layout['keys']):
+        if re.search(_col(col), rest, re.IGNORECASE):
+            return None
+
+    for rollup in candidates:
+        if all(n % (rollup['seconds'] if kind == 'seconds' else rollup['bucket']) == 0 for kind, n in checks):
+            break
+    else:
+        return None
+    source = _SOURCE.search(text)
+    text = text[:source.start(1)] + rollup['table'] + text[source.end(1):]
+    text = re.sub(r'__r(\d+)__', lambda m: replacements[int(m.group(1))], text)
+    text = _PLACEHOLDER.sub(lambda m: literals[int(m.group(1))], text)
+    return text, rollup['table']
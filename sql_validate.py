@@ -0,0 +1,158 @@
+import os
+import re
+import json
+import difflib
+import sqlite3
+import threading
+from rca.baseline.rca_agent.sql_functions import register_sql_functions
+
+# Local static validation of model-written SQL. Queries are compiled (EXPLAIN, never run) against an
+# empty in-memory copy of the schema cached by import_to_sql (dataset/<name>/schema.json), so unknown
+# tables, columns and functions and syntax errors are found without touching data.db. A misspelt name
+# with a single close match is fixed in place; otherwise the closest valid names are suggested.
+
+# Similarity (difflib ratio) a name needs to be suggested, and to be substituted automatically
+SUGGEST_CUTOFF = 0.6
+FIX_CUTOFF = 0.8
+# Misspelt names fixed in one query at most
+MAX_FIXES = 5
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_TYPES = {'int64': 'INTEGER', 'float64': 'REAL', 'str': 'TEXT', 'object': 'TEXT', 'bool': 'INTEGER'}
+_UNKNOWN = re.compile(r'^no such (table|column|function): (.+)$')
+
+class Validation:
+    def __init__(self, sql):
+        self.sql = sql
+        self.fixes = []
+        self.error = None
+        self.suggestions = []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def _table_ddl(table, columns):
+    names = [col for col, _ in columns]
+    if table.endswith('_fts'):
+        return f'CREATE VIRTUAL TABLE "{table}" USING fts5(' + ', '.join(f'"{col}"' for col in names) + ')'
+    return f'CREATE TABLE "{table}" (' + ', '.join(f'"{col}" {_TYPES.get(coltype, coltype)}' for col, coltype in columns) + ')'
+
+def load_schema(db_path):
+    # {table: [(column, type), ...]} from the importer's schema cache, or from data.db itself without one
+    schema_json = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'schema.json')
+    if os.path.exists(schema_json):
+        with open(schema_json, 'r') as f:
+            return {table: [tuple(col) for col in columns] for table, columns in json.load(f).items()}
+    conn = sqlite3.connect(f'file:{os.path.abspath(db_path)}?mode=ro', uri=True)
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite%' AND name NOT LIKE '\\_%' ESCAPE '\\'")]
+        return {table: [(col[1], col[2]) for col in conn.execute(f'PRAGMA table_info("{table}")')] for table in tables}
+    finally:
+        conn.close()
+
+def _replace_identifier(sql, old, new):
+    # Whole-identifier replacement outside string literals, quoted or not
+    parts = re.split(f'({_STRING.pattern})', sql)
+    pattern = re.compile(rf'(?<![\w$])("?){re.escape(old)}\1(?![\w$])', re.IGNORECASE)
+    for i in range(0, len(parts), 2):
+        parts[i] = pattern.sub(lambda m: f'{m.group(1)}{new}{m.group(1)}', parts[i])
+    return ''.join(parts)
+
+class SchemaValidator:
+    def __init__(self, schema):
+        self.schema = schema
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        register_sql_functions(self.conn)
+        for table, columns in schema.items():
+            try:
+                self.conn.execute(_table_ddl(table, columns))
+            except sqlite3.Error:
+                continue
+        try:
+            self.functions = sorted({row[0] for row in self.conn.execute('SELECT name FROM pragma_function_list')})
+        except sqlite3.Error:
+            self.functions = []
+
+    def compile_error(self, sql):
+        with self.lock:
+            try:
+                self.conn.execute(f'EXPLAIN {sql}').fetchall()
+                return None
+            except (sqlite3.Error, sqlite3.Warning) as e:
+                return str(e)
+
+    def candidates(self, kind, sql):
+        if kind == 'table':
+            return list(self.schema)
+        if kind == 'function':
+            return self.functions
+        # Columns of the tables the query mentions
+        text = _STRING.sub("''", sql).lower()
+        mentioned = [table for table in self.schema if re.search(rf'(?<![\w$]){re.escape(table.lower())}(?![\w$])', text)]
+        return sorted({col for table in mentioned for col, _ in self.schema[table]})
+
+    def closest(self, name, candidates, n=3):
+        close = difflib.get_close_matches(name, candidates, n, SUGGEST_CUTOFF)
+        # 'kpi' -> 'kpi_name': a prefix or part of a valid name is as telling as a typo
+        close += [c for c in candidates if c not in close and len(name) >= 3 and name.lower() in c.lower()]
+        return close[:n]
+
+    def owners(self, column):
+        return [table for table, columns in self.schema.items() if any(col == column for col, _ in columns)]
+
+    def validate(self, sql, max_fixes=MAX_FIXES):
+        check = Validation(sql)
+        for _ in range(max_fixes + 1):
+            error = self.compile_error(check.sql)
+            if error is None:
+                check.error = None
+                check.suggestions = []
+                return check
+            check.error = error
+            check.suggestions = []
+            match = _UNKNOWN.match(error)
+            if match is None:
+                return check
+            kind, name = match.groups()
+            qualifier, _, name = name.rpartition('.') if kind == 'column' else ('', '', name)
+            candidates = self.candidates(kind, check.sql)
+            close = self.closest(name, candidates)
+            case_match = [candidate for candidate in candidates if candidate.lower() == name.lower()]
+            check.suggestions = [(kind, name, close)]
+            fixes = case_match or difflib.get_close_matches(name, candidates, 2, FIX_CUTOFF)
+            if len(fixes) != 1 or len(check.fixes) >= max_fixes:
+                return check
+            fixed = _replace_identifier(check.sql, name, fixes[0])
+            if fixed == check.sql:
+                return check
+            check.fixes.append((kind, f'{qualifier}.{name}' if qualifier else name, fixes[0]))
+            check.sql = fixed
+        return check
+
+    def describe(self, check):
+        # Retry hint for a query that failed validation
+        lines = [f"The SQL query does not compile against the database schema: {check.error}"]
+        for kind, name, close in check.suggestions:
+            owners = self.owners(name) if kind == 'column' else []
+            if owners:
+                lines.append(f"`{name}` is not a column of the tables in the query; it is a column of: " + ', '.join(f'`{t}`' for t in owners[:8]) + '.')
+            if close:
+                lines.append(f"Closest valid {kind} names: " + ', '.join(f'`{c}`' for c in close) + '.')
+            elif not owners:
+                lines.append(f"Unknown {kind} `{name}`, and no valid {kind} name is close to it.")
+        return '\n'.join(lines)
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+def get_validator(db_path):
+    # One validator per dataset, rebuilt when the importer rewrites schema.json
+    key = os.path.abspath(db_path)
+    schema_json = os.path.join(os.path.dirname(key), 'schema.json')
+    stamp = os.stat(schema_json).st_mtime_ns if os.path.exists(schema_json) else None
+    with _validators_lock:
+        entry = _validators.get(key)
+        if entry is None or entry[0] != stamp:
+            entry = _validators[key] = (stamp, SchemaValidator(load_schema(db_path)))
+        return entry[1]
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+AGENT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# The agent modules import each other as rca.baseline.rca_agent.*; the self-contained ones are also
+# imported straight from this directory
+sys.path.insert(0, AGENT_DIR)
+
+# Stand-in for the parent project's LLM router, which is not part of this directory
+API_ROUTER = """configs = {'SOURCE': 'test', 'MODEL': 'test'}
+
+def get_chat_completion(messages, **kwargs):
+    raise RuntimeError('no LLM in tests')
+"""
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    # The upstream layout: <project>/rca/baseline/rca_agent (this directory), <project>/rca/api_router.py
+    # and <project>/dataset/import_to_sql.py; only <project> is on sys.path
+    (tmp_path / 'rca' / 'baseline').mkdir(parents=True)
+    (tmp_path / 'rca' / '__init__.py').write_text('')
+    (tmp_path / 'rca' / 'api_router.py').write_text(API_ROUTER)
+    (tmp_path / 'rca' / 'baseline' / '__init__.py').write_text('')
+    os.symlink(AGENT_DIR, tmp_path / 'rca' / 'baseline' / 'rca_agent')
+    (tmp_path / 'dataset').mkdir()
+    with open(os.path.join(AGENT_DIR, 'import_to_sql.py')) as src:
+        (tmp_path / 'dataset' / 'import_to_sql.py').write_text(src.read())
+    monkeypatch.setattr(sys, 'path', [str(tmp_path)] + [p for p in sys.path if os.path.abspath(p or '.') != AGENT_DIR])
+    monkeypatch.delitem(sys.modules, 'import_to_sql', raising=False)
+    for name in [name for name in sys.modules if name == 'rca' or name.startswith('rca.')]:
+        monkeypatch.delitem(sys.modules, name)
+    return str(tmp_path)
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+pytest.importorskip('pandas')
+
+def test_fenced_step_streamed_through_json_end_needs_no_repair(project, monkeypatch):
+    import rca.api_router as api_router
+    from rca.baseline.rca_agent import controller, llm_stream
+    step = {'analysis': 'cpu of node-1 is high', 'completed': 'False', 'instruction': 'Check the memory of node-1.'}
+    reply = '```json\n' + json.dumps(step, indent=4) + '\n```\nI will wait for the observation.'
+
+    def stream(messages, **kwargs):
+        for k in range(0, len(reply), 7):
+            yield reply[k:k + 7]
+    monkeypatch.setattr(api_router, 'get_chat_completion_stream', stream, raising=False)
+    # The stream is cut right after the object's closing brace, so its closing fence never arrives
+    text = llm_stream.streaming(api_router.get_chat_completion, llm_stream.json_end, 'controller')(messages=[])
+    assert not text.rstrip().endswith('```')
+    response, repaired = controller.parse_step(text)
+    assert response == step
+    assert repaired is False
+
+class ResponseError(Exception):
+    # Shaped like ollama.ResponseError from a server without structured outputs
+    def __init__(self, error, status_code):
+        super().__init__(error)
+        self.status_code = status_code
+
+def test_backend_rejecting_the_schema_falls_back_to_prompt_only(project, monkeypatch):
+    import rca.api_router as api_router
+    from rca.baseline.rca_agent import controller
+    step = {'analysis': 'cpu of node-1 is high', 'completed': 'False', 'instruction': 'Check the memory of node-1.'}
+    calls = []
+
+    def stream(messages, **kwargs):
+        calls.append(kwargs.get('format'))
+        if kwargs.get('format'):
+            raise ResponseError('invalid format: expected "json" or a JSON schema', 400)
+        yield json.dumps(step)
+    monkeypatch.setattr(api_router, 'get_chat_completion_stream', stream, raising=False)
+    monkeypatch.setattr(controller, 'STRUCTURED_OUTPUT', True)
+    warnings = []
+    logger = type('Logger', (), {'warning': lambda self, message: warnings.append(message)})()
+    assert json.loads(controller.step_completion([{'role': 'user', 'content': 'go'}], logger)) == step
+    assert controller.STRUCTURED_OUTPUT is False
+    assert len(warnings) == 1
+    # Later steps no longer ask for the schema
+    assert json.loads(controller.step_completion([{'role': 'user', 'content': 'go on'}], logger)) == step
+    assert calls == [controller.response_schema, None, None]
+
+def test_other_backend_errors_are_not_taken_for_a_rejected_schema(project, monkeypatch):
+    import rca.api_router as api_router
+    from rca.baseline.rca_agent import controller
+
+    def stream(messages, **kwargs):
+        raise ResponseError('model "test" not found, try pulling it first', 404)
+        yield
+    monkeypatch.setattr(api_router, 'get_chat_completion_stream', stream, raising=False)
+    monkeypatch.setattr(controller, 'STRUCTURED_OUTPUT', True)
+    with pytest.raises(ResponseError):
+        controller.step_completion([{'role': 'user', 'content': 'go'}])
+    assert controller.STRUCTURED_OUTPUT is True
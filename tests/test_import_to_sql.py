@@ -0,0 +1,30 @@
+import os
+import sys
+import sqlite3
+import importlib.util
+
+import pytest
+
+pytest.importorskip('pandas')
+
+def load_like_runner(project):
+    # run_agent_standard loads dataset/import_to_sql.py by path; dataset/ itself is not on sys.path
+    spec = importlib.util.spec_from_file_location('import_to_sql', os.path.join(project, 'dataset', 'import_to_sql.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def test_parallel_import_from_runner_loader(project, tmp_path):
+    import_to_sql = load_like_runner(project)
+    plan = []
+    for day in range(3):
+        path = tmp_path / f'metric_{day}.csv'
+        path.write_text('timestamp,cmdb_id,kpi_name,value\n' + ''.join(f'{1647734400 + day * 86400 + i},node-1,cpu,{i}\n' for i in range(50)))
+        plan.append(('metric_container', str(path), f'2022_03_2{day}/metric/metric_container.csv', 0, 0.0, f'hash{day}'))
+    conn = sqlite3.connect(str(tmp_path / 'data.db'))
+    import_to_sql.ensure_manifest(conn.cursor())
+    import_to_sql.parallel_import(conn, plan, lambda msg, **fields: None, workers=2, chunk_rows=20)
+    assert conn.execute('SELECT COUNT(*) FROM metric_container').fetchone()[0] == 150
+    assert conn.execute('SELECT COUNT(*) FROM _import_manifest').fetchone()[0] == 3
+    conn.close()
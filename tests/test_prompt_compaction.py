@@ -0,0 +1,36 @@
+import json
+
+def step_messages(number):
+    response = json.dumps({'analysis': f'step {number}', 'completed': 'False',
+                           'instruction': f'Check the metrics of service-{number} around the failure.'})
+    observation = f'service-{number} metrics: ' + ' '.join(str(k * number) for k in range(150))
+    return [{'role': 'assistant', 'content': response}, {'role': 'user', 'content': observation}]
+
+def test_sent_prompt_extends_the_previous_one_while_compacting(project):
+    from rca.baseline.rca_agent.prompt_compaction import PromptCompactor
+    compactor = PromptCompactor(budget=6000, keep_steps=2)
+    prompt = [{'role': 'system', 'content': 'You are the controller.'}, {'role': 'user', 'content': 'The issue.'}]
+    sent, extended, folds, drops = [], 0, 0, 0
+    for number in range(1, 61):
+        prompt += step_messages(number)
+        before = (compactor.compacted, len(compactor.blocks), compactor.dropped)
+        messages = compactor.messages(prompt)
+        assert compactor.last_tokens[1] <= compactor.budget
+        if not compactor.compacted:
+            pass
+        elif compactor.compacted == before[0]:
+            # No fold: the previous prompt is sent again unchanged, followed by the new step
+            assert messages[:len(sent)] == sent
+            extended += 1
+        elif compactor.dropped == before[2]:
+            # A fold appends one digest message; the head and the digest already sent stay as they were
+            kept = 2 + before[1]
+            assert messages[:kept] == sent[:kept]
+            assert len(compactor.blocks) == before[1] + 1
+            folds += 1
+        else:
+            assert messages[:2] == sent[:2]
+            drops += 1
+        sent = messages
+    assert folds and drops
+    assert extended > folds + drops
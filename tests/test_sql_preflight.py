@@ -0,0 +1,92 @@
+import sqlite3
+
+import pytest
+
+from sql_preflight import make_sargable, preflight, PreflightRejected
+
+START = 1647734400  # 2022-03-20 00:00:00 UTC
+
+@pytest.fixture(scope='module')
+def conn():
+    # One row every 20 minutes from 2022-03-19 to 2022-03-22, in seconds and in milliseconds
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE metric (timestamp INTEGER, timestamp_ms INTEGER)')
+    conn.executemany('INSERT INTO metric VALUES (?, ?)', [(ts, ts * 1000) for ts in range(START - 86400, START + 2 * 86400, 1200)])
+    yield conn
+    conn.close()
+
+def count(conn, where):
+    return conn.execute(f'SELECT COUNT(*) FROM metric WHERE {where}').fetchone()[0]
+
+@pytest.mark.parametrize('where', [
+    "date(timestamp, 'unixepoch') = '2022-03-20'",
+    "date(timestamp, 'unixepoch') >= '2022-03-20'",
+    "date(timestamp, 'unixepoch') > '2022-03-20'",
+    "date(timestamp, 'unixepoch') <= '2022-03-20'",
+    "date(timestamp, 'unixepoch') < '2022-03-20'",
+    "date(timestamp, 'unixepoch', '+8 hours') = '2022-03-20'",
+    "date(timestamp_ms / 1000, 'unixepoch') BETWEEN '2022-03-20' AND '2022-03-21'",
+    "'2022-03-20' <= date(timestamp, 'unixepoch')",
+    "datetime(timestamp, 'unixepoch') >= '2022-03-20 10:00:00'",
+    "datetime(timestamp, 'unixepoch') > '2022-03-20 10:00:00'",
+    "datetime(timestamp, 'unixepoch') < '2022-03-20 10'",
+    "datetime(timestamp, 'unixepoch') BETWEEN '2022-03-20 10:00:00' AND '2022-03-20 18:00:00'",
+    "strftime('%Y-%m-%d %H:%M:%S', timestamp_ms / 1000, 'unixepoch', '+8 hours') <= '2022-03-20 10:00:00'",
+])
+def test_rewrite_keeps_row_count(conn, where):
+    rewritten, rewrites = make_sargable(where)
+    assert rewrites
+    assert count(conn, rewritten) == count(conn, where)
+
+@pytest.mark.parametrize('where', [
+    # date() output is compared as text with these, which is not a whole-day range
+    "date(timestamp, 'unixepoch') >= '2022-03-20 10:00:00'",
+    "date(timestamp, 'unixepoch') = '2022-03-20 10:00:00'",
+    "date(timestamp, 'unixepoch') < '2022-03-20 10'",
+    "'2022-03-20 10:00:00' <= date(timestamp, 'unixepoch')",
+    # Not zero-padded, so the text comparison does not follow the calendar
+    "date(timestamp, 'unixepoch') >= '2022-3-20'",
+    "datetime(timestamp, 'unixepoch') >= '2022-03-20 9:00:00'",
+])
+def test_non_matching_literal_is_left_alone(conn, where):
+    rewritten, rewrites = make_sargable(where)
+    assert not rewrites and rewritten == where
+
+@pytest.fixture(scope='module')
+def metric_conn():
+    # A metric table larger than the reject threshold used below, indexed on timestamp only (as imported)
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE metric_container (timestamp INTEGER, cmdb_id TEXT, kpi_name TEXT, value REAL)')
+    conn.executemany('INSERT INTO metric_container VALUES (?, ?, ?, ?)',
+                     [(START + i, f'node-{i % 7}', 'cpu', float(i)) for i in range(6001)])
+    conn.execute('CREATE INDEX idx_metric_container_timestamp ON metric_container (timestamp)')
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize('sql', [
+    'SELECT * FROM metric_container LIMIT 5',
+    'SELECT COUNT(*) FROM metric_container',
+    'SELECT DISTINCT cmdb_id FROM metric_container',
+    "SELECT * FROM metric_container WHERE cmdb_id = 'node-1'",
+])
+def test_single_table_scan_is_not_rejected(metric_conn, sql):
+    check = preflight(metric_conn, sql, reject_rows=5000)
+    assert check.sql == sql
+
+def test_limit_caps_the_estimate(metric_conn):
+    assert preflight(metric_conn, 'SELECT * FROM metric_container LIMIT 5', reject_rows=5000).estimate == 5
+    # Sorting has to read every row first, so LIMIT does not bound it
+    assert preflight(metric_conn, 'SELECT * FROM metric_container ORDER BY value LIMIT 5', reject_rows=5000).estimate > 5
+
+def test_covering_index_scan_is_discounted(metric_conn):
+    plain = preflight(metric_conn, 'SELECT SUM(value) FROM metric_container', reject_rows=5000)
+    covering = preflight(metric_conn, 'SELECT COUNT(timestamp) FROM metric_container', reject_rows=5000)
+    assert covering.estimate < plain.estimate
+
+def test_expensive_single_scan_gets_hints(metric_conn):
+    check = preflight(metric_conn, "SELECT * FROM metric_container WHERE cmdb_id = 'node-1'", reject_rows=5000)
+    assert check.hints
+
+def test_cross_join_is_rejected(metric_conn):
+    with pytest.raises(PreflightRejected):
+        preflight(metric_conn, 'SELECT COUNT(*) FROM metric_container a, metric_container b WHERE a.value < b.value', reject_rows=5000)
@@ -0,0 +1,25 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip('pandas')
+
+from sql_budget import QueryBudget
+from sql_result import fetch_result, render_result
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (n INTEGER)')
+    conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(2500)])
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize('max_rows, capped', [(1000, True), (2500, False), (None, False)])
+def test_row_cap_stops_reading_without_failing(conn, max_rows, capped):
+    result = fetch_result(conn, 'SELECT n FROM t', QueryBudget(max_rows=max_rows), fetch_rows=300)
+    assert result.capped is capped
+    assert result.row_count == (max_rows if capped else 2500)
+    assert result.summaries[0].count == result.row_count
+    text, _ = render_result(result)
+    assert ('reading stopped there' in text) is capped
@@ -0,0 +1,53 @@
+import sqlite3
+
+import pytest
+
+from sql_rollup import rewrite_for_rollups
+
+START = 1647770400  # 2022-03-20 10:00:00 UTC
+RESOLUTIONS = (('1m', 60), ('5m', 300), ('1h', 3600))
+
+@pytest.fixture(scope='module')
+def conn():
+    # Two hours of one point per second, value = seconds since START, with rollups laid out as the importer builds them
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE metric_container (timestamp INTEGER, cmdb_id TEXT, kpi_name TEXT, value REAL)')
+    conn.executemany('INSERT INTO metric_container VALUES (?, ?, ?, ?)',
+                     [(START + i, 'node-1', 'cpu', float(i)) for i in range(7200)])
+    conn.execute('''CREATE TABLE rollup_tables (table_name TEXT PRIMARY KEY, metric_table TEXT, resolution TEXT, seconds INTEGER,
+                    bucket INTEGER, timestamp_column TEXT, component_column TEXT, kpi_column TEXT, value_columns TEXT)''')
+    for suffix, seconds in RESOLUTIONS:
+        rollup = f'metric_container_rollup_{suffix}'
+        conn.execute(f'''CREATE TABLE "{rollup}" AS SELECT '2022_03_20' AS date, cmdb_id, kpi_name,
+                         (timestamp / {seconds}) * {seconds} AS timestamp, MIN(value) AS value_min, MAX(value) AS value_max,
+                         AVG(value) AS value_avg, SUM(value) AS value_sum, COUNT(value) AS value_count
+                         FROM metric_container GROUP BY cmdb_id, kpi_name, (timestamp / {seconds}) * {seconds}''')
+        conn.execute('INSERT INTO rollup_tables VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (rollup, 'metric_container', suffix, seconds, seconds, 'timestamp', 'cmdb_id', 'kpi_name', 'value'))
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize('sql, table', [
+    (f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp >= {START + 3600}', 'metric_container_rollup_1h'),
+    (f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp >= {START + 600}', 'metric_container_rollup_5m'),
+    (f'SELECT MAX(value) FROM metric_container WHERE {START + 60} <= timestamp AND timestamp < {START + 7200}', 'metric_container_rollup_1m'),
+    (f'SELECT cmdb_id, AVG(value) FROM metric_container WHERE timestamp BETWEEN {START} AND {START + 3599} GROUP BY cmdb_id',
+     'metric_container_rollup_1h'),
+])
+def test_rewrite_matches_raw(conn, sql, table):
+    rewrite = rewrite_for_rollups(sql, conn)
+    assert rewrite is not None and rewrite[1] == table
+    assert conn.execute(rewrite[0]).fetchall() == conn.execute(sql).fetchall()
+
+@pytest.mark.parametrize('sql', [
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp >= {START} + 600',
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp >= {START + 3600} - 30',
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp * 1000 >= {START * 1000}',
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp >= {START} * 1',
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE {START} + 30 <= timestamp',
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE {START + 3600} <= timestamp + 30',
+    f'SELECT MIN(value), COUNT(value) FROM metric_container WHERE timestamp BETWEEN {START} AND {START + 3600} - 1',
+])
+def test_arithmetic_on_bounds_is_not_rewritten(conn, sql):
+    # The literal next to the column is not the bound, so no rollup alignment can be read off it
+    assert rewrite_for_rollups(sql, conn) is None